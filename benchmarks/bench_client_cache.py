@@ -0,0 +1,156 @@
+#!/usr/bin/python
+#
+# Count the keystone round-trips of polling nova, glance and cinder
+# with and without the client cache against a local fake keystone
+#
+# Copyright 2014 ETH Zurich, ISGINF, Bastian Ballmann
+# Email: bastian.ballmann@inf.ethz.ch
+# Web: http://www.isg.inf.ethz.ch
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# It is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License.
+# If not, see <http://www.gnu.org/licenses/>.
+
+
+#
+# Loading modules
+#
+
+import os
+import sys
+import json
+import threading
+from time import time, strftime, gmtime
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import openstack_lib
+from openstack_lib import get_nova_client, get_glance_client, get_cinder_client, flush_client_cache
+
+
+#
+# Configuration
+#
+
+# a poll round checks every item once like glance_check_upload or nova_check_migration
+ITEMS = 200
+POLLS = 10
+TENANTS = 4
+
+# lifetime of the tokens handed out by the fake keystone in seconds
+TOKEN_LIFETIME = 3600
+
+
+#
+# Subroutines
+#
+
+# requests seen by the fake keystone
+requests = {'tokens': 0, 'tenants': 0}
+
+
+class FakeKeystone(BaseHTTPRequestHandler):
+    """
+    Answers the keystone v2.0 token and tenant calls the tools make
+    """
+    def send_json(self, data):
+        body = json.dumps(data)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        requests['tokens'] += 1
+        base = "http://%s:%d/v2.0" % self.server.server_address
+        endpoint = {"adminURL": base, "publicURL": base, "internalURL": base, "region": "RegionOne"}
+
+        self.send_json({"access": {
+            "token": {"id": "token%d" % requests['tokens'],
+                      "expires": strftime("%Y-%m-%dT%H:%M:%SZ", gmtime(time() + TOKEN_LIFETIME)),
+                      "tenant": {"id": "admin", "name": "admin"}},
+            "serviceCatalog": [{"type": "identity", "name": "keystone", "endpoints": [endpoint]},
+                               {"type": "image", "name": "glance", "endpoints": [endpoint]}],
+            "user": {"id": "admin", "name": os.environ["OS_USERNAME"], "roles": []},
+            "metadata": {"is_admin": 1, "roles": []}}})
+
+    def do_GET(self):
+        requests['tenants'] += 1
+        tenant_id = self.path.rstrip("/").split("/")[-1]
+        self.send_json({"tenant": {"id": tenant_id, "name": "tenant_" + tenant_id, "enabled": True}})
+
+    def log_message(self, *args):
+        pass
+
+
+def start_fake_keystone():
+    """
+    Start the fake keystone in a background thread and point the environment to it
+    """
+    server = HTTPServer(("127.0.0.1", 0), FakeKeystone)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    os.environ["OS_AUTH_URL"] = "http://%s:%d/v2.0" % server.server_address
+    os.environ["OS_USERNAME"] = "admin"
+    os.environ["OS_PASSWORD"] = "secret"
+    os.environ["OS_TENANT_NAME"] = "admin"
+
+
+def poll(cached):
+    """
+    Run POLLS rounds over ITEMS items and fetch the clients a check function needs
+    Params: use the client cache (bool)
+    Returns: tupel of token requests, tenant requests, seconds
+    """
+    flush_client_cache()
+    requests['tokens'] = requests['tenants'] = 0
+    start = time()
+
+    for poll_round in range(POLLS):
+        for item in range(ITEMS):
+            if not cached:
+                flush_client_cache()
+
+            tenant = str(item % TENANTS)
+            get_nova_client(tenant)
+            get_glance_client()
+            get_cinder_client("tenant_" + tenant)
+
+    return (requests['tokens'], requests['tenants'], time() - start)
+
+
+#
+# MAIN PART
+#
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        ITEMS = int(sys.argv[1])
+
+    if len(sys.argv) > 2:
+        POLLS = int(sys.argv[2])
+
+    start_fake_keystone()
+    print "%d items, %d poll rounds, %d tenants" % (ITEMS, POLLS, TENANTS)
+
+    for (name, cached) in (("uncached", False), ("cached", True)):
+        (tokens, tenants, seconds) = poll(cached)
+        print "%-8s %6d token requests %6d tenant lookups %8.2fs" % (name, tokens, tenants, seconds)
+
+    # tokens within CLIENT_TOKEN_STALE of their expiry must be renewed on the next lookup
+    TOKEN_LIFETIME = openstack_lib.CLIENT_TOKEN_STALE - 1
+    (tokens, tenants, seconds) = poll(True)
+    print "%-8s %6d token requests %6d tenant lookups %8.2fs" % ("expiring", tokens, tenants, seconds)
@@ -0,0 +1,162 @@
+#!/usr/bin/python
+#
+# Measure the throughput and ratio of every available compression codec
+# when downloading and reading back synthetic vm images
+#
+# Copyright 2014 ETH Zurich, ISGINF, Bastian Ballmann
+# Email: bastian.ballmann@inf.ethz.ch
+# Web: http://www.isg.inf.ethz.ch
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# It is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License.
+# If not, see <http://www.gnu.org/licenses/>.
+
+
+#
+# Loading modules
+#
+
+import os
+import sys
+import shutil
+import hashlib
+import tempfile
+from time import time
+import fake_glance
+import openstack_lib
+
+
+#
+# Configuration
+#
+
+# size of the image in MB
+IMAGE_SIZE = 128
+
+# share of zeroed, text like and random 1 MB blocks in the image
+IMAGE_MIX = (('zero', 4), ('text', 3), ('random', 3))
+
+
+#
+# Subroutines
+#
+def make_vm_image(size):
+    """
+    Generate a synthetic vm disk image
+    The blocks follow IMAGE_MIX, the content is the same on every run
+    Params: size in bytes
+    Returns: string
+    """
+    block_size = 1024 * 1024
+    text = "".join(["/usr/lib/python2.7/dist-packages/module%d.py 0644 root root %d\n" % (i, i * 4099) for i in range(30000)])
+    kinds = [kind for (kind, share) in IMAGE_MIX for i in range(share)]
+    blocks = []
+
+    for number in range(size / block_size + 1):
+        kind = kinds[(number * 7) % len(kinds)]
+
+        if kind == "zero":
+            blocks.append("\0" * block_size)
+        elif kind == "text":
+            offset = (number * 104729) % (len(text) - block_size)
+            blocks.append(text[offset:offset + block_size])
+        else:
+            blocks.append("".join([hashlib.sha512("%d:%d" % (number, i)).digest() for i in range(block_size / 64)]))
+
+    return "".join(blocks)[:size]
+
+
+def get_codecs():
+    """
+    Return the compression codecs that are installed
+    Returns: list of codec names (None is uncompressed)
+    """
+    codecs = [None]
+
+    if openstack_lib.zstandard:
+        codecs.append("zstd")
+
+    if openstack_lib.lz4_frame:
+        codecs.append("lz4")
+
+    return codecs + ["gzip"]
+
+
+def run(codec, output_dir, data):
+    """
+    Download the test image with a codec and read it back
+    Params: codec name, output directory, expected image data
+    Returns: tupel of download MB/s, compression ratio, read MB/s, boolean if read data matches
+    """
+    output_file = os.path.join(output_dir, "image.img")
+    openstack_lib.BACKUP_COMPRESSION = codec
+    sys.stdout = open(os.devnull, "w")
+    start = time()
+
+    try:
+        ok = openstack_lib.download_glance_image("image", output_file)
+    finally:
+        download_seconds = time() - start
+        sys.stdout.close()
+        sys.stdout = sys.__stdout__
+
+    image_file = openstack_lib.find_backup_image(output_file)
+
+    if not ok or not image_file:
+        return (0, 0, 0, False)
+
+    ratio = float(len(data)) / os.path.getsize(image_file)
+    start = time()
+    reader = openstack_lib.open_image_reader(image_file, codec)
+    hasher = hashlib.md5()
+
+    while True:
+        chunk = reader.read(openstack_lib.DOWNLOAD_CHUNK_SIZE)
+
+        if not chunk:
+            break
+
+        hasher.update(chunk)
+
+    reader.close()
+    read_seconds = time() - start
+
+    for old_file in openstack_lib.get_backup_image_files(output_file) + [output_file + ".md5"]:
+        if os.path.exists(old_file):
+            os.unlink(old_file)
+
+    return (len(data) / download_seconds / 1e6, ratio, len(data) / read_seconds / 1e6,
+            hasher.hexdigest() == hashlib.md5(data).hexdigest())
+
+
+#
+# MAIN PART
+#
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        IMAGE_SIZE = int(sys.argv[1])
+
+    fake_glance.start()
+    data = make_vm_image(IMAGE_SIZE * 1024 * 1024)
+    fake_glance.images["image"] = data
+    output_dir = tempfile.mkdtemp()
+
+    print "%d MB synthetic vm image (%s)" % (IMAGE_SIZE, ", ".join(["%s %d/10" % mix for mix in IMAGE_MIX]))
+    print "%-6s %14s %8s %12s %s" % ("codec", "download MB/s", "ratio", "read MB/s", "verified")
+
+    try:
+        for codec in get_codecs():
+            (download_rate, ratio, read_rate, verified) = run(codec, output_dir, data)
+            print "%-6s %14.1f %8.2f %12.1f %s" % (codec or "none", download_rate, ratio, read_rate, verified)
+    finally:
+        shutil.rmtree(output_dir)
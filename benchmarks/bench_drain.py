@@ -0,0 +1,90 @@
+#!/usr/bin/python
+#
+# Run the drain simulation of openstack_migrator.py on a synthetic cluster,
+# check that repeated runs give identical output and print the drain times
+#
+# Copyright 2014 ETH Zurich, ISGINF, Bastian Ballmann
+# Email: bastian.ballmann@inf.ethz.ch
+# Web: http://www.isg.inf.ethz.ch
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# It is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License.
+# If not, see <http://www.gnu.org/licenses/>.
+
+
+#
+# Loading modules
+#
+
+import os
+import sys
+from subprocess import Popen, PIPE
+
+
+#
+# Configuration
+#
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+MIGRATOR = os.path.join(BENCHMARK_DIR, "..", "openstack_migrator.py")
+CLUSTER_FILE = os.path.join(BENCHMARK_DIR, "cluster.json")
+
+# runs of every scenario that must give the same output
+RUNS = 3
+
+# arguments of the drained hosts
+SCENARIOS = [["cmp3"], ["--hosts", "cmp3,cmp4"], ["--aggregate", "rack1"]]
+
+
+#
+# Subroutines
+#
+def simulate(args):
+    """
+    Run one drain simulation
+    Params: list of arguments for openstack_migrator.py
+    Returns: output
+    """
+    proc = Popen([sys.executable, MIGRATOR, "--simulate", CLUSTER_FILE] + args, stdout=PIPE)
+    output = proc.communicate()[0]
+
+    if proc.returncode != 0:
+        print "ERROR simulation " + " ".join(args) + " exited with " + str(proc.returncode)
+        sys.exit(1)
+
+    return output
+
+
+#
+# MAIN PART
+#
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        CLUSTER_FILE = sys.argv[1]
+
+    identical = True
+
+    for scenario in SCENARIOS:
+        for order in ([], ["--smallest-first"]):
+            outputs = [simulate(order + scenario) for run in range(RUNS)]
+            summary = [line for line in outputs[0].splitlines() if "estimated drain time" in line]
+
+            if len(set(outputs)) > 1:
+                identical = False
+
+            print "%-28s %-16s %s%s" % (" ".join(scenario), " ".join(order) or "largest-first",
+                                        summary and summary[0] or "no summary",
+                                        len(set(outputs)) > 1 and " (OUTPUT DIFFERS BETWEEN RUNS)" or "")
+
+    if not identical:
+        sys.exit(1)
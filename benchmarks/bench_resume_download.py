@@ -0,0 +1,125 @@
+#!/usr/bin/python
+#
+# Download an image from a local glance stand-in that drops connections
+# and count the transferred bytes of resumed downloads
+#
+# Copyright 2014 ETH Zurich, ISGINF, Bastian Ballmann
+# Email: bastian.ballmann@inf.ethz.ch
+# Web: http://www.isg.inf.ethz.ch
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# It is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License.
+# If not, see <http://www.gnu.org/licenses/>.
+
+
+#
+# Loading modules
+#
+
+import os
+import sys
+import shutil
+import tempfile
+from time import time
+import fake_glance
+import openstack_lib
+
+
+#
+# Configuration
+#
+
+# size of the image in MB
+IMAGE_SIZE = 64
+
+# the connection is closed after that fraction of the image
+DROP_FRACTION = 0.15
+
+
+#
+# Subroutines
+#
+def quiet(func, *args):
+    """
+    Call a function without printing its output
+    Params: function, arguments
+    Returns: result of the function
+    """
+    sys.stdout = open(os.devnull, "w")
+
+    try:
+        return func(*args)
+    finally:
+        sys.stdout.close()
+        sys.stdout = sys.__stdout__
+
+
+def download(name, output_dir, expected):
+    """
+    Download the test image and print the requests and bytes sent since the last reset
+    Params: name of the run, output directory, expected image data
+    Returns: boolean
+    """
+    output_file = os.path.join(output_dir, name + ".img")
+    start = time()
+    ok = quiet(openstack_lib.download_glance_image, "image", output_file)
+    seconds = time() - start
+    verified = ok and open(output_file, "rb").read() == expected
+
+    print "%-10s ok %-5s verified %-5s %4d requests %8.1f MB sent (%.2fx image) %6.2fs" % \
+        (name, ok, verified, fake_glance.state['requests'], fake_glance.state['sent_bytes'] / 1e6,
+         float(fake_glance.state['sent_bytes']) / len(expected), seconds)
+
+    return ok
+
+
+#
+# MAIN PART
+#
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        IMAGE_SIZE = int(sys.argv[1])
+
+    openstack_lib.DOWNLOAD_RETRY_WAIT = 0
+    openstack_lib.DOWNLOAD_SEGMENTS = 1
+    openstack_lib.DOWNLOAD_PROGRESS_INTERVAL = 4 * 1024 * 1024
+
+    fake_glance.start()
+    data = os.urandom(IMAGE_SIZE * 1024 * 1024 + 17)
+    fake_glance.images["image"] = data
+    drop_every = int(len(data) * DROP_FRACTION)
+    output_dir = tempfile.mkdtemp()
+
+    print "%d MB image, connection dropped every %d MB" % (IMAGE_SIZE, drop_every / 1024 / 1024)
+
+    try:
+        # resume within one run
+        fake_glance.reset(ranges=True, drop_every=drop_every)
+        openstack_lib.DOWNLOAD_RETRIES = 20
+        download("retries", output_dir, data)
+
+        # give up after the first drop and resume from the progress record on the next run
+        fake_glance.reset(ranges=True, drop_every=drop_every)
+        openstack_lib.DOWNLOAD_RETRIES = 1
+        quiet(openstack_lib.download_glance_image, "image", os.path.join(output_dir, "nextrun.img"))
+        print "left by the failed run: " + ", ".join([f for f in sorted(os.listdir(output_dir)) if f.startswith("nextrun")])
+        fake_glance.state['drop_every'] = None
+        openstack_lib.DOWNLOAD_RETRIES = 20
+        download("nextrun", output_dir, data)
+
+        # glance without range support restarts at byte zero after every drop
+        fake_glance.reset(ranges=False, drop_every=drop_every)
+        openstack_lib.DOWNLOAD_RETRIES = 5
+        download("noranges", output_dir, data)
+    finally:
+        shutil.rmtree(output_dir)
@@ -0,0 +1,117 @@
+#!/usr/bin/python
+#
+# Measure the throughput of segmented image downloads against a local
+# range capable glance stand-in with a per connection rate limit
+#
+# Copyright 2014 ETH Zurich, ISGINF, Bastian Ballmann
+# Email: bastian.ballmann@inf.ethz.ch
+# Web: http://www.isg.inf.ethz.ch
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# It is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License.
+# If not, see <http://www.gnu.org/licenses/>.
+
+
+#
+# Loading modules
+#
+
+import os
+import sys
+import shutil
+import tempfile
+from time import time
+import fake_glance
+import openstack_lib
+
+
+#
+# Configuration
+#
+
+# size of the image in MB
+IMAGE_SIZE = 64
+
+# throughput of one connection in MB/s
+CONNECTION_RATE = 32
+
+# numbers of segments to compare
+SEGMENTS = (1, 2, 4, 8)
+
+
+#
+# Subroutines
+#
+def download(name, output_dir, expected):
+    """
+    Download the test image and print its throughput
+    Params: name of the run, output directory, expected image data
+    Returns: boolean
+    """
+    output_file = os.path.join(output_dir, name + ".img")
+    sys.stdout = open(os.devnull, "w")
+    start = time()
+
+    try:
+        ok = openstack_lib.download_glance_image("image", output_file)
+    finally:
+        seconds = time() - start
+        sys.stdout.close()
+        sys.stdout = sys.__stdout__
+
+    verified = ok and open(output_file, "rb").read() == expected
+    print "%-12s ok %-5s verified %-5s %3d requests %8.1f MB/s" % \
+        (name, ok, verified, fake_glance.state['requests'], len(expected) / seconds / 1e6)
+
+    if os.path.exists(output_file):
+        os.unlink(output_file)
+
+    return ok
+
+
+#
+# MAIN PART
+#
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        IMAGE_SIZE = int(sys.argv[1])
+
+    if len(sys.argv) > 2:
+        CONNECTION_RATE = int(sys.argv[2])
+
+    openstack_lib.DOWNLOAD_RETRY_WAIT = 0
+    openstack_lib.DOWNLOAD_SEGMENT_MIN_SIZE = 1024 * 1024
+
+    fake_glance.start()
+    data = os.urandom(IMAGE_SIZE * 1024 * 1024 + 17)
+    fake_glance.images["image"] = data
+    output_dir = tempfile.mkdtemp()
+
+    print "%d MB image, %d MB/s per connection" % (IMAGE_SIZE, CONNECTION_RATE)
+
+    try:
+        for segments in SEGMENTS:
+            openstack_lib.DOWNLOAD_SEGMENTS = segments
+            fake_glance.reset(ranges=True, rate=CONNECTION_RATE * 1e6, drop_every=None)
+            download("%d segments" % segments, output_dir, data)
+
+        # segments must resume their own range after a dropped connection
+        openstack_lib.DOWNLOAD_SEGMENTS = max(SEGMENTS)
+        fake_glance.reset(ranges=True, rate=None, drop_every=len(data) / max(SEGMENTS) / 2)
+        download("drops", output_dir, data)
+
+        # without range support the image is fetched over one stream
+        fake_glance.reset(ranges=False, rate=CONNECTION_RATE * 1e6, drop_every=None)
+        download("noranges", output_dir, data)
+    finally:
+        shutil.rmtree(output_dir)
@@ -0,0 +1,224 @@
+#!/usr/bin/python
+#
+# Simulate the snapshots of backup_nova with a fake nova and glance
+# and compare the total snapshot time with and without throttling
+#
+# Copyright 2014 ETH Zurich, ISGINF, Bastian Ballmann
+# Email: bastian.ballmann@inf.ethz.ch
+# Web: http://www.isg.inf.ethz.ch
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# It is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License.
+# If not, see <http://www.gnu.org/licenses/>.
+
+
+#
+# Loading modules
+#
+
+import os
+import sys
+import random
+import shutil
+import tempfile
+import threading
+from time import time, sleep
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import openstack_lib
+from openstack_lib import GlanceNotFound
+
+
+#
+# Configuration
+#
+
+VMS = 40
+HYPERVISORS = 4
+BACKENDS = 2
+
+# root disk size in GB of the flavors and how often they are picked
+FLAVORS = {'small': 10, 'medium': 40, 'large': 160}
+FLAVOR_MIX = ['small', 'small', 'small', 'medium', 'medium', 'large']
+
+# simulated seconds to snapshot one GB on an idle hypervisor
+SECONDS_PER_GB = 0.025
+
+# every snapshot beyond this number on one hypervisor slows all of them down
+HYPERVISOR_SNAPSHOT_SLOTS = 2
+HYPERVISOR_CONTENTION = 0.35
+
+SIMULATION_TICK = 0.005
+
+
+#
+# Subroutines
+#
+
+# snapshot image id -> dictionary of fake image, hypervisor and seconds left
+snapshots = {}
+snapshots_lock = threading.Lock()
+simulation_stopped = threading.Event()
+peak = {}
+
+
+class FakeObj(object):
+    def __init__(self, **fields):
+        self.__dict__.update(fields)
+
+
+class FakeServer(object):
+    def __init__(self, number, flavor, hypervisor, backend):
+        self.id = "vm%d" % number
+        self.name = "vm%d" % number
+        self.status = "ACTIVE"
+        self.flavor = {'id': flavor}
+        self.image = {}
+        setattr(self, 'OS-EXT-STS:task_state', None)
+        setattr(self, 'OS-EXT-SRV-ATTR:hypervisor_hostname', hypervisor)
+        setattr(self, 'OS-EXT-AZ:availability_zone', backend)
+
+    def create_image(self, name):
+        hypervisor = getattr(self, 'OS-EXT-SRV-ATTR:hypervisor_hostname')
+
+        snapshots_lock.acquire()
+        image_id = "snap%d" % len(snapshots)
+        snapshots[image_id] = {'image': FakeObj(id=image_id, name=name, owner="tenant", status="queued"),
+                               'hypervisor': hypervisor,
+                               'left': FLAVORS[self.flavor['id']] * SECONDS_PER_GB}
+        running = len([s for s in snapshots.values() if s['hypervisor'] == hypervisor and s['left'] > 0])
+        peak[hypervisor] = max(peak.get(hypervisor, 0), running)
+        snapshots_lock.release()
+
+        return image_id
+
+
+class FakeImages(object):
+    def get(self, image_id):
+        if image_id not in snapshots:
+            raise GlanceNotFound("Image " + image_id + " not found")
+
+        return snapshots[image_id]['image']
+
+    def list(self, filters=None, page_size=None):
+        return [s['image'] for s in snapshots.values()]
+
+    def delete(self, image_id):
+        pass
+
+
+def simulate_hypervisors():
+    """
+    Let the running snapshots of every hypervisor share its throughput
+    """
+    last = time()
+
+    while not simulation_stopped.is_set():
+        sleep(SIMULATION_TICK)
+        now = time()
+        running = {}
+
+        snapshots_lock.acquire()
+
+        for snapshot in snapshots.values():
+            if snapshot['left'] > 0:
+                running.setdefault(snapshot['hypervisor'], []).append(snapshot)
+
+        for hypervisor_snapshots in running.values():
+            count = len(hypervisor_snapshots)
+            speed = 1.0 / (1 + HYPERVISOR_CONTENTION * max(0, count - HYPERVISOR_SNAPSHOT_SLOTS)) / count
+
+            for snapshot in hypervisor_snapshots:
+                snapshot['left'] -= (now - last) * speed
+
+                if snapshot['left'] <= 0:
+                    snapshot['image'].status = "active"
+
+        snapshots_lock.release()
+        last = now
+
+
+def make_servers(seed):
+    """
+    Create the fake vms
+    Params: random seed
+    Returns: list of FakeServer objects
+    """
+    rand = random.Random(seed)
+
+    return [FakeServer(number, rand.choice(FLAVOR_MIX), "hv%d" % (number % HYPERVISORS), "az%d" % (number % BACKENDS))
+            for number in range(VMS)]
+
+
+def run(servers, limits):
+    """
+    Run backup_nova over the fake vms
+    Params: list of FakeServer objects, tupel of snapshots per hypervisor and per backend
+    Returns: tupel of seconds, number of finished snapshots, highest number of snapshots on one hypervisor
+    """
+    nova = FakeObj(servers=FakeObj(list=lambda: list(servers),
+                                   create_image=lambda srv, name: srv.create_image(name)),
+                   flavors=FakeObj(get=lambda flavor_id: FakeObj(disk=FLAVORS[flavor_id])))
+    tenant = FakeObj(id="tenant", name="tenant")
+
+    openstack_lib.get_nova_client = lambda tenant_id: nova
+    (openstack_lib.SNAPSHOT_PER_HYPERVISOR, openstack_lib.SNAPSHOT_PER_BACKEND) = limits
+    openstack_lib.BACKUP_BASE_PATH = tempfile.mkdtemp()
+    os.mkdir(openstack_lib.get_backup_base_path(tenant.id))
+
+    snapshots.clear()
+    peak.clear()
+    sys.stdout = open(os.devnull, "w")
+    start = time()
+
+    try:
+        openstack_lib.backup_nova(tenant)
+    finally:
+        seconds = time() - start
+        sys.stdout.close()
+        sys.stdout = sys.__stdout__
+        shutil.rmtree(openstack_lib.BACKUP_BASE_PATH)
+
+    return (seconds, len([s for s in snapshots.values() if s['image'].status == "active"]), max(peak.values()))
+
+
+#
+# MAIN PART
+#
+
+if __name__ == '__main__':
+    seeds = [int(seed) for seed in sys.argv[1:]] or [1, 2, 3]
+    limits = (openstack_lib.SNAPSHOT_PER_HYPERVISOR, openstack_lib.SNAPSHOT_PER_BACKEND)
+
+    fake_glance = FakeObj(images=FakeImages())
+    openstack_lib.get_glance_client = lambda: fake_glance
+    openstack_lib.download_nova_glance_image = lambda params: True
+    openstack_lib.POLL_MIN_INTERVAL = 0.02
+    openstack_lib.POLL_MAX_INTERVAL = 0.1
+
+    simulator = threading.Thread(target=simulate_hypervisors)
+    simulator.daemon = True
+    simulator.start()
+
+    print "%d vms on %d hypervisors, %d per hypervisor and %d per backend when throttled" % \
+        (VMS, HYPERVISORS, limits[0], limits[1])
+
+    try:
+        for seed in seeds:
+            servers = make_servers(seed)
+
+            for (name, run_limits) in (("all at once", (VMS, VMS)), ("throttled", limits)):
+                (seconds, finished, most) = run(servers, run_limits)
+                print "seed %-3d %-12s %6.2fs %3d snapshots, at most %2d on one hypervisor" % (seed, name, seconds, finished, most)
+    finally:
+        simulation_stopped.set()
+        simulator.join()
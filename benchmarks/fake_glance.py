@@ -0,0 +1,189 @@
+#
+# Local glance stand-in for the download benchmarks
+# It serves image data over http with optional range support,
+# per connection throughput limit and injected disconnects
+#
+# Copyright 2014 ETH Zurich, ISGINF, Bastian Ballmann
+# Email: bastian.ballmann@inf.ethz.ch
+# Web: http://www.isg.inf.ethz.ch
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# It is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License.
+# If not, see <http://www.gnu.org/licenses/>.
+
+
+#
+# Loading modules
+#
+
+import os
+import re
+import sys
+import hashlib
+import threading
+from time import sleep
+from SocketServer import ThreadingMixIn
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import openstack_lib
+from openstack_lib import GlanceNotFound
+
+
+#
+# Configuration
+#
+
+# bytes written to the socket at once
+SEND_BLOCK_SIZE = 64 * 1024
+
+
+#
+# Subroutines
+#
+
+# image data by id
+images = {}
+image_objs = {}
+
+# ranges: answer range requests with 206
+# rate: bytes per second and connection (None is unlimited)
+# drop_every: close the connection after that many bytes of a response (None never)
+# requests and sent_bytes are counted
+state = {'ranges': True, 'rate': None, 'drop_every': None, 'requests': 0, 'sent_bytes': 0}
+state_lock = threading.Lock()
+
+
+class GlanceImageHandler(BaseHTTPRequestHandler):
+    """
+    Serves GET /v2/images/<id>/file
+    """
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        match = re.match(r".*/v2/images/([^/]+)/file$", self.path)
+        data = images.get(match.group(1)) if match else None
+        count("requests", 1)
+
+        if data is None:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        start = 0
+        end = len(data) - 1
+        match = re.match(r"bytes=(\d+)-(\d*)$", self.headers.get("Range", ""))
+
+        if match and state['ranges']:
+            start = int(match.group(1))
+
+            if match.group(2):
+                end = min(int(match.group(2)), end)
+
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes %d-%d/%d" % (start, end, len(data)))
+        else:
+            self.send_response(200)
+
+        self.send_header("Accept-Ranges", state['ranges'] and "bytes" or "none")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+
+        sent = 0
+        pos = start
+
+        try:
+            while pos <= end:
+                block = data[pos:min(pos + SEND_BLOCK_SIZE, end + 1)]
+
+                if state['drop_every'] and sent + len(block) > state['drop_every']:
+                    self.wfile.write(block[:state['drop_every'] - sent])
+                    count("sent_bytes", state['drop_every'] - sent)
+                    self.close_connection = 1
+                    return
+
+                self.wfile.write(block)
+                count("sent_bytes", len(block))
+                sent += len(block)
+                pos += len(block)
+
+                if state['rate']:
+                    sleep(float(len(block)) / state['rate'])
+        except IOError:
+            self.close_connection = 1
+
+    def log_message(self, *args):
+        pass
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    # clients close answers they dont read e.g. when probing for range support
+    def handle_error(self, request, client_address):
+        pass
+
+
+class FakeImage(object):
+    def __init__(self, image_id, data):
+        self.id = image_id
+        self.size = len(data)
+        self.checksum = hashlib.md5(data).hexdigest()
+        self.status = "active"
+
+
+class FakeImages(object):
+    def get(self, image_id):
+        if image_id not in images:
+            raise GlanceNotFound("Image " + image_id + " not found")
+
+        if image_id not in image_objs or image_objs[image_id].size != len(images[image_id]):
+            image_objs[image_id] = FakeImage(image_id, images[image_id])
+
+        return image_objs[image_id]
+
+
+class FakeGlance(object):
+    images = FakeImages()
+
+
+def count(counter, value):
+    state_lock.acquire()
+    state[counter] += value
+    state_lock.release()
+
+
+def reset(**settings):
+    """
+    Reset the counters and apply new settings
+    Params: keyword arguments of state
+    """
+    state.update(requests=0, sent_bytes=0, **settings)
+
+
+def start():
+    """
+    Start the server in a background thread and make openstack_lib download from it
+    Returns: base url
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", 0), GlanceImageHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    base_url = "http://%s:%d" % server.server_address
+    openstack_lib.get_glance_client = lambda: FakeGlance()
+    openstack_lib.get_glance_image_url = lambda image_id: (base_url + "/v2/images/" + image_id + "/file", "token")
+
+    return base_url
+
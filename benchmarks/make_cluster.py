@@ -0,0 +1,113 @@
+#!/usr/bin/python
+#
+# Generate a synthetic cluster for openstack_migrator.py --simulate
+# The same arguments always give the same file
+#
+# Copyright 2014 ETH Zurich, ISGINF, Bastian Ballmann
+# Email: bastian.ballmann@inf.ethz.ch
+# Web: http://www.isg.inf.ethz.ch
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# It is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License.
+# If not, see <http://www.gnu.org/licenses/>.
+
+
+#
+# Loading modules
+#
+
+import sys
+import json
+import random
+
+
+#
+# Configuration
+#
+
+HOSTS = 10
+SERVERS = 200
+SEED = 1
+
+# ram in MB, vcpus and disk in GB of the flavors
+FLAVORS = [(2048, 1, 20), (4096, 2, 40), (8192, 4, 80), (16384, 8, 160)]
+
+# every hypervisor has the same size
+HOST_RAM = 65536
+HOST_VCPUS = 16
+HOST_DISK = 2000
+
+# the first hosts form an aggregate to drain with --aggregate
+AGGREGATE_NAME = "rack1"
+AGGREGATE_HOSTS = 3
+
+
+#
+# Subroutines
+#
+def make_cluster(hosts, servers, seed):
+    """
+    Create hypervisors with random usage and servers spread over them
+    Params: number of hosts, number of servers, random seed
+    Returns: dictionary of flavors, hypervisors, servers and aggregates
+    """
+    rand = random.Random(seed)
+    flavors = [{'id': str(number), 'ram': ram, 'vcpus': vcpus, 'disk': disk}
+               for (number, (ram, vcpus, disk)) in enumerate(FLAVORS)]
+    hypervisors = []
+    vms = []
+
+    for number in range(hosts):
+        hypervisors.append({'hypervisor_hostname': "cmp%d.example" % number,
+                            'service': {'host': "cmp%d" % number},
+                            'state': "up",
+                            'status': "enabled",
+                            'memory_mb': HOST_RAM,
+                            'memory_mb_used': rand.randint(40000, 95000),
+                            'vcpus': HOST_VCPUS,
+                            'vcpus_used': rand.randint(10, 100),
+                            'local_gb': HOST_DISK,
+                            'local_gb_used': rand.randint(200, 1500)})
+
+    for number in range(servers):
+        vms.append({'id': "vm%03d" % number,
+                    'name': "vm%03d" % number,
+                    'status': rand.choice(["ACTIVE", "ACTIVE", "SHUTOFF"]),
+                    'flavor': {'id': rand.choice(flavors)['id']},
+                    'OS-EXT-SRV-ATTR:host': "cmp%d" % (number % hosts)})
+
+    return {'flavors': flavors,
+            'hypervisors': hypervisors,
+            'servers': vms,
+            'aggregates': [{'name': AGGREGATE_NAME, 'hosts': ["cmp%d" % number for number in range(min(AGGREGATE_HOSTS, hosts))]}]}
+
+
+#
+# MAIN PART
+#
+
+if __name__ == '__main__':
+    if "--help" in sys.argv or "-h" in sys.argv:
+        print sys.argv[0] + " [hosts] [servers] [seed] > cluster.json"
+        sys.exit(1)
+
+    if len(sys.argv) > 1:
+        HOSTS = int(sys.argv[1])
+
+    if len(sys.argv) > 2:
+        SERVERS = int(sys.argv[2])
+
+    if len(sys.argv) > 3:
+        SEED = int(sys.argv[3])
+
+    json.dump(make_cluster(HOSTS, SERVERS, SEED), sys.stdout, indent=1, sort_keys=True, separators=(',', ': '))
+    print
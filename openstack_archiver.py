@@ -32,6 +32,8 @@ import atexit
 import keystoneclient.v2_0.client as keystone_client
 from openstack_lib import get_keystone_client, backup_keystone, backup_nova, backup_glance, backup_cinder
 from openstack_lib import get_backup_base_path, ensure_dir_exists, cleanup_nova_backup, cleanup_glance_backup
+from openstack_lib import gc_nova_backup, gc_glance_backup
+from openstack_lib import start_manifest, open_journal, close_journal
 from openstack_lib import BACKUP_BASE_PATH
 
 
@@ -41,9 +43,15 @@ from openstack_lib import BACKUP_BASE_PATH
 
 # Check if we got enough params
 if len(sys.argv) < 2:
-    print sys.argv[0] + " <tenant_id/_name>"
+    print sys.argv[0] + " [--gc] <tenant_id/_name>"
+    print "--gc removes all backup images and resets all vms in image uploading, also of concurrent runs"
     sys.exit(1)
 
+garbage_collect = sys.argv[1] == "--gc"
+
+if garbage_collect:
+    del sys.argv[1]
+
 # dont buffer stdout
 sys.stdout = os.fdopen(sys.stdout.fileno(), 'w', 0)
 
@@ -58,9 +66,22 @@ try:
 except (keystone_client.exceptions.NotFound, keystone_client.exceptions.NoUniqueMatch):
     tenant = keystone.tenants.get(sys.argv[1])
 
+if garbage_collect:
+    gc_nova_backup(tenant)
+    gc_glance_backup()
+    sys.exit(0)
+
 ensure_dir_exists(BACKUP_BASE_PATH)
 ensure_dir_exists(get_backup_base_path(tenant.id))
 
+# an interrupted run is resumed and keeps adding to its manifest
+if not open_journal(tenant.id):
+    start_manifest(tenant.id)
+
+# vms snapshotted by this run must not stay in image uploading
+# backup images of an interrupted run are kept to resume it
+atexit.register(lambda: cleanup_nova_backup(tenant))
+
 # Check that admin user is in the tenant we want to backup
 # otherwise add him
 if not filter(lambda x: x.username == os.environ['OS_USERNAME'], tenant.list_users()):
@@ -74,5 +95,6 @@ backup_glance(tenant)
 backup_cinder(tenant)
 
 # Clean up at the end
-atexit.register(lambda: cleanup_nova_backup(tenant))
-atexit.register(cleanup_glance_backup)
+cleanup_nova_backup(tenant)
+cleanup_glance_backup(tenant.id)
+close_journal(tenant.id)
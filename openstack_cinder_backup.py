@@ -27,57 +27,124 @@
 
 import os
 import sys
-import keystoneclient.v2_0.client as keystone_client
-from cinderclient.exceptions import ClientException, BadRequest, Unauthorized
+from time import time
+from collections import deque
 from openstack_lib import get_keystone_client, get_cinder_client, get_backup_base_path, ensure_dir_exists
-from openstack_lib import backup_cinder_volume, wait_for_glance_upload_to_finish, attach_volume
-#from openstack_lib import nova_glance_check_upload, cinder_glance_check_upload
+from openstack_lib import backup_cinder_volume, attach_volume, run_parallel, wait_for_action_to_finish, start_manifest
+from openstack_lib import cinder_glance_check_upload, cinder_glance_batch_check_upload
+from openstack_lib import GLANCE_UPLOAD_TIMEOUT, ACTION_DONE
 import openstack_lib
 
 
+#
+# Configuration
+#
+
+# volume uploads running at the same time over all tenants
+MAX_UPLOADS = 8
+
+
 #
 # Subroutines
 #
-def backup_tenant(tenant):
-    cinder = get_cinder_client(tenant)
-    volumes = cinder.volumes.list()
+def prepare_tenant(tenant):
+    """
+    Find the volumes of a tenant to backup, make sure the admin user is in the tenant
+    and start a new manifest for the tenant backup
+    Params: tenant object
+    Returns: list of volume objects
+    """
+    cinder = get_cinder_client(tenant.name)
+    volumes = [volume for volume in cinder.volumes.list() if volume.display_name.startswith("backupme")]
 
     if len(volumes) == 0:
-       return (tenant.id, None)
+        return []
 
     # Check that admin user is in the tenant we want to backup
     # otherwise add him
-    if not filter(lambda x: x.username == os.environ['OS_USERNAME'], tenant.list_users()):
-        keystone = get_keystone_client()
-        tenant.add_user(keystone.users.find(name = os.environ['OS_USERNAME']),
-                        keystone.roles.find(name = 'admin'))
+    # the tenant object belongs to the client of the main thread
+    # therefore the calls go through the client of this worker
+    keystone = get_keystone_client()
 
-    backups = {}
-    attached = {}
+    if not filter(lambda x: x.username == os.environ['OS_USERNAME'], keystone.tenants.list_users(tenant)):
+        keystone.tenants.add_user(tenant,
+                                  keystone.users.find(name = os.environ['OS_USERNAME']),
+                                  keystone.roles.find(name = 'admin'))
 
     ensure_dir_exists(get_backup_base_path(tenant.id))
     ensure_dir_exists(os.path.join(get_backup_base_path(tenant.id), "cinder"))
+    start_manifest(tenant.id)
+
+    return volumes
+
 
-    for volume in volumes:
-        if volume.display_name.startswith("backupme"):
-            (backup_id, backup_name) = backup_cinder_volume(tenant, volume)
+def start_uploads(queues, running, stats):
+    """
+    Start volume uploads until MAX_UPLOADS are running
+    Volumes are taken round robin from the queues of all tenants
+    so that every tenant makes progress
+    Params: deque of tupels of tenant and deque of volumes, dictionary of running uploads, dictionary of tenant stats
+    Returns: dictionary of started uploads as items for wait_for_action_to_finish
+    """
+    started = {}
+
+    while queues and len(running) + len(started) < MAX_UPLOADS:
+        picked = []
+
+        while queues and len(running) + len(started) + len(picked) < MAX_UPLOADS:
+            (tenant, volumes) = queues.popleft()
+            picked.append((tenant, volumes.popleft()))
+
+            if volumes:
+                queues.append((tenant, volumes))
+
+        results = run_parallel(lambda upload: backup_cinder_volume((upload[0].id, upload[0].name, upload[1].id)),
+                               picked,
+                               'cinder')
+
+        for ((tenant, volume), (backup_id, backup_name, backup_size)) in zip(picked, results):
+            stats[tenant.id].setdefault('start', time())
 
             if backup_id:
-                backups[backup_id] = (tenant.id, backup_name)
+                started[backup_id] = (tenant.id, backup_name, backup_size)
+                running[backup_id] = (tenant, volume)
+            else:
+                stats[tenant.id]['failed'] += 1
+                finish_volume(tenant, stats)
+
+    return started
+
 
-                if len(volume.attachments) > 0:
-                    attached[backup_id] = {}
-                    attached[backup_id]['vm'] = volume.attachments[0]['server_id']
-                    attached[backup_id]['volume'] = volume.id
-                    attached[backup_id]['device'] = volume.attachments[0]['device']
+def finish_volume(tenant, stats):
+    """
+    Count a processed volume of a tenant and reattach the volumes of the tenant
+    after its last volume
+    Params: tenant object, dictionary of tenant stats
+    """
+    tenant_stats = stats[tenant.id]
+    tenant_stats['left'] -= 1
 
-    wait_for_glance_upload_to_finish(backups, tenant, output_dir="")
+    if tenant_stats['left'] == 0:
+        for volume in tenant_stats['attached']:
+            attach_volume(tenant, volume.id, volume.attachments[0]['server_id'], volume.attachments[0]['device'])
 
-    # Reattach volumes
-    for info in attached.values():
-        attach_volume(tenant, info['volume'], info['vm'], info['device'])
+        tenant_stats['end'] = time()
 
-    return tenant.id, True
+
+def print_summary(tenants, stats):
+    """
+    Print volumes and time of every tenant, slowest first
+    Params: list of tenant objects, dictionary of tenant stats
+    """
+    print "\nTenant summary (slowest first)"
+
+    for tenant in sorted(tenants, key=lambda x: stats[x.id].get('end', 0) - stats[x.id].get('start', 0), reverse=True):
+        tenant_stats = stats[tenant.id]
+
+        if tenant_stats['volumes']:
+            print tenant.name + ": " + str(tenant_stats['volumes']) + " volumes, " + \
+                  str(tenant_stats['failed']) + " failed, " + \
+                  str(int(tenant_stats.get('end', time()) - tenant_stats.get('start', time()))) + " seconds"
 
 
 #
@@ -92,5 +159,39 @@ keystone = get_keystone_client()
 
 openstack_lib.BACKUP_BASE_PATH = "/var/cinder_backup"
 
-for tenant in keystone.tenants.list():
-    backup_tenant(tenant)
+start = time()
+tenants = keystone.tenants.list()
+queues = deque()
+running = {}
+stats = {}
+
+for (tenant, volumes) in zip(tenants, run_parallel(prepare_tenant, tenants, 'cinder')):
+    stats[tenant.id] = {'volumes': len(volumes),
+                        'left': len(volumes),
+                        'failed': 0,
+                        'attached': [volume for volume in volumes if len(volume.attachments) > 0]}
+
+    if volumes:
+        queues.append((tenant, deque(volumes)))
+
+
+def upload_finished(backup_id, outcome):
+    (tenant, volume) = running.pop(backup_id)
+
+    if outcome != ACTION_DONE:
+        stats[tenant.id]['failed'] += 1
+
+    finish_volume(tenant, stats)
+
+    return start_uploads(queues, running, stats)
+
+
+# all tenants share one polling loop, a finished upload starts the next one
+wait_for_action_to_finish(start_uploads(queues, running, stats),
+                          GLANCE_UPLOAD_TIMEOUT,
+                          cinder_glance_check_upload,
+                          cinder_glance_batch_check_upload,
+                          upload_finished)
+
+print_summary(tenants, stats)
+print "Backup of all tenants took " + str(int(time() - start)) + " seconds"
@@ -25,12 +25,26 @@
 
 import os
 import json
+import atexit
+import zlib
+import gzip
+import errno
+import hashlib
+import thread
+import httplib
+import urlparse
+import threading
 from glob import glob
-from time import sleep
-from pickle import PicklingError
-from copy import deepcopy
-from multiprocessing import Pool, TimeoutError
+from time import sleep, time
+from heapq import heappush, heappop
+from Queue import Queue, Empty
+from collections import deque
+from random import uniform
+from calendar import timegm
+from multiprocessing.pool import ThreadPool
 from novaclient.exceptions import Conflict as NovaConflict
+from novaclient.exceptions import ClientException as NovaClientException
+from novaclient.exceptions import NotFound as NovaNotFound
 import keystoneclient.v2_0.client as keystone_client
 from keystoneclient.openstack.common.apiclient.exceptions import Conflict as KeystoneConflict
 from keystoneclient.openstack.common.apiclient.exceptions import NotFound as KeystoneNotFound
@@ -42,9 +56,20 @@ from cinderclient.exceptions import ClientException as CinderClientException
 from cinderclient.exceptions import BadRequest as CinderBadRequest
 from glanceclient.exc import HTTPNotFound as GlanceNotFound
 from glanceclient.exc import HTTPInternalServerError as GlanceInternalServerError
+from glanceclient.exc import HTTPException as GlanceHTTPException
 from neutronclient.neutron import client as neutron_client
 from neutronclient.common.exceptions import NeutronClientException
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
 
 #
 # Configuration
@@ -56,7 +81,54 @@ GLANCE_DOWNLOAD_TIMEOUT = 600
 CINDER_BACKUP_TIMEOUT = 10
 CINDER_BACKUP_TRIES = 600
 BACKUP_BASE_PATH = '/var/openstack_backup/'
+BACKUP_PREVIOUS_PATH = None
+INCREMENTAL_BACKUP = True
 INITIAL_PASSWORD = "youknowgodisnotagoodpassword"
+CLIENT_CACHE_TTL = 3000
+CLIENT_TOKEN_STALE = 300
+GLANCE_PAGE_SIZE = 1000
+GLANCE_INDEX_TTL = 60
+GLANCE_INDEX_FULL_TTL = 600
+POLL_MIN_INTERVAL = 3
+POLL_MAX_INTERVAL = 60
+POLL_BACKOFF = 1.5
+POLL_JITTER = 0.2
+POLL_BYTES_PER_SECOND = 20 * 1024 * 1024
+ACTION_DONE = "done"
+ACTION_FAILED = "failed"
+ACTION_TIMEOUT = "timeout"
+SERVICE_CONCURRENCY = {'keystone': 8, 'nova': 8, 'glance': 16, 'glance_data': 32, 'glance_upload': 8, 'keystone_roles': 8, 'cinder': 8, 'compression': 4}
+PARALLEL_TIMEOUT = 7 * 24 * 3600
+EXECUTOR_PRIME_CLIENTS = True
+SNAPSHOT_PER_HYPERVISOR = 2
+SNAPSHOT_PER_BACKEND = 8
+DOWNLOAD_RETRIES = 5
+DOWNLOAD_RETRY_WAIT = 10
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+DOWNLOAD_SOCKET_TIMEOUT = 120
+DOWNLOAD_PROGRESS_INTERVAL = 64 * 1024 * 1024
+DOWNLOAD_SEGMENTS = 4
+DOWNLOAD_SEGMENT_MIN_SIZE = 256 * 1024 * 1024
+DOWNLOAD_CHECKSUM_RETRIES = 2
+DOWNLOAD_SPARSE = True
+SPARSE_BLOCK_SIZE = 64 * 1024
+BACKUP_COMPRESSION = None
+COMPRESSION_BLOCK_SIZE = 4 * 1024 * 1024
+COMPRESSION_SUFFIXES = {'zstd': '.zst', 'lz4': '.lz4', 'gzip': '.gz'}
+BACKUP_CHUNK_STORE = False
+CHUNK_RECIPE_SUFFIX = ".recipe"
+CHUNK_MIN_SIZE = 256 * 1024
+CHUNK_MAX_SIZE = 4 * 1024 * 1024
+CHUNK_ALIGN = 512
+CHUNK_WINDOW = 64
+CHUNK_MASK = 0x7ff
+MANIFEST_FILE = "manifest.jsonl"
+JOURNAL_FILE = "journal.jsonl"
+TRANSFER_BUFFERS = 64
+TRANSFER_BUFFER_SIZE = 1024 * 1024
+TRANSFER_QUEUE_SIZE = 4
+TRANSFER_WRITER_MEMORY = 16 * 1024 * 1024
+TRANSFER_WAIT_INTERVAL = 1
 
 
 #
@@ -71,6 +143,24 @@ def get_backup_base_path(tenant_id):
     return os.path.join(BACKUP_BASE_PATH, tenant_id)
 
 
+def get_openstack_obj_data(obj):
+    """
+    Strip the circular references of an openstack object
+    Params: object
+    Returns: dictionary of public attributes (strings, lists and dicts are returned as is)
+    """
+    if isinstance(obj, str) or isinstance(obj, list) or isinstance(obj, dict):
+        return obj
+
+    data = {}
+
+    for (k, v) in obj.__dict__.items():
+        if not k.startswith("_") and k != "manager":
+            data[k] = v
+
+    return data
+
+
 def dump_openstack_obj(obj, out_file=None):
     """
     Unfortunately due to circular references openstack objects cannot
@@ -79,14 +169,7 @@ def dump_openstack_obj(obj, out_file=None):
     If no output filename is given the json is returned as string
     Parameter: object to dump, output filename (optional)
     """
-    if isinstance(obj, str) or isinstance(obj, list) or isinstance(obj, dict):
-        dump = obj
-    else:
-        dump = {}
-
-        for (k, v) in obj.__dict__.items():
-            if not k.startswith("_") and k != "manager":
-                dump[k] = v
+    dump = get_openstack_obj_data(obj)
 
     if out_file:
         fh = open(out_file, "w")
@@ -122,7 +205,7 @@ def load_openstack_obj(json_file):
         data = json.loads(fh.read())
         fh.close()
     except IOError,e:
-        print "Cannot read file " + tenant_file + " " + str(e)
+        print "Cannot read file " + json_file + " " + str(e)
 
     return data
 
@@ -136,429 +219,3009 @@ def ensure_dir_exists(dir):
         os.mkdir(dir)
 
 
-def wait_for_action_to_finish(all_items, wait_timeout, check_func):
+def get_item_deadline(item, wait_timeout, start):
+    """
+    Calculate the deadline of an item
+    Bigger objects get more time depending on POLL_BYTES_PER_SECOND
+    Params: item tupel (optional third value is the size in bytes), timeout in seconds/3, start time
+    Returns: unix timestamp
+    """
+    deadline = start + wait_timeout * POLL_MIN_INTERVAL
+
+    if len(item) > 2 and item[2]:
+        deadline += float(item[2]) / POLL_BYTES_PER_SECOND
+
+    return deadline
+
+
+def check_items(items, check_func, batch_func=None):
+    """
+    Check the status of the given items either in one batch or one by one
+    Params: dictionary of items, function to check one item, function to check all items (optional)
+    Returns: dictionary of item id and True, False or None
+    """
+    results = {}
+
+    if batch_func:
+        try:
+            return dict(batch_func(items))
+        except (GlanceNotFound, GlanceInternalServerError), e:
+            print "Batch status check failed. Checking items one by one.\n" + str(e) + "\n"
+
+    for item in items.items():
+        try:
+            (item_id, success) = check_func(item)
+            results[item_id] = success
+        except (GlanceNotFound, GlanceInternalServerError), e:
+            print "\nFailed to get status of " + str(item[0]) + "\n" + str(e) + "\n"
+            results[item[0]] = False
+
+    return results
+
+
+def wait_for_action_to_finish(all_items, wait_timeout, check_func, batch_func=None, finished_func=None):
     """
     Wait until an action on all items has finished (or failed)
-    Param: dictionary of all_items with image id as key and value of tenant id and display name as tupel
+    Every item is polled on its own schedule with exponential backoff and jitter
+    starting at POLL_MIN_INTERVAL up to POLL_MAX_INTERVAL seconds and gives up
+    on its deadline (see get_item_deadline)
+    Param: dictionary of all_items with image id as key and value of tenant id, display name and optional size in bytes as tupel
     Param: timeout in seconds/3
     Param: function to check if action has finished
+    Param: function to check all pending items at once (optional)
+    Param: function called with item id and outcome of every finished item,
+           it can return a dictionary of new items to wait for (optional)
+    Returns: dictionary of item id and ACTION_DONE, ACTION_FAILED or ACTION_TIMEOUT
     """
-    pool = Pool()
-    my_items = deepcopy(all_items)
-    my_wait_timeout = deepcopy(wait_timeout)
+    outcomes = {}
+    intervals = {}
+    deadlines = {}
+    schedule = []
+    all_items = dict(all_items)
+
+    def add_items(items):
+        start = time()
+
+        for (item_id, item) in items.items():
+            all_items[item_id] = item
+            intervals[item_id] = POLL_MIN_INTERVAL
+            deadlines[item_id] = get_item_deadline(item, wait_timeout, start)
+            heappush(schedule, (start, item_id))
+
+    add_items(all_items)
+
+    while schedule:
+        now = time()
+
+        if schedule[0][0] > now:
+            sleep(schedule[0][0] - now)
+            continue
+
+        due = {}
+
+        while schedule and schedule[0][0] <= now:
+            item_id = heappop(schedule)[1]
+            due[item_id] = all_items[item_id]
+
+        results = check_items(due, check_func, batch_func)
+        now = time()
+
+        for item_id in due.keys():
+            success = results.get(item_id)
+
+            if success:
+                outcomes[item_id] = ACTION_DONE
+            elif success == False:
+                outcomes[item_id] = ACTION_FAILED
+            elif now >= deadlines[item_id]:
+                print "Timeout waiting for " + str(item_id)
+                outcomes[item_id] = ACTION_TIMEOUT
+            else:
+                intervals[item_id] = min(intervals[item_id] * POLL_BACKOFF, POLL_MAX_INTERVAL)
+                next_check = now + intervals[item_id] * uniform(1 - POLL_JITTER, 1 + POLL_JITTER)
+                heappush(schedule, (min(next_check, deadlines[item_id]), item_id))
+                continue
+
+            if finished_func:
+                add_items(finished_func(item_id, outcomes[item_id]) or {})
+
+    return outcomes
+
+
+def get_items_with_outcome(all_items, outcomes, outcome=None):
+    """
+    Filter items by the outcome of wait_for_action_to_finish
+    Print all items that did not finish
+    Params: dictionary of items, dictionary of outcomes, wanted outcome (default ACTION_DONE)
+    Returns: dictionary of items
+    """
+    if not outcome:
+        outcome = ACTION_DONE
+
+    items = {}
+
+    for (item_id, item) in all_items.items():
+        if outcomes.get(item_id) == outcome:
+            items[item_id] = item
+        elif outcome == ACTION_DONE:
+            print "ERROR " + str(item[1]) + " (" + str(item_id) + ") " + str(outcomes.get(item_id, ACTION_FAILED))
+
+    return items
+
+
+def batch_check_status(all_items, list_func, status_func, check_func):
+    """
+    Resolve the status of all pending items with one list call per group
+    Items are grouped by the first value of their tupel (tenant id or name)
+    Items missing in the listing are checked one by one with check_func
+    Param: dictionary of pending items like in wait_for_action_to_finish
+    Param: function that gets the group and returns a list of objects
+    Param: function that gets item id, item tupel and object and returns True, False or None
+    Param: function to check a single item
+    Returns: list of tupels of item id and success
+    """
+    results = []
+    groups = {}
+
+    for (item_id, item) in all_items.items():
+        groups.setdefault(item[0], {})[item_id] = item
+
+    for (group, items) in groups.items():
+        found = {}
 
-    while 1:
         try:
-            results = [check_func(x) for x in my_items.items()]
-
-            for (item_id, success) in results:
-                if success:
-                    del my_items[item_id]
-
-                # Got exception
-                elif success == False:
-                    del my_items[item_id]
-        except (GlanceNotFound, GlanceInternalServerError):
-            if my_items.get(item_id):
-                del my_items[item_id]
-        except TimeoutError:
-            pass
-        except KeyboardInterrupt:
-            pool.terminate()
+            for obj in list_func(group):
+                if obj.id in items:
+                    found[obj.id] = obj
+        except (NovaClientException, CinderClientException, GlanceHTTPException), e:
+            print "Failed to list status of " + str(len(items)) + " items\n" + str(e) + "\n"
 
-        if len(my_items) == 0 or my_wait_timeout == 0:
-            break
-        else:
-            my_wait_timeout -= 1
-            sleep(3)
+        for (item_id, item) in items.items():
+            if found.get(item_id):
+                results.append((item_id, status_func(item_id, item, found[item_id])))
+            else:
+                results.append(check_func((item_id, item)))
+
+    return results
 
 
 #
-# KEYSTONE
+# CLIENT CACHE
 #
-def get_keystone_client():
+
+# authenticated clients keyed by (service, tenant) with their expiry time
+# forked worker processes start with an empty cache to not share sockets
+# the http connections of service clients are not thread safe therefore
+# every thread gets its own clients, only the keystone token is shared
+# (see get_keystone_auth), keystone api calls use per thread clients too
+_client_cache = {}
+_client_cache_pid = None
+_client_cache_lock = threading.Lock()
+SHARED_CLIENT_SERVICES = ('keystone',)
+
+
+def get_client_cache_key(service, key):
     """
-    Returns a keystone client object
+    Return the key of a client in the client cache
+    Params: service name, cache key
+    Returns: tupel
     """
-    return keystone_client.Client(auth_url=os.environ["OS_AUTH_URL"],
-                                  username=os.environ["OS_USERNAME"],
-                                  password=os.environ["OS_PASSWORD"],
-                                  tenant_name=os.environ["OS_TENANT_NAME"])
+    if service in SHARED_CLIENT_SERVICES:
+        return (service, key, None)
 
+    return (service, key, thread.get_ident())
 
-def backup_keystone_user(tenant, user):
+
+def get_cached_client(service, key):
     """
-    Backup user meta data into a json file
-    Params: tenant object, user object
+    Return a cached client if it exists and its token is not about to expire
+    Params: service name, cache key (e.g. tenant id)
+    Returns: client object or None
     """
-    print "Backing up metadata of user " + user.name
+    global _client_cache_pid
 
-    dump_openstack_obj(user, os.path.join(get_backup_base_path(tenant.id),
-                                          "keystone",
-                                          "user_" + user.name + ".json"))
+    _client_cache_lock.acquire()
 
-    for role in user.list_roles(tenant.id):
-        print "Storing role " + role.name + " for user " + user.name
-        dump_openstack_obj(role, os.path.join(get_backup_base_path(tenant.id),
-                                              "keystone",
-                                              "role_" + user.name + "_" + role.name + ".json"))
+    try:
+        if _client_cache_pid != os.getpid():
+            _client_cache.clear()
+            _client_cache_pid = os.getpid()
 
+        cache_key = get_client_cache_key(service, key)
+        entry = _client_cache.get(cache_key)
 
-def restore_keystone_user(params):
+        if entry and entry[1] - CLIENT_TOKEN_STALE > time():
+            return entry[0]
+        elif entry:
+            del _client_cache[cache_key]
+    finally:
+        _client_cache_lock.release()
+
+    return None
+
+
+def set_cached_client(service, key, client, expires=None):
     """
-    Restore a keystone user and it's roles
-    Params: tupel of tenant_id, absolute name to user json file, absolute name to backup path
+    Put a client into the cache
+    Params: service name, cache key, client object, expiry as unix timestamp (optional)
+    Returns: client object
     """
-    tenant_id = params[0]
-    user_data = load_openstack_obj(params[1])
-    backup_path = params[2]
-    user = None
+    if not expires:
+        expires = time() + CLIENT_CACHE_TTL
 
-    if user_data:
-        keystone = get_keystone_client()
+    _client_cache_lock.acquire()
+    _client_cache[get_client_cache_key(service, key)] = (client, expires)
+    _client_cache_lock.release()
 
-        try:
-            user = keystone.users.create(user_data['username'],
-                                  INITIAL_PASSWORD,
-                                  user_data['email'],
-                                  tenant_id,
-                                  user_data['enabled'])
-            print "Restored user " + user_data['username']
-        except KeystoneConflict, e:
-            print "User " + user_data['username'] + " already exists"
-            user = keystone.users.find(name=user_data['username'])
+    return client
 
-        for role_file in glob(os.path.join(backup_path, 'role_*.json')):
-            try:
-                role_data = load_openstack_obj(role_file)
-                role = keystone.roles.find(name=role_data['name'])
-                keystone.roles.add_user_role(user, role, tenant_id)
-                print "Added user " + user.name + " to tenant with role " + role.name
-            except KeystoneConflict, e:
-                pass
-            except KeystoneNotFound, e:
-                print "Role " + role_data['name'] + " cannot be found " + str(e)
 
+def flush_client_cache(service=None):
+    """
+    Remove all cached clients or only those of one service
+    Params: service name (optional)
+    """
+    _client_cache_lock.acquire()
 
-def backup_keystone(tenant):
+    for cache_key in _client_cache.keys():
+        if not service or cache_key[0] == service:
+            del _client_cache[cache_key]
+
+    _client_cache_lock.release()
+
+
+def get_token_expiry(keystone):
     """
-    Backup all keystone data
-    Params: tenant object
+    Return the expiry time of the token of a keystone client
+    Falls back to CLIENT_CACHE_TTL if the client doesnt tell
+    Params: keystone client object
+    Returns: unix timestamp
     """
-    backup_path = os.path.join(get_backup_base_path(tenant.id), "keystone")
-    ensure_dir_exists(backup_path)
+    expires = getattr(getattr(keystone, 'auth_ref', None), 'expires', None)
 
-    print "Backing up metadata of tenant " + tenant.name
-    dump_openstack_obj(tenant, os.path.join(backup_path, "tenant.json"))
-    [backup_keystone_user(tenant, user) for user in tenant.list_users()]
+    if expires:
+        return timegm(expires.utctimetuple())
 
+    return time() + CLIENT_CACHE_TTL
 
-def restore_keystone_tenant(tenant_data):
+
+#
+# CONCURRENCY
+#
+
+# one thread pool per service is shared by all parallel runs of the process
+# its size SERVICE_CONCURRENCY[service] limits the concurrent requests to the service
+# the pools are created on first use and shut down at exit
+_executors = {}
+_executors_pid = None
+_executors_lock = threading.Lock()
+_executor_worker = threading.local()
+
+
+def init_executor_worker(service):
     """
-    Restoring a keystone tenant
-    Params: dictionary of tenant data
-    Returns: tenant object
+    Initialize a worker thread of a service executor
+    The clients of the thread get authenticated before the first task
+    if EXECUTOR_PRIME_CLIENTS is set
+    Params: service name
     """
-    keystone = get_keystone_client()
-    tenant = None
+    _executor_worker.service = service
+
+    if not EXECUTOR_PRIME_CLIENTS:
+        return
 
     try:
-        tenant = keystone.tenants.create(tenant_data['name'],
-                                         tenant_data['description'],
-                                         tenant_data['enabled'])
-        print "Restored tenant " + tenant_data['name']
-    except KeystoneConflict, e:
-        print "Tenant " + tenant_data['name'] + " already exists"
-        tenant = keystone.tenants.find(name=tenant_data['name'])
+        if service.startswith('glance'):
+            get_glance_client()
+        elif service.split("_")[0] in ('keystone', 'nova', 'cinder'):
+            get_keystone_client()
+    except Exception, e:
+        print "Cannot prepare clients of " + service + " worker: " + str(e)
 
-    return tenant
 
+def get_executor(service):
+    """
+    Return the thread pool of a service
+    Forked processes get new pools because threads do not survive a fork
+    Params: service name
+    Returns: ThreadPool object
+    """
+    global _executors_pid
 
-def restore_keystone(tenant_id):
+    _executors_lock.acquire()
+
+    try:
+        if _executors_pid != os.getpid():
+            _executors.clear()
+            _executors_pid = os.getpid()
+
+        if service not in _executors:
+            _executors[service] = ThreadPool(SERVICE_CONCURRENCY.get(service, 4),
+                                             init_executor_worker,
+                                             (service,))
+
+        return _executors[service]
+    finally:
+        _executors_lock.release()
+
+
+def shutdown_executors(wait=True):
     """
-    Restore all keystone stuff
-    Params: tenant_id
+    Shut down the thread pools of all services
+    Params: wait for running tasks (default) or terminate them
     """
-    backup_path = os.path.join(get_backup_base_path(tenant_id), "keystone")
-    tenant_file = os.path.join(backup_path, "tenant.json")
-    tenant_data = None
-    tenant = None
+    _executors_lock.acquire()
 
-    if os.path.exists(backup_path):
-        tenant_data = load_openstack_obj(tenant_file)
+    try:
+        if _executors_pid != os.getpid():
+            return
 
-        if tenant_data:
-            tenant = restore_keystone_tenant(tenant_data)
+        for pool in _executors.values():
+            if wait:
+                pool.close()
+            else:
+                pool.terminate()
 
-            map(restore_keystone_user,
-                [(tenant.id, user_file, backup_path) for user_file in glob(os.path.join(backup_path, 'user_*.json'))])
-    else:
-        print "ERROR " + backup_path + " does not exist!"
+            pool.join()
+
+        _executors.clear()
+    finally:
+        _executors_lock.release()
+
+
+atexit.register(shutdown_executors)
+
+
+def in_executor(service):
+    """
+    Check if the current thread is a worker of the executor of a service
+    Params: service name
+    Returns: boolean
+    """
+    return getattr(_executor_worker, 'service', None) == service
+
+
+def run_parallel(func, params_list, service):
+    """
+    Run func for all params in the executor of the service
+    At most SERVICE_CONCURRENCY[service] calls run at the same time.
+    Called from a worker of the same executor func runs in the calling
+    thread, waiting for the busy pool could deadlock.
+    Params: function, list of parameters, service name
+    Returns: list of results in the order of params_list
+    """
+    params_list = list(params_list)
+
+    if not params_list:
+        return []
+    elif in_executor(service) or len(params_list) == 1:
+        return map(func, params_list)
+
+    try:
+        # get() with timeout to be interruptible by ctrl-c
+        return get_executor(service).map_async(func, params_list, 1).get(PARALLEL_TIMEOUT)
+    except KeyboardInterrupt:
+        shutdown_executors(False)
+        raise
 
-    return tenant
+
+def get_task_priorities(tasks):
+    """
+    Return the length of the longest chain of tasks waiting for each task
+    Tasks on the critical path get the highest priority
+    Params: dictionary of tasks (see run_task_graph)
+    Returns: dictionary of task id and chain length
+    """
+    dependents = {}
+    priorities = {}
+
+    for (task_id, task) in tasks.items():
+        for dep_id in task[2]:
+            dependents.setdefault(dep_id, []).append(task_id)
+
+    def priority(task_id):
+        if task_id not in priorities:
+            priorities[task_id] = 1 + max([priority(dep_id) for dep_id in dependents.get(task_id, [])] or [0])
+
+        return priorities[task_id]
+
+    for task_id in tasks:
+        priority(task_id)
+
+    return priorities
+
+
+def run_task_graph(tasks):
+    """
+    Run tasks as soon as all tasks they depend on have finished
+    At most SERVICE_CONCURRENCY[service] tasks of a service run at the same time,
+    ready tasks with the longest chain of tasks waiting for them start first.
+    Tasks depending on a failed task are skipped.
+    Params: dictionary of task id and tupel of service, function, list of task ids it depends on,
+            the function gets called with the dictionary of results of the finished tasks
+    Returns: dictionary of task id and result (failed and skipped tasks are missing)
+    """
+    results = {}
+    failed = set()
+    missing = {}
+    dependents = {}
+    running = {}
+    ready = []
+    finished = Queue()
+    priorities = get_task_priorities(tasks)
+
+    for (task_id, task) in tasks.items():
+        missing[task_id] = set(dep_id for dep_id in task[2] if dep_id in tasks)
+
+        for dep_id in missing[task_id]:
+            dependents.setdefault(dep_id, []).append(task_id)
+
+        if not missing[task_id]:
+            heappush(ready, (-priorities[task_id], task_id))
+
+    def run_task(task_id):
+        (service, func, depends) = tasks[task_id]
+
+        try:
+            finished.put((task_id, True, func(results)))
+        except Exception, e:
+            print "ERROR task " + task_id + " failed: " + str(e)
+            finished.put((task_id, False, None))
+
+    try:
+        while ready or running:
+            postponed = []
+
+            while ready:
+                (priority, task_id) = heappop(ready)
+                service = tasks[task_id][0]
+
+                if running.get(service, 0) < SERVICE_CONCURRENCY.get(service, 4):
+                    running[service] = running.get(service, 0) + 1
+                    get_executor(service).apply_async(run_task, (task_id,))
+                else:
+                    postponed.append((priority, task_id))
+
+            for item in postponed:
+                heappush(ready, item)
+
+            if not sum(running.values()):
+                break
+
+            # get() with timeout to be interruptible by ctrl-c
+            (task_id, ok, result) = finished.get(True, PARALLEL_TIMEOUT)
+            running[tasks[task_id][0]] -= 1
+            skip = [] if ok else [task_id]
+
+            if ok:
+                results[task_id] = result
+
+            for dep_id in dependents.get(task_id, []):
+                missing[dep_id].discard(task_id)
+
+                if not ok:
+                    continue
+                elif not missing[dep_id] and dep_id not in failed:
+                    heappush(ready, (-priorities[dep_id], dep_id))
+
+            # skip everything that waits for a failed task
+            while skip:
+                failed_id = skip.pop()
+                failed.add(failed_id)
+
+                for dep_id in dependents.get(failed_id, []):
+                    if dep_id not in failed:
+                        print "Skipping " + dep_id + " because " + failed_id + " failed"
+                        skip.append(dep_id)
+    except KeyboardInterrupt:
+        shutdown_executors(False)
+        raise
+
+    return results
 
 
 #
-# NOVA
+# MANIFEST
 #
-def get_nova_client(tenant_id):
+
+# every archive run indexes all objects of a tenant in one json lines file
+# lines are only appended, a later line of an object updates the former one
+_manifest_lock = threading.Lock()
+_manifest_cache = {}
+
+
+def append_json_line(file_name, record, sync=False):
     """
-    Instantiate and return a nova client
-    Params: tenant id
+    Append a record as json line to a file
+    One write per line on a file opened for appending cannot interleave
+    with the lines of other threads
+    Params: file name, dictionary, sync file to disk (optional)
     """
-    keystone = get_keystone_client()
-    tenant = keystone.tenants.get(tenant_id)
-    return nova_client.Client(username=os.environ["OS_USERNAME"],
-                              api_key=os.environ["OS_PASSWORD"],
-                              auth_url=os.environ["OS_AUTH_URL"],
-                              project_id=tenant.name)
+    fd = os.open(file_name, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
 
+    try:
+        os.write(fd, json.dumps(record, default=str) + "\n")
 
-def backup_nova_vm(tenant, srv):
+        if sync:
+            os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def get_manifest_file(tenant_id):
     """
-    Save vm meta data as json file and make a snapshot of the given vm
-    Params: tenant object, nova server object
+    Return the name of the manifest file of a tenant backup
+    Params: tenant id
+    Returns: file name
     """
-    bad_status = ['Error', 'image_uploading']
-    print "Backing up metadata of vm " + srv.name
-    dump_openstack_obj(srv, os.path.join(get_backup_base_path(tenant.id), "nova", "vm_" + srv.name + ".json"))
+    return os.path.join(get_backup_base_path(tenant_id), MANIFEST_FILE)
 
-    # reset vm if it's in a bad state for image uploading
-    if srv.status in bad_status or getattr(srv, 'OS-EXT-STS:task_state') in bad_status:
-        print "Vm " + srv.name + " in bad state " + srv.status + " (" + getattr(srv, 'OS-EXT-STS:task_state') + "). Resetting."
-        srv.reset_state('active')
-        sleep(1)
 
-    print "Creating backup image of vm " + srv.name
+def start_manifest(tenant_id):
+    """
+    Start a new manifest for an archive run of a tenant
+    Params: tenant id
+    """
+    _manifest_lock.acquire()
 
     try:
-        backup_id = srv.create_image(GLANCE_BACKUP_PREFIX + "_" + tenant.name + "_" + srv.name)
-        return backup_id
-    except NovaConflict, e:
-        print "\nERROR creating snapshot of vm " + srv.name + "\n" + str(e) + "\n"
-        return None
+        open(get_manifest_file(tenant_id), "w").close()
+        _manifest_cache.pop(tenant_id, None)
+    finally:
+        _manifest_lock.release()
 
 
-def backup_nova(tenant):
+def add_manifest_entry(tenant_id, obj_type, obj_id, **fields):
     """
-    Backup all nova data
-    Params: tenant object
+    Append an object to the manifest of a tenant backup
+    Known fields are name, meta (json file), payload (image file), size,
+    digest, depends (list of "type:id" needed to restore the object),
+    attached_vms (vm ids of a volume), base_image (image id a vm was booted from)
+    and data (object dictionary)
+    File names are stored relative to the backup directory of the tenant
+    Params: tenant id, object type, object id, fields of the object
     """
-    backups = {}
-    nova = get_nova_client(tenant.id)
-    glance = get_glance_client()
-    output_dir = os.path.join(get_backup_base_path(tenant.id), "nova")
-    ensure_dir_exists(output_dir)
+    base_path = get_backup_base_path(tenant_id)
+    entry = {'type': obj_type, 'id': obj_id}
 
-    for srv in nova.servers.list():
-        backup_image_id = backup_nova_vm(tenant, srv)
+    for (k, v) in fields.items():
+        if k in ('meta', 'payload') and v:
+            v = os.path.relpath(v, base_path)
+        elif k == 'data':
+            v = get_openstack_obj_data(v)
 
-        if backup_image_id:
-            backups[backup_image_id] = (tenant.id, srv.id + "_" + srv.name)
+        entry[k] = v
 
-    # wait for snapshots to finish
-    wait_for_action_to_finish(backups, GLANCE_UPLOAD_TIMEOUT, nova_glance_check_upload)
+    append_json_line(get_manifest_file(tenant_id), entry)
 
-    # Download images from glance and delete them afterwards
-    pool = Pool()
-    pool.map(download_nova_glance_image, backups.items())
-    pool.map(glance_delete, backups.keys())
+    _manifest_lock.acquire()
+    _manifest_cache.pop(tenant_id, None)
+    _manifest_lock.release()
 
 
-def nova_check_vm_got_created(params):
+def add_manifest_payload(tenant_id, obj_type, obj_id, output_file):
     """
-    Check if a nova vm was successfully created
-    Params: tupel of vm id, tenant id
-    Returns: True for success, False for failure or None for not finished
+    Record the archived image file of an object in the manifest
+    Params: tenant id, object type, object id, name of uncompressed image file
+    Returns: boolean
     """
-    vm_id = params[0]
-    tenant_id = params[1]
-    nova = get_nova_client(tenant_id)
+    image_file = find_backup_image(output_file)
+
+    if not image_file:
+        return False
+
+    add_manifest_entry(tenant_id,
+                       obj_type,
+                       obj_id,
+                       payload=image_file,
+                       size=os.path.getsize(image_file),
+                       digest=load_image_digest(output_file))
+
+    return True
+
+
+def load_manifest(tenant_id):
+    """
+    Read the manifest of a tenant backup
+    Params: tenant id
+    Returns: list of entry dictionaries in archive order or None if there is no manifest
+    """
+    manifest_file = get_manifest_file(tenant_id)
+
+    if not os.path.exists(manifest_file):
+        return None
+
+    _manifest_lock.acquire()
 
     try:
-        vm = nova.servers.get(vm_id)
-        print "Status of volume " + vm.name + " is " + vm.status
+        if tenant_id in _manifest_cache:
+            return _manifest_cache[tenant_id]
 
-        if vm.status.upper() == "ACTIVE":
-            return (vm_id, True)
-    except NovaConflict, e:
-        print "Failed to get status of vm " + vm_id + "\n" + str(e)
-        return (vm_id, False)
+        entries = {}
+        order = []
+        fh = open(manifest_file)
 
-    return (vm_id, None)
+        for line in fh:
+            if not line.strip():
+                continue
+
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                print "Skipping broken line in manifest " + manifest_file
+                continue
+
+            key = (entry['type'], entry['id'])
+
+            if key in entries:
+                entries[key].update(entry)
+            else:
+                entries[key] = entry
+                order.append(key)
+
+        fh.close()
+
+        _manifest_cache[tenant_id] = [entries[key] for key in order]
+        return _manifest_cache[tenant_id]
+    finally:
+        _manifest_lock.release()
+
+
+def get_manifest_file_path(tenant_id, entry, field='payload'):
+    """
+    Return the absolute name of a file recorded in a manifest entry
+    Params: tenant id, manifest entry, field name (payload or meta)
+    Returns: file name or None
+    """
+    if not entry.get(field):
+        return None
+
+    return os.path.join(get_backup_base_path(tenant_id), entry[field])
+
+
+def load_backup_objects(tenant_id, obj_type):
+    """
+    Return the archived objects of a type
+    The manifest is used if the backup has one, for older backups the
+    json files of the objects are read
+    Params: tenant id, object type (tenant, user, role, image, vm or volume)
+    Returns: list of manifest entries with absolute payload file names
+    """
+    manifest = load_manifest(tenant_id)
+
+    if manifest is not None:
+        return [dict(entry, payload=get_manifest_file_path(tenant_id, entry))
+                for entry in manifest if entry['type'] == obj_type and entry.get('data')]
+
+    base_path = get_backup_base_path(tenant_id)
+    patterns = {'tenant': os.path.join(base_path, "keystone", "tenant.json"),
+                'user': os.path.join(base_path, "keystone", "user_*.json"),
+                'role': os.path.join(base_path, "keystone", "role_*.json"),
+                'image': os.path.join(base_path, "glance", "*.json"),
+                'vm': os.path.join(base_path, "nova", "*.json"),
+                'volume': os.path.join(base_path, "cinder", "*.json")}
+    objects = []
+
+    for json_file in glob(patterns[obj_type]):
+        data = load_openstack_obj(json_file)
+        image_file = None
+        user_name = None
+
+        if not data:
+            continue
+        elif obj_type == 'role' and os.path.basename(json_file).endswith("_" + data.get('name', '') + ".json"):
+            # role files are named role_<user name>_<role name>.json
+            user_name = os.path.basename(json_file)[len("role_"):-len("_" + data['name'] + ".json")]
+        elif obj_type == 'image':
+            image_file = json_file[:-len(".json")] + ".img"
+        elif obj_type == 'vm':
+            image_file = os.path.join(base_path, "nova", data['id'] + "_" + data['name'] + ".img")
+        elif obj_type == 'volume':
+            image_files = glob(os.path.join(base_path, "cinder", GLANCE_BACKUP_PREFIX + "_" + data['id'] + "_*.img*"))
+
+            if image_files:
+                image_file = image_files[0].split(".img")[0] + ".img"
+
+        objects.append({'type': obj_type, 'id': data.get('id'), 'data': data, 'payload': image_file, 'user_name': user_name})
+
+    return objects
+
+
+def verify_backup(tenant_id):
+    """
+    Check that all image files recorded in the manifest of a tenant backup
+    exist and match their md5 digest
+    Params: tenant id
+    Returns: boolean
+    """
+    manifest = load_manifest(tenant_id)
+    ok = True
+
+    if manifest is None:
+        print "ERROR backup of tenant " + tenant_id + " has no manifest"
+        return False
+
+    for entry in manifest:
+        image_file = get_manifest_file_path(tenant_id, entry)
+
+        if not image_file:
+            continue
+        elif not os.path.exists(image_file):
+            print "ERROR image file " + image_file + " of " + entry['type'] + " " + entry['id'] + " is missing"
+            ok = False
+        elif entry.get('digest'):
+            digest = hash_file(image_file, codec=get_image_codec(image_file)).hexdigest()
+
+            if digest != entry['digest']:
+                print "ERROR image file " + image_file + " of " + entry['type'] + " " + entry['id'] + " is corrupt"
+                ok = False
+            else:
+                print "Verified image file " + image_file
+
+    return ok
+
+
+#
+# IMAGE FILES
+#
+
+# lseek whence values of linux to find data and holes in sparse files
+SEEK_DATA = 3
+SEEK_HOLE = 4
+ZERO_BLOCK = "\0" * SPARSE_BLOCK_SIZE
+
+
+def write_image_data(fh, data):
+    """
+    Write data to an image file
+    If DOWNLOAD_SPARSE is set blocks of SPARSE_BLOCK_SIZE zeros are not written
+    but skipped so that they become holes in a sparse file. The caller must
+    truncate the file to its final size to create a hole at its end.
+    Params: file object, data
+    """
+    if not DOWNLOAD_SPARSE:
+        fh.write(data)
+        return
+
+    for start in range(0, len(data), SPARSE_BLOCK_SIZE):
+        block = data[start:start + SPARSE_BLOCK_SIZE]
+
+        if block == ZERO_BLOCK[:len(block)]:
+            fh.seek(len(block), os.SEEK_CUR)
+        else:
+            fh.write(block)
+
+
+class SparseFileReader(object):
+    """
+    Read only file object for image files that returns the holes of a
+    sparse file as zeros without reading them from disk
+    Falls back to normal reads on filesystems without SEEK_DATA / SEEK_HOLE
+    """
+
+    def __init__(self, file_name):
+        self.name = file_name
+        self.fh = open(file_name, "rb")
+        self.size = os.fstat(self.fh.fileno()).st_size
+        self.pos = 0
+        self.extent = None
+
+    def get_extent(self, pos):
+        """
+        Return the data extent at or after pos
+        Params: position in file
+        Returns: tupel of start and end of data
+        """
+        if self.extent and self.extent[0] <= pos < self.extent[1]:
+            return self.extent
+
+        try:
+            start = os.lseek(self.fh.fileno(), pos, SEEK_DATA)
+            self.extent = (start, os.lseek(self.fh.fileno(), start, SEEK_HOLE))
+        except OSError, e:
+            if e.errno == errno.ENXIO:
+                self.extent = (self.size, self.size)
+            else:
+                self.extent = (pos, self.size)
+
+        return self.extent
+
+    def read(self, size=-1):
+        if size < 0 or self.pos + size > self.size:
+            size = self.size - self.pos
+
+        data = []
+
+        while size > 0:
+            (start, end) = self.get_extent(self.pos)
+
+            if self.pos < start:
+                length = min(start - self.pos, size)
+                data.append("\0" * length)
+            else:
+                length = min(end - self.pos, size)
+                self.fh.seek(self.pos)
+                chunk = self.fh.read(length)
+                data.append(chunk)
+
+                # file got shorter while reading
+                if len(chunk) < length:
+                    self.pos += len(chunk)
+                    break
+
+            self.pos += length
+            size -= length
+
+        return "".join(data)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.pos
+        elif whence == os.SEEK_END:
+            offset += self.size
+
+        self.pos = max(offset, 0)
+
+    def tell(self):
+        return self.pos
+
+    def close(self):
+        self.fh.close()
+
+
+class ImageWriter(object):
+    """
+    Write image data into a file starting at file_offset
+    Blocks of zeros become holes (see write_image_data)
+    buffered is the number of bytes that are not on disk after sync()
+    """
+
+    buffered = 0
+
+    def __init__(self, file_name, file_offset=0):
+        if file_offset:
+            self.fh = open(file_name, "r+b")
+            self.fh.seek(file_offset)
+        else:
+            self.fh = open(file_name, "wb")
+
+    def write(self, data):
+        write_image_data(self.fh, data)
+
+    def sync(self):
+        """
+        Write all data to disk
+        Returns: position in file
+        """
+        self.fh.truncate(self.fh.tell())
+        self.fh.flush()
+        os.fsync(self.fh.fileno())
+
+        return self.fh.tell()
+
+    def close(self, final=True):
+        """
+        Write all data to disk and close the file
+        Params: data is complete (optional)
+        Returns: position in file
+        """
+        try:
+            return self.sync()
+        finally:
+            self.fh.close()
+
+
+class CompressingImageWriter(ImageWriter):
+    """
+    Write image data compressed into a file starting at file_offset
+    The data is cut into blocks of COMPRESSION_BLOCK_SIZE which get compressed
+    as independent frames by the 'compression' executor and are written in order.
+    Every sync() ends a frame so a download can be resumed at that position.
+    Besides the transfer buffers a writer holds at most TRANSFER_WRITER_MEMORY
+    bytes of uncompressed data (plus their compressed frames).
+    """
+
+    def __init__(self, file_name, file_offset, codec):
+        ImageWriter.__init__(self, file_name, file_offset)
+        self.codec = codec
+        self.buffer = []
+        self.buffered = 0
+        self.pending = deque()
+        self.pending_bytes = 0
+        self.pool = get_executor('compression')
+
+    def write(self, data):
+        while self.pending and self.pending_bytes + self.buffered + len(data) > TRANSFER_WRITER_MEMORY:
+            self.write_pending()
+
+        self.buffer.append(str(data))
+        self.buffered += len(data)
+
+        if self.buffered >= min(COMPRESSION_BLOCK_SIZE, TRANSFER_WRITER_MEMORY / 2):
+            self.submit()
+
+    def write_pending(self):
+        """
+        Write the oldest compressed block
+        """
+        (result, length) = self.pending.popleft()
+        self.fh.write(wait_for_result(result))
+        self.pending_bytes -= length
+
+    def submit(self):
+        """
+        Hand the buffered data to the compression threads and write
+        finished blocks if too many are pending
+        """
+        if self.buffer:
+            self.pending.append((self.pool.apply_async(compress_block, (self.codec, "".join(self.buffer))), self.buffered))
+            self.pending_bytes += self.buffered
+            self.buffer = []
+            self.buffered = 0
+
+        while len(self.pending) > SERVICE_CONCURRENCY['compression'] * 2:
+            self.write_pending()
+
+    def sync(self):
+        self.submit()
+
+        while self.pending:
+            self.write_pending()
+
+        return ImageWriter.sync(self)
+
+
+class StreamReader(object):
+    """
+    Read only file object without seek support around a decompressing reader
+    """
+
+    def __init__(self, fh):
+        self.fh = fh
+
+    def read(self, size=-1):
+        return self.fh.read(size)
+
+    def close(self):
+        self.fh.close()
+
+
+def get_chunk_path(chunk_hash):
+    """
+    Return the path of a chunk in the chunk store
+    The chunk store is shared by all tenants
+    Params: sha256 hex digest of chunk
+    Returns: file name
+    """
+    return os.path.join(BACKUP_BASE_PATH, "chunks", chunk_hash[:2], chunk_hash[2:4], chunk_hash)
+
+
+def store_chunk(data):
+    """
+    Store a chunk in the chunk store unless it already exists
+    Params: data of chunk
+    Returns: sha256 hex digest of chunk
+    """
+    chunk_hash = hashlib.sha256(data).hexdigest()
+    chunk_file = get_chunk_path(chunk_hash)
+
+    if not os.path.exists(chunk_file):
+        if not os.path.exists(os.path.dirname(chunk_file)):
+            try:
+                os.makedirs(os.path.dirname(chunk_file))
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+        tmp_file = chunk_file + "." + str(os.getpid()) + "." + str(thread.get_ident())
+        fh = open(tmp_file, "wb")
+        fh.write(data)
+        fh.flush()
+        os.fsync(fh.fileno())
+        fh.close()
+        os.rename(tmp_file, chunk_file)
+
+    return chunk_hash
+
+
+def find_chunk_boundary(data, offset):
+    """
+    Find the end of the first content defined chunk in data
+    Candidates are positions at least CHUNK_MIN_SIZE into the chunk that are
+    aligned to CHUNK_ALIGN bytes of the image (disk images are sector aligned,
+    so inserted data shifts content by multiples of it). A candidate is a
+    boundary if the crc32 of the CHUNK_WINDOW bytes before it masked with
+    CHUNK_MASK is zero.
+    Params: data starting with the chunk, offset of data in the image
+    Returns: length of chunk or None if data contains no boundary
+    """
+    pos = CHUNK_MIN_SIZE + (CHUNK_ALIGN - (offset + CHUNK_MIN_SIZE) % CHUNK_ALIGN) % CHUNK_ALIGN
+    end = min(len(data), CHUNK_MAX_SIZE)
+
+    while pos <= end:
+        if zlib.crc32(data[pos - CHUNK_WINDOW:pos]) & CHUNK_MASK == 0:
+            return pos
+
+        pos += CHUNK_ALIGN
+
+    if len(data) >= CHUNK_MAX_SIZE:
+        return CHUNK_MAX_SIZE
+
+    return None
+
+
+class ChunkStoreWriter(object):
+    """
+    Split image data into content defined chunks (see find_chunk_boundary),
+    store every chunk once in the chunk store and write the list of chunks
+    (recipe) into the file. Every line of a recipe is sha256 and length of a chunk.
+    Besides the transfer buffers a writer holds at most TRANSFER_WRITER_MEMORY
+    bytes (the buffered data is copied once while cutting chunks), but at least
+    enough to find a boundary within CHUNK_MAX_SIZE.
+    """
+
+    def __init__(self, file_name, file_offset=0):
+        self.offset = 0
+
+        if file_offset:
+            self.fh = open(file_name, "r+b")
+
+            for line in self.fh.read(file_offset).splitlines():
+                self.offset += int(line.split(" ")[1])
+
+            self.fh.seek(file_offset)
+        else:
+            self.fh = open(file_name, "wb")
+
+        self.buffer = []
+        self.buffered = 0
+
+    def write_chunks(self, final=False):
+        """
+        Store all chunks in the buffer
+        Params: store the remaining data as chunk even without boundary (optional)
+        """
+        data = "".join(self.buffer)
+        start = 0
+
+        while start < len(data):
+            length = find_chunk_boundary(buffer(data, start), self.offset)
+
+            if not length and final:
+                length = len(data) - start
+            elif not length:
+                break
+
+            chunk = data[start:start + length]
+            self.fh.write(store_chunk(chunk) + " " + str(len(chunk)) + "\n")
+            self.offset += len(chunk)
+            start += length
+
+        self.buffer = [data[start:]]
+        self.buffered = len(data) - start
+
+    def write(self, data):
+        self.buffer.append(str(data))
+        self.buffered += len(data)
+
+        if self.buffered >= max(min(2 * CHUNK_MAX_SIZE, TRANSFER_WRITER_MEMORY / 2 - TRANSFER_BUFFER_SIZE), CHUNK_MAX_SIZE):
+            self.write_chunks()
+
+    def sync(self, final=False):
+        """
+        Store all complete chunks and write the recipe to disk
+        Data after the last chunk boundary stays buffered unless final is set
+        because cutting it would break deduplication with other images
+        Params: store the remaining data as chunk (optional)
+        Returns: position in recipe file
+        """
+        self.write_chunks(final)
+        self.fh.truncate(self.fh.tell())
+        self.fh.flush()
+        os.fsync(self.fh.fileno())
+
+        return self.fh.tell()
+
+    def close(self, final=True):
+        try:
+            return self.sync(final)
+        finally:
+            self.fh.close()
+
+
+class ChunkStoreReader(object):
+    """
+    Read only file object that reassembles an image from the chunk store
+    by its recipe. Every chunk is verified against its sha256.
+    """
+
+    def __init__(self, file_name):
+        fh = open(file_name)
+        self.chunks = deque([line.split(" ")[0] for line in fh.read().splitlines()])
+        fh.close()
+        self.data = ""
+        self.pos = 0
+
+    def read(self, size=-1):
+        while self.chunks and (size < 0 or len(self.data) - self.pos < size):
+            chunk_hash = self.chunks.popleft()
+            fh = open(get_chunk_path(chunk_hash), "rb")
+            chunk = fh.read()
+            fh.close()
+
+            if hashlib.sha256(chunk).hexdigest() != chunk_hash:
+                raise IOError("Chunk " + chunk_hash + " is corrupt")
+
+            self.data = self.data[self.pos:] + chunk
+            self.pos = 0
+
+        if size < 0:
+            size = len(self.data) - self.pos
+
+        data = self.data[self.pos:self.pos + size]
+        self.pos += len(data)
+
+        return data
+
+    def close(self):
+        self.chunks.clear()
+        self.data = ""
+
+
+def get_compression_codec():
+    """
+    Return the codec to compress backup images with
+    BACKUP_COMPRESSION can be None, "auto" (best available), "zstd", "lz4" or "gzip"
+    Codecs that are not installed fall back to gzip
+    Returns: codec name or None
+    """
+    available = {'zstd': zstandard, 'lz4': lz4_frame, 'gzip': zlib}
+
+    if not BACKUP_COMPRESSION:
+        return None
+    elif BACKUP_COMPRESSION == "auto":
+        for codec in ('zstd', 'lz4', 'gzip'):
+            if available[codec]:
+                return codec
+    elif available.get(BACKUP_COMPRESSION):
+        return BACKUP_COMPRESSION
+
+    print "Compression " + str(BACKUP_COMPRESSION) + " is not available. Using gzip."
+    return "gzip"
+
+
+def compress_block(codec, data):
+    """
+    Compress data into one independent frame
+    Concatenated frames form a valid stream of every codec
+    Params: codec name, data
+    Returns: compressed data
+    """
+    if codec == "zstd":
+        return zstandard.ZstdCompressor(level=3).compress(data)
+    elif codec == "lz4":
+        return lz4_frame.compress(data)
+
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def open_image_writer(file_name, file_offset=0, codec=None):
+    """
+    Open a file to write image data into
+    Params: file name, position to start writing at, compression codec or "chunks" for the chunk store (optional)
+    Returns: ImageWriter object
+    """
+    if codec == "chunks":
+        return ChunkStoreWriter(file_name, file_offset)
+    elif codec:
+        return CompressingImageWriter(file_name, file_offset, codec)
+
+    return ImageWriter(file_name, file_offset)
+
+
+def open_image_reader(file_name, codec=None):
+    """
+    Open an image file for reading and decompress it on the fly
+    Params: file name, compression codec or "chunks" for a chunk store recipe (optional)
+    Returns: file object
+    """
+    if codec == "chunks":
+        return ChunkStoreReader(file_name)
+    elif codec == "zstd":
+        return StreamReader(zstandard.ZstdDecompressor().stream_reader(open(file_name, "rb"), read_across_frames=True))
+    elif codec == "lz4":
+        return StreamReader(lz4_frame.LZ4FrameFile(file_name, "rb"))
+    elif codec == "gzip":
+        return StreamReader(gzip.GzipFile(file_name, "rb"))
+
+    return SparseFileReader(file_name)
+
+
+def get_image_codec(file_name):
+    """
+    Return the compression codec of an image file by its suffix
+    Params: file name
+    Returns: codec name, "chunks" for a chunk store recipe or None
+    """
+    if file_name.endswith(CHUNK_RECIPE_SUFFIX):
+        return "chunks"
+
+    for (codec, suffix) in COMPRESSION_SUFFIXES.items():
+        if file_name.endswith(suffix):
+            return codec
+
+    return None
+
+
+def get_backup_image_files(file_name):
+    """
+    Return the names an image file can have on disk (uncompressed, compressed or chunk store recipe)
+    Params: name of uncompressed image file
+    Returns: list of file names
+    """
+    return [file_name, file_name + CHUNK_RECIPE_SUFFIX] + [file_name + suffix for suffix in COMPRESSION_SUFFIXES.values()]
+
+
+def find_backup_image(file_name):
+    """
+    Find the image file of a backup
+    Params: name of uncompressed image file
+    Returns: name of existing image file or None
+    """
+    for image_file in get_backup_image_files(file_name):
+        if os.path.exists(image_file):
+            return image_file
+
+    return None
+
+
+def open_backup_image(file_name):
+    """
+    Open an image file of a backup for reading
+    Compressed images get decompressed while reading, images in the
+    chunk store get reassembled
+    Params: name of uncompressed image file
+    Returns: file object
+    """
+    image_file = find_backup_image(file_name) or file_name
+
+    return open_image_reader(image_file, get_image_codec(image_file))
+
+
+#
+# JOURNAL
+#
+
+# the steps of an archive run of a tenant are appended to its journal
+# an interrupted run is resumed by skipping the steps that were done
+# only tenants with an open journal use it
+_journals = {}
+_journals_lock = threading.Lock()
+
+
+def get_journal_file(tenant_id):
+    """
+    Return the name of the journal file of a tenant backup
+    Params: tenant id
+    Returns: file name
+    """
+    return os.path.join(get_backup_base_path(tenant_id), JOURNAL_FILE)
+
+
+def open_journal(tenant_id):
+    """
+    Open the journal of a tenant backup
+    The steps of an unfinished former run are loaded to resume it,
+    otherwise a new journal is started
+    Params: tenant id
+    Returns: True if a former run gets resumed
+    """
+    journal_file = get_journal_file(tenant_id)
+    journal = {}
+    finished = True
+
+    if os.path.exists(journal_file):
+        fh = open(journal_file)
+
+        for line in fh:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # the last line of a crashed run can be incomplete
+                continue
+
+            journal[(record['step'], record['key'])] = record
+            finished = record['step'] == 'finished'
+
+        fh.close()
+
+    _journals_lock.acquire()
+
+    try:
+        if finished:
+            open(journal_file, "w").close()
+            _journals[tenant_id] = {}
+        else:
+            print "Resuming backup of tenant " + tenant_id + " with " + str(len(journal)) + " finished steps"
+            _journals[tenant_id] = journal
+    finally:
+        _journals_lock.release()
+
+    return not finished
+
+
+def add_journal_step(tenant_id, step, key, **fields):
+    """
+    Record a finished step in the journal of a tenant backup
+    The journal is synced to disk after every step
+    Params: tenant id, step name, key of the object, fields of the step
+    """
+    if tenant_id not in _journals:
+        return
+
+    record = dict(fields, step=step, key=key)
+    append_json_line(get_journal_file(tenant_id), record, True)
+
+    _journals_lock.acquire()
+
+    try:
+        _journals[tenant_id][(step, key)] = record
+    finally:
+        _journals_lock.release()
+
+
+def get_journal_step(tenant_id, step, key):
+    """
+    Look up a finished step in the journal of a tenant backup
+    Params: tenant id, step name, key of the object
+    Returns: dictionary of the step or None
+    """
+    _journals_lock.acquire()
+
+    try:
+        return _journals.get(tenant_id, {}).get((step, key))
+    finally:
+        _journals_lock.release()
+
+
+def get_journal_steps(tenant_id, step):
+    """
+    Return all finished steps of a kind from the journal of a tenant backup
+    Params: tenant id, step name
+    Returns: list of dictionaries
+    """
+    _journals_lock.acquire()
+
+    try:
+        return [record for ((record_step, key), record) in _journals.get(tenant_id, {}).items() if record_step == step]
+    finally:
+        _journals_lock.release()
+
+
+def close_journal(tenant_id):
+    """
+    Mark the archive run of a tenant as finished and close its journal
+    Params: tenant id
+    """
+    add_journal_step(tenant_id, 'finished', tenant_id)
+
+    _journals_lock.acquire()
+
+    try:
+        _journals.pop(tenant_id, None)
+    finally:
+        _journals_lock.release()
+
+
+#
+# TRANSFER PIPELINE
+#
+
+# all transfers of the process share TRANSFER_BUFFERS buffers
+# a reader waits for a free buffer if the later stages fall behind
+# a transfer holds at most TRANSFER_QUEUE_SIZE buffers per stage, writers
+# that compress or chunk data keep up to TRANSFER_WRITER_MEMORY more
+_transfer_buffers = Queue()
+_transfer_buffers_lock = threading.Lock()
+_transfer_buffers_created = [0]
+_transfer_stats = {}
+
+
+def wait_for_queue(queue):
+    """
+    Take an item from a queue, waits in steps of TRANSFER_WAIT_INTERVAL
+    so that a KeyboardInterrupt is not blocked
+    Params: Queue object
+    Returns: item
+    """
+    while 1:
+        try:
+            return queue.get(True, TRANSFER_WAIT_INTERVAL)
+        except Empty:
+            continue
+
+
+def wait_for_result(result):
+    """
+    Wait for the result of an executor task in steps of TRANSFER_WAIT_INTERVAL
+    so that a KeyboardInterrupt is not blocked
+    Params: AsyncResult object
+    Returns: result of the task
+    """
+    while not result.ready():
+        result.wait(TRANSFER_WAIT_INTERVAL)
+
+    return result.get()
+
+
+def get_transfer_buffer():
+    """
+    Take a buffer from the pool, blocks until one is free
+    Returns: bytearray of TRANSFER_BUFFER_SIZE
+    """
+    _transfer_buffers_lock.acquire()
+
+    try:
+        if _transfer_buffers.empty() and _transfer_buffers_created[0] < TRANSFER_BUFFERS:
+            _transfer_buffers_created[0] += 1
+            return bytearray(TRANSFER_BUFFER_SIZE)
+    finally:
+        _transfer_buffers_lock.release()
+
+    return wait_for_queue(_transfer_buffers)
+
+
+def release_transfer_buffer(buf):
+    """
+    Give a buffer back to the pool
+    Params: bytearray
+    """
+    _transfer_buffers.put(buf)
+
+
+def get_transfer_stats():
+    """
+    Return the throughput of all transfer stages of the process
+    Returns: dictionary of stage name and tupel of bytes, busy seconds, MB per second
+    """
+    _transfer_buffers_lock.acquire()
+
+    try:
+        return dict((name, (nbytes, seconds, seconds and nbytes / seconds / 1024 / 1024))
+                    for (name, (nbytes, seconds)) in _transfer_stats.items())
+    finally:
+        _transfer_buffers_lock.release()
+
+
+class TransferPipeline(object):
+    """
+    Move data from a reader through stages in their own threads
+    connected by queues of TRANSFER_QUEUE_SIZE buffers
+    read_func(buf) fills a buffer and returns the number of bytes (0 at the end),
+    every stage is a tupel of name and function called with the data
+    of a buffer in order. If readable is set the data can be read from the
+    pipeline as from a file after the last stage.
+    The bytes and busy seconds of each stage are counted in stats.
+    """
+
+    def __init__(self, name, read_func, stages=[], readable=False):
+        self.name = name
+        self.read_func = read_func
+        self.stages = [('read', None)] + list(stages)
+        self.readable = readable
+        self.queues = [Queue(TRANSFER_QUEUE_SIZE) for stage in self.stages[1:]]
+        self.stats = dict((stage[0], [0, 0.0]) for stage in self.stages)
+        self.error = None
+        self.closed = False
+        self.threads = []
+        self.data = None
+        self.pos = 0
+
+        if readable:
+            self.queues.append(Queue(TRANSFER_QUEUE_SIZE))
+
+    def count(self, stage_name, nbytes, start):
+        stats = self.stats[stage_name]
+        stats[0] += nbytes
+        stats[1] += time() - start
+
+    def forward(self, index, item):
+        """
+        Pass an item to the next stage or release its buffer after the last one
+        Params: index of current stage, tupel of buffer and length or None at the end
+        """
+        if index < len(self.queues):
+            self.queues[index].put(item)
+        elif item:
+            release_transfer_buffer(item[0])
+
+    def run_reader(self):
+        try:
+            while not self.error and not self.closed:
+                buf = get_transfer_buffer()
+                start = time()
+
+                try:
+                    length = self.read_func(buf)
+                except:
+                    release_transfer_buffer(buf)
+                    raise
+
+                self.count('read', length, start)
+
+                if not length:
+                    release_transfer_buffer(buf)
+                    break
+
+                self.forward(0, (buf, length))
+        except Exception, e:
+            self.error = self.error or e
+
+        self.forward(0, None)
+
+    def run_stage(self, index):
+        (stage_name, stage_func) = self.stages[index]
+
+        while 1:
+            item = wait_for_queue(self.queues[index - 1])
+
+            if item is None:
+                break
+            elif self.error or self.closed:
+                release_transfer_buffer(item[0])
+                continue
+
+            try:
+                start = time()
+                stage_func(buffer(item[0], 0, item[1]))
+                self.count(stage_name, item[1], start)
+            except Exception, e:
+                self.error = self.error or e
+                release_transfer_buffer(item[0])
+                continue
+
+            self.forward(index, item)
+
+        self.forward(index, None)
+
+    def start(self):
+        """
+        Start the threads of all stages
+        """
+        self.threads = [threading.Thread(target=self.run_reader)] + \
+                       [threading.Thread(target=self.run_stage, args=(index,)) for index in range(1, len(self.stages))]
+
+        for thread_obj in self.threads:
+            thread_obj.daemon = True
+            thread_obj.start()
+
+    def wait(self):
+        """
+        Wait for all stages to finish and add their counters to the process stats
+        """
+        for thread_obj in self.threads:
+            while thread_obj.is_alive():
+                thread_obj.join(1)
+
+        self.threads = []
+
+        _transfer_buffers_lock.acquire()
+
+        try:
+            for (stage_name, (nbytes, seconds)) in self.stats.items():
+                stats = _transfer_stats.setdefault(stage_name, [0, 0.0])
+                stats[0] += nbytes
+                stats[1] += seconds
+        finally:
+            _transfer_buffers_lock.release()
+
+    def join(self):
+        """
+        Wait for all stages to finish
+        Raises: the first exception of a stage
+        """
+        self.wait()
+
+        if self.error:
+            raise self.error
+
+    def run(self):
+        """
+        Transfer all data
+        Returns: number of bytes read
+        """
+        self.start()
+        self.join()
+
+        return self.stats['read'][0]
+
+    def read(self, size=-1):
+        """
+        Read data after the last stage of a readable pipeline
+        """
+        if not self.threads and not self.closed:
+            self.start()
+
+        data = []
+
+        while size < 0 or size > 0:
+            if not self.data:
+                item = wait_for_queue(self.queues[-1])
+
+                if item is None:
+                    self.queues[-1].put(None)
+                    break
+
+                self.data = item
+                self.pos = 0
+
+            length = self.data[1] - self.pos
+
+            if size >= 0:
+                length = min(length, size)
+                size -= length
+
+            data.append(str(self.data[0][self.pos:self.pos + length]))
+            self.pos += length
+
+            if self.pos == self.data[1]:
+                release_transfer_buffer(self.data[0])
+                self.data = None
+
+        if self.error:
+            raise IOError("Transfer of " + self.name + " failed: " + str(self.error))
+
+        return "".join(data)
+
+    def close(self):
+        """
+        Stop the transfer and give all buffers back
+        """
+        self.closed = True
+
+        if self.data:
+            release_transfer_buffer(self.data[0])
+            self.data = None
+
+        if self.readable and self.threads:
+            while 1:
+                item = wait_for_queue(self.queues[-1])
+
+                if item is None:
+                    break
+
+                release_transfer_buffer(item[0])
+
+        self.wait()
+
+    def summary(self):
+        """
+        Returns: string of the throughput of every stage
+        """
+        return ", ".join(stage_name + " " + str(int(self.stats[stage_name][0] / max(self.stats[stage_name][1], 0.001) / 1024 / 1024)) + " MB/s"
+                         for (stage_name, stage_func) in self.stages)
+
+
+def read_into_buffer(fh, buf, length=None):
+    """
+    Read from a file object into a buffer
+    Params: file object, bytearray, maximum number of bytes (optional)
+    Returns: number of bytes read
+    """
+    if length is None:
+        length = len(buf)
+
+    data = fh.read(min(length, len(buf)))
+    buf[:len(data)] = data
+
+    return len(data)
+
+
+def open_transfer_reader(name, fh):
+    """
+    Read a file in a background thread ahead of the consumer
+    At most TRANSFER_QUEUE_SIZE buffers are read ahead
+    Params: name of the transfer, file object
+    Returns: readable TransferPipeline
+    """
+    return TransferPipeline(name, lambda buf: read_into_buffer(fh, buf), readable=True)
+
+
+#
+# KEYSTONE
+#
+_keystone_auth_lock = threading.Lock()
+
+
+def get_keystone_auth():
+    """
+    Returns the keystone client holding the token that is shared by all threads
+    It is only used for the token and service catalog, not for api calls.
+    The client is cached and reauthenticates when its token is about to expire
+    """
+    keystone = get_cached_client('keystone', None)
+
+    if keystone:
+        return keystone
+
+    # threads starting at once must not all authenticate
+    _keystone_auth_lock.acquire()
+
+    try:
+        keystone = get_cached_client('keystone', None)
+
+        if not keystone:
+            keystone = keystone_client.Client(auth_url=os.environ["OS_AUTH_URL"],
+                                              username=os.environ["OS_USERNAME"],
+                                              password=os.environ["OS_PASSWORD"],
+                                              tenant_name=os.environ["OS_TENANT_NAME"])
+            set_cached_client('keystone', None, keystone, get_token_expiry(keystone))
+    finally:
+        _keystone_auth_lock.release()
+
+    return keystone
+
+
+def get_keystone_client():
+    """
+    Returns a keystone client object of the calling thread
+    It is built from the shared token (see get_keystone_auth) without authenticating again
+    """
+    keystone = get_cached_client('keystone_api', None)
+
+    if not keystone:
+        auth = get_keystone_auth()
+        keystone = set_cached_client('keystone_api', None,
+                                     keystone_client.Client(auth_ref=auth.auth_ref),
+                                     get_token_expiry(auth))
+
+    return keystone
+
+
+# roles by name, they are the same for all tenants
+_keystone_roles = {}
+_keystone_roles_lock = threading.Lock()
+
+
+def backup_keystone_user(tenant, user):
+    """
+    Backup user meta data into a json file
+    Params: tenant object, user object
+    """
+    print "Backing up metadata of user " + user.name
+    user_file = os.path.join(get_backup_base_path(tenant.id), "keystone", "user_" + user.name + ".json")
+
+    dump_openstack_obj(user, user_file)
+    add_manifest_entry(tenant.id, 'user', user.id, name=user.name, meta=user_file, data=user, depends=["tenant:" + tenant.id])
+
+    for role in get_keystone_client().roles.roles_for_user(user, tenant.id):
+        print "Storing role " + role.name + " for user " + user.name
+        role_file = os.path.join(get_backup_base_path(tenant.id), "keystone", "role_" + user.name + "_" + role.name + ".json")
+
+        dump_openstack_obj(role, role_file)
+        add_manifest_entry(tenant.id, 'role', user.id + ":" + role.id, name=role.name, user=user.id, meta=role_file, data=role, depends=["user:" + user.id])
+
+
+def restore_keystone_user(params):
+    """
+    Restore a keystone user and it's roles
+    Params: tupel of tenant_id, user data dictionary, list of role data dictionaries
+    """
+    tenant_id = params[0]
+    user_data = params[1]
+    roles_data = params[2]
+    user = None
+
+    if user_data:
+        keystone = get_keystone_client()
+
+        try:
+            user = keystone.users.create(user_data['username'],
+                                  INITIAL_PASSWORD,
+                                  user_data['email'],
+                                  tenant_id,
+                                  user_data['enabled'])
+            print "Restored user " + user_data['username']
+        except KeystoneConflict, e:
+            print "User " + user_data['username'] + " already exists"
+            user = keystone.users.find(name=user_data['username'])
+
+        run_parallel(lambda role_data: add_keystone_user_role(user, role_data['name'], tenant_id),
+                     roles_data,
+                     'keystone_roles')
+
+
+def get_keystone_role(role_name):
+    """
+    Look up a role by name
+    All roles are listed once and cached by name
+    Params: role name
+    Returns: role object or None
+    """
+    _keystone_roles_lock.acquire()
+
+    try:
+        if not _keystone_roles:
+            for role in get_keystone_client().roles.list():
+                _keystone_roles[role.name] = role
+
+        return _keystone_roles.get(role_name)
+    finally:
+        _keystone_roles_lock.release()
+
+
+def add_keystone_user_role(user, role_name, tenant_id):
+    """
+    Give a user a role in a tenant
+    Params: user object, role name, tenant id
+    """
+    keystone = get_keystone_client()
+    role = get_keystone_role(role_name)
+
+    if not role:
+        print "Role " + role_name + " cannot be found"
+        return
+
+    try:
+        keystone.roles.add_user_role(user, role, tenant_id)
+        print "Added user " + user.name + " to tenant with role " + role.name
+    except KeystoneConflict, e:
+        pass
+    except KeystoneNotFound, e:
+        print "Role " + role_name + " cannot be found " + str(e)
+
+
+def get_user_roles(roles, user):
+    """
+    Return the roles of a user from a backup
+    Params: list of role entries, user entry (see load_backup_objects)
+    Returns: list of role data dictionaries
+    """
+    return [role['data'] for role in roles
+            if role.get('user') == user['id'] or role.get('user_name') == user['data'].get('name')]
+
+
+def backup_keystone(tenant):
+    """
+    Backup all keystone data
+    Params: tenant object
+    """
+    backup_path = os.path.join(get_backup_base_path(tenant.id), "keystone")
+    ensure_dir_exists(backup_path)
+
+    if get_journal_step(tenant.id, 'keystone', tenant.id):
+        print "Keystone data of tenant " + tenant.name + " was already backed up"
+        return
+
+    print "Backing up metadata of tenant " + tenant.name
+    dump_openstack_obj(tenant, os.path.join(backup_path, "tenant.json"))
+    add_manifest_entry(tenant.id, 'tenant', tenant.id, name=tenant.name, meta=os.path.join(backup_path, "tenant.json"), data=tenant)
+    run_parallel(lambda user: backup_keystone_user(tenant, user), tenant.list_users(), 'keystone')
+    add_journal_step(tenant.id, 'keystone', tenant.id)
+
+
+def restore_keystone_tenant(tenant_data):
+    """
+    Restoring a keystone tenant
+    Params: dictionary of tenant data
+    Returns: tenant object
+    """
+    keystone = get_keystone_client()
+    tenant = None
+
+    try:
+        tenant = keystone.tenants.create(tenant_data['name'],
+                                         tenant_data['description'],
+                                         tenant_data['enabled'])
+        print "Restored tenant " + tenant_data['name']
+    except KeystoneConflict, e:
+        print "Tenant " + tenant_data['name'] + " already exists"
+        tenant = keystone.tenants.find(name=tenant_data['name'])
+
+    return tenant
+
+
+def restore_keystone(tenant_id):
+    """
+    Restore all keystone stuff
+    Params: tenant_id
+    """
+    backup_path = os.path.join(get_backup_base_path(tenant_id), "keystone")
+    tenant = None
+
+    if os.path.exists(backup_path):
+        tenants = load_backup_objects(tenant_id, 'tenant')
+
+        if tenants:
+            tenant = restore_keystone_tenant(tenants[0]['data'])
+            roles = load_backup_objects(tenant_id, 'role')
+
+            run_parallel(restore_keystone_user,
+                         [(tenant.id, user['data'], get_user_roles(roles, user)) for user in load_backup_objects(tenant_id, 'user')],
+                         'keystone')
+    else:
+        print "ERROR " + backup_path + " does not exist!"
+
+    return tenant
+
+
+#
+# NOVA
+#
+def get_nova_client(tenant_id):
+    """
+    Instantiate and return a nova client
+    The client is cached per tenant
+    Params: tenant id
+    """
+    nova = get_cached_client('nova', tenant_id)
+
+    if not nova:
+        keystone = get_keystone_client()
+        tenant = keystone.tenants.get(tenant_id)
+        nova = set_cached_client('nova', tenant_id,
+                                 nova_client.Client(username=os.environ["OS_USERNAME"],
+                                                    api_key=os.environ["OS_PASSWORD"],
+                                                    auth_url=os.environ["OS_AUTH_URL"],
+                                                    project_id=tenant.name))
+
+    return nova
+
+
+def backup_nova_vm(tenant, srv):
+    """
+    Save vm meta data as json file and make a snapshot of the given vm
+    A snapshot of an interrupted run (see open_journal) is reused if glance still has it
+    The api calls use the nova client of the calling thread
+    Params: tenant object, nova server object
+    Returns: id of snapshot image or None
+    """
+    bad_status = ['Error', 'image_uploading']
+    nova = get_nova_client(tenant.id)
+    print "Backing up metadata of vm " + srv.name
+    vm_file = os.path.join(get_backup_base_path(tenant.id), "nova", "vm_" + srv.name + ".json")
+    base_image = None
+
+    # the vm gets restored from its snapshot, the image it was booted from is not needed
+    if isinstance(srv.image, dict) and srv.image.get('id'):
+        base_image = srv.image['id']
+
+    dump_openstack_obj(srv, vm_file)
+    add_manifest_entry(tenant.id, 'vm', srv.id, name=srv.name, meta=vm_file, data=srv,
+                       depends=["tenant:" + tenant.id], base_image=base_image)
+
+    # a snapshot of an interrupted run can still be uploading
+    # therefore look it up before resetting the vm
+    snapshot = get_journal_step(tenant.id, 'snapshot', srv.id)
+
+    if snapshot and glance_image_usable(snapshot['image_id']):
+        print "Reusing backup image " + snapshot['image_id'] + " of vm " + srv.name
+        return snapshot['image_id']
+
+    # reset vm if it's in a bad state for image uploading
+    if srv.status in bad_status or getattr(srv, 'OS-EXT-STS:task_state') in bad_status:
+        print "Vm " + srv.name + " in bad state " + srv.status + " (" + getattr(srv, 'OS-EXT-STS:task_state') + "). Resetting."
+        nova.servers.reset_state(srv, 'active')
+        sleep(1)
+
+    print "Creating backup image of vm " + srv.name
+
+    try:
+        backup_id = nova.servers.create_image(srv, GLANCE_BACKUP_PREFIX + "_" + tenant.name + "_" + srv.name)
+        add_journal_step(tenant.id, 'snapshot', srv.id, image_id=backup_id, obj_type='vm')
+        return backup_id
+    except NovaConflict, e:
+        print "\nERROR creating snapshot of vm " + srv.name + "\n" + str(e) + "\n"
+        return None
+
+
+def get_snapshot_limits(srv):
+    """
+    Return the groups of a vm that limit its concurrent snapshots
+    Params: nova server object
+    Returns: dictionary of group name and maximal number of concurrent snapshots
+    """
+    limits = {}
+    hypervisor = getattr(srv, 'OS-EXT-SRV-ATTR:hypervisor_hostname', None)
+    backend = getattr(srv, 'OS-EXT-AZ:availability_zone', None)
+
+    if hypervisor:
+        limits["hypervisor " + hypervisor] = SNAPSHOT_PER_HYPERVISOR
+
+    if backend:
+        limits["backend " + backend] = SNAPSHOT_PER_BACKEND
+
+    return limits
+
+
+def start_nova_snapshots(tenant, queue, running, backup_vms):
+    """
+    Start the snapshots of all queued vms whose hypervisor and storage backend
+    have less than SNAPSHOT_PER_HYPERVISOR and SNAPSHOT_PER_BACKEND running snapshots
+    The api calls are made in parallel, vms are taken in the order of the queue
+    Params: tenant object, list of tupels of vm and size in bytes, dictionary of running snapshots per group,
+            dictionary to store the vm and size of every started snapshot image id
+    Returns: dictionary of started snapshots as items for wait_for_action_to_finish
+    """
+    started = {}
+
+    while queue:
+        picked = []
+
+        for (srv, size) in list(queue):
+            limits = get_snapshot_limits(srv)
+
+            if [group for (group, limit) in limits.items() if running.get(group, 0) >= limit]:
+                continue
+
+            for group in limits:
+                running[group] = running.get(group, 0) + 1
+
+            queue.remove((srv, size))
+            picked.append((srv, size))
+
+        if not picked:
+            break
+
+        failed = False
+
+        for ((srv, size), backup_image_id) in zip(picked, run_parallel(lambda vm: backup_nova_vm(tenant, vm[0]), picked, 'nova')):
+            if backup_image_id:
+                backup_vms[backup_image_id] = (srv, size)
+                started[backup_image_id] = (tenant.id, srv.id + "_" + srv.name, size)
+            else:
+                finish_nova_snapshot(srv, running)
+                failed = True
+
+        # failed snapshots give their slots to the next vms
+        if not failed:
+            break
+
+    return started
+
+
+def finish_nova_snapshot(srv, running):
+    """
+    Release the snapshot slots of a vm
+    Params: nova server object, dictionary of running snapshots per group
+    """
+    for group in get_snapshot_limits(srv):
+        running[group] -= 1
+
+
+def backup_nova(tenant):
+    """
+    Backup all nova data
+    Snapshots of the biggest vms are started first, at most SNAPSHOT_PER_HYPERVISOR
+    run on one hypervisor and SNAPSHOT_PER_BACKEND on one storage backend
+    (availability zone). The next snapshot starts when one has finished.
+    Params: tenant object
+    """
+    backups = {}
+    backup_vms = {}
+    running = {}
+    flavor_sizes = {}
+    nova = get_nova_client(tenant.id)
+    glance = get_glance_client()
+    output_dir = os.path.join(get_backup_base_path(tenant.id), "nova")
+    ensure_dir_exists(output_dir)
+
+    queue = []
+
+    for srv in nova.servers.list():
+        if get_journal_step(tenant.id, 'download', srv.id):
+            print "Vm " + srv.name + " was already backed up"
+            continue
+
+        if srv.flavor['id'] not in flavor_sizes:
+            flavor_sizes[srv.flavor['id']] = get_flavor_disk_size(nova, srv.flavor['id'])
+
+        queue.append((srv, flavor_sizes[srv.flavor['id']]))
+
+    queue.sort(key=lambda vm: vm[1], reverse=True)
+
+    def snapshot_finished(image_id, outcome):
+        finish_nova_snapshot(backup_vms[image_id][0], running)
+        started = start_nova_snapshots(tenant, queue, running, backup_vms)
+        backups.update(started)
+        return started
+
+    # wait for snapshots to finish and start the next ones
+    backups.update(start_nova_snapshots(tenant, queue, running, backup_vms))
+    outcomes = wait_for_action_to_finish(backups, GLANCE_UPLOAD_TIMEOUT, nova_glance_check_upload, nova_glance_batch_check_upload, snapshot_finished)
+
+    # Download finished images from glance and delete all of them afterwards
+    downloads = get_items_with_outcome(backups, outcomes).items()
+
+    def download_vm_image(download):
+        (image_id, item) = download
+
+        if download_nova_glance_image(download):
+            image_file = os.path.join(output_dir, item[1] + ".img")
+            add_manifest_payload(tenant.id, 'vm', backup_vms[image_id][0].id, image_file)
+            add_journal_step(tenant.id, 'download', backup_vms[image_id][0].id, image_id=image_id, digest=load_image_digest(image_file))
+
+    run_parallel(download_vm_image, downloads, 'glance')
+
+    delete_backup_images(tenant.id, backups.keys())
+
+
+def get_flavor_disk_size(nova, flavor_id):
+    """
+    Return the root disk size of a flavor
+    Params: nova client, flavor id
+    Returns: size in bytes or None if the flavor cannot be found
+    """
+    try:
+        return nova.flavors.get(flavor_id).disk * 1024 * 1024 * 1024
+    except NovaClientException, e:
+        print "Cannot get flavor " + str(flavor_id) + " " + str(e)
+
+    return None
+
+
+def nova_check_vm_got_created(params):
+    """
+    Check if a nova vm was successfully created
+    Params: tupel of vm id, tenant id
+    Returns: True for success, False for failure or None for not finished
+    """
+    vm_id = params[0]
+    tenant_id = params[1]
+    nova = get_nova_client(tenant_id)
+
+    try:
+        vm = nova.servers.get(vm_id)
+        print "Status of volume " + vm.name + " is " + vm.status
+
+        if vm.status.upper() == "ACTIVE":
+            return (vm_id, True)
+    except NovaConflict, e:
+        print "Failed to get status of vm " + vm_id + "\n" + str(e)
+        return (vm_id, False)
+
+    return (vm_id, None)
+
+
+def restore_nova_vm(params):
+    """
+    Restore a single vm
+    Params: tuple of new tenant_id, vm data dictionary, name of (uncompressed) image file
+    Returns: id of the new vm or None
+    """
+    new_tenant_id = params[0]
+    vm_data = params[1]
+    vm_img_file = params[2]
+    bkp_img_name = "vm_" + vm_data['name']
+
+    if not vm_img_file or not find_backup_image(vm_img_file):
+        print "ERROR restoring vm " + vm_data['name'] + " no image file in backup"
+        return None
+
+    nova = get_nova_client(new_tenant_id)
+    glance = get_glance_client()
+
+    print "Uploading image " + bkp_img_name
+    glance_img = glance.images.create(container_format="bare",
+                                      disk_format="qcow2",
+                                      name=bkp_img_name,
+                                      visibility="public")
+    glance_upload_image(glance_img.id, bkp_img_name, vm_img_file)
+
+    vm = nova.servers.create(vm_data['name'],
+                             glance_img.id,
+                             vm_data['flavor']['id'])
+
+    outcomes = wait_for_action_to_finish({vm.id: (new_tenant_id,)},
+                                         GLANCE_DOWNLOAD_TIMEOUT,
+                                         nova_check_vm_got_created)
+
+    if outcomes.get(vm.id) == ACTION_DONE:
+        print "Restored vm " + vm_data['name']
+    else:
+        print "ERROR restoring vm " + vm_data['name'] + " " + outcomes.get(vm.id, ACTION_FAILED)
+
+    # a vm that is still building needs its image
+    if outcomes.get(vm.id) != ACTION_TIMEOUT:
+        glance.images.delete(glance_img.id)
+
+    if outcomes.get(vm.id) == ACTION_DONE:
+        return vm.id
+
+    return None
+
+
+def restore_nova(old_tenant_id, new_tenant):
+    """
+    Restore all nova stuff
+    Params: old tenant_id, new tenant object
+    """
+    run_parallel(restore_nova_vm,
+                 [(new_tenant.id, vm['data'], vm['payload']) for vm in load_backup_objects(old_tenant_id, 'vm')],
+                 'nova')
+
+
+def cleanup_nova_backup(tenant):
+    """
+    Reset the vms snapshotted by this run (see open_journal) that are still in task image uploading
+    Params: tenant object
+    """
+    def reset_vm(vm_id):
+        nova = get_nova_client(tenant.id)
+
+        try:
+            vm = nova.servers.get(vm_id)
+        except NovaNotFound:
+            return
+
+        if getattr(vm, 'OS-EXT-STS:task_state') == task_states.IMAGE_UPLOADING and vm.status.lower() == 'active':
+            nova.servers.reset_state(vm, 'active')
+
+    run_parallel(reset_vm,
+                 [step['key'] for step in get_journal_steps(tenant.id, 'snapshot') if step.get('obj_type') == 'vm'],
+                 'nova')
+
+
+def gc_nova_backup(tenant):
+    """
+    Reset all active vms of a tenant that are still in task image uploading
+    This scans all vms and also resets the ones of concurrent runs
+    Params: tenant object
+    """
+    nova = get_nova_client(tenant.id)
+    vms = [vm for vm in nova.servers.list() if getattr(vm, 'OS-EXT-STS:task_state') == task_states.IMAGE_UPLOADING and \
+                                               vm.status.lower() == 'active']
+
+    run_parallel(lambda vm: get_nova_client(tenant.id).servers.reset_state(vm, 'active'), vms, 'nova')
+
+
+# ids of vms that were seen migrating, a vm that is idle on its source
+# host afterwards got its migration rolled back
+_migrations_seen = set()
+
+
+def get_migration_status(vm, item):
+    """
+    Check if the migration of a vm has finished
+    With a source host (fourth value of the item) the vm must have left it,
+    a just started migration can still look active on the source.
+    A vm that was seen migrating and is idle on its source again failed.
+    Params: nova server object, item tupel of tenant id, display name, size in bytes, source host (optional),
+            planned target host (optional)
+    Returns: True for success, False for failure or None for not finished
+    """
+    print "Migration of " + item[1] + " has status " + vm.status
+
+    if vm.status.lower() == 'error':
+        _migrations_seen.discard(vm.id)
+        return False
+
+    if len(item) < 4:
+        return vm.status.lower() == 'active' or None
+
+    if getattr(vm, 'OS-EXT-STS:task_state', None) or vm.status.lower() in ('migrating', 'resize'):
+        _migrations_seen.add(vm.id)
+        return None
+
+    if vm.status.lower() not in ('active', 'shutoff', 'verify_resize'):
+        return None
+
+    if getattr(vm, 'OS-EXT-SRV-ATTR:host', None) != item[3]:
+        _migrations_seen.discard(vm.id)
+        return True
+
+    if vm.id in _migrations_seen:
+        print "Migration of " + item[1] + " was rolled back"
+        _migrations_seen.discard(vm.id)
+        return False
+
+
+def nova_check_migration(params):
+    """
+    Check if migration of vm has finished
+    Params: tupel of instance id, item tupel (see get_migration_status)
+    Returns: True for success, False for failure or None for not finished
+    """
+    vm_id = params[0]
+    tenant_id = params[1][0]
+    display_name = params[1][1]
+    nova = get_nova_client(tenant_id)
+
+    try:
+        return (vm_id, get_migration_status(nova.servers.get(vm_id), params[1]))
+    except NovaConflict, e:
+        print "\nFailed to get status of image " + display_name + "\n" + str(e) + "\n"
+        return (vm_id, False)
+
+
+def nova_batch_check_migration(all_items):
+    """
+    Check if migrations of vms have finished with one list call per source and planned target host
+    Vms on none of these hosts (e.g. placed by the scheduler) are checked one by one
+    Params: dictionary of instance id as key and item tupel (see get_migration_status) as value
+    Returns: list of tupels of instance id and True, False or None
+    """
+    hosts = set()
+
+    for item in all_items.values():
+        hosts.update([host for host in item[3:5] if host])
+
+    def list_vms(tenant_id):
+        nova = get_nova_client(tenant_id)
+        return [vm for host in sorted(hosts) for vm in nova.servers.list(search_opts={'host': host, 'all_tenants': 1})]
+
+    return batch_check_status(all_items,
+                              list_vms,
+                              lambda vm_id, item, vm: get_migration_status(vm, item),
+                              nova_check_migration)
+
+
+#
+# GLANCE
+#
+def get_glance_client():
+    """
+    Return an instance of a glance client
+    The client is cached as long as the keystone token it uses is valid
+    """
+    glance = get_cached_client('glance', None)
+
+    if not glance:
+        keystone = get_keystone_auth()
+        glance_endpoint = keystone.service_catalog.url_for(service_type='image',
+                                                           endpoint_type='publicURL')
+        glance = set_cached_client('glance', None,
+                                   glance_client.Client('2',glance_endpoint, token=keystone.auth_token),
+                                   get_token_expiry(keystone))
+
+    return glance
+
+
+def glance_check_upload(params, output_dir):
+    """
+    Check if an upload to glance has finished
+    Params: tupel of image id, tenant id, name for output
+    Returns: True for success, False for failure or None for not finished
+    """
+    glance = get_glance_client()
+    image_id = params[0]
+    tenant_id = params[1][0]
+    display_name = params[1][1]
+
+    try:
+        backup_image = glance.images.get(image_id)
+        print "Upload of " + display_name + " is " + backup_image.status
+
+        if backup_image.status.lower() == 'active':
+            return (image_id, True)
+    except (GlanceNotFound, GlanceInternalServerError), e:
+        print "\nFailed to get status of image " + display_name + "\n" + str(e) + "\n"
+        return (image_id, False)
+
+    return (image_id, None)
+
+
+def glance_batch_check_upload(all_items, output_dir):
+    """
+    Check if uploads to glance have finished with one paginated list call per tenant
+    Params: dictionary of image id as key and tupel of tenant id, name for output as value
+    Returns: list of tupels of image id and True, False or None
+    """
+    glance = get_glance_client()
+
+    def upload_status(image_id, item, backup_image):
+        print "Upload of " + item[1] + " is " + backup_image.status
+
+        if backup_image.status.lower() == 'active':
+            return True
+        elif backup_image.status.lower() in ('killed', 'deleted'):
+            return False
+
+    return batch_check_status(all_items,
+                              lambda tenant_id: glance.images.list(filters={'owner': tenant_id},
+                                                                   page_size=GLANCE_PAGE_SIZE),
+                              upload_status,
+                              lambda params: glance_check_upload(params, output_dir))
+
+
+# No functools.partial with multiprocess on 2.6 :(
+# (see http://bugs.python.org/issue5228)
+#def create_glance_check_upload(tenant, output_dir):
+#    def myclosure(params):
+#        return glance_check_upload(params, tenant, output_dir)
+#    return myclosure
+
+def nova_glance_check_upload(params):
+    return glance_check_upload(params, "nova")
+
+def cinder_glance_check_upload(params):
+    return glance_check_upload(params, "cinder")
+
+def nova_glance_batch_check_upload(all_items):
+    return glance_batch_check_upload(all_items, "nova")
+
+def cinder_glance_batch_check_upload(all_items):
+    return glance_batch_check_upload(all_items, "cinder")
+
+def glance_delete(image_id):
+    glance = get_glance_client()
+    return glance.images.delete(image_id)
+
+
+def glance_image_usable(image_id):
+    """
+    Check if a glance image exists and is not broken
+    Params: image id
+    Returns: boolean
+    """
+    glance = get_glance_client()
+
+    try:
+        return glance.images.get(image_id).status.lower() in ('queued', 'saving', 'active')
+    except GlanceNotFound:
+        return False
+
+
+def delete_backup_images(tenant_id, image_ids):
+    """
+    Delete temporary backup images from glance in parallel and record it in the journal
+    Images downloaded by an interrupted run that were not deleted get deleted too
+    Params: tenant id, list of image ids
+    """
+    image_ids = set(image_ids) | set(step['image_id'] for step in get_journal_steps(tenant_id, 'download'))
+
+    def delete_image(image_id):
+        try:
+            glance_delete(image_id)
+        except GlanceNotFound:
+            pass
+
+        add_journal_step(tenant_id, 'delete', image_id)
+
+    run_parallel(delete_image,
+                 [image_id for image_id in image_ids if not get_journal_step(tenant_id, 'delete', image_id)],
+                 'glance')
+
+
+def glance_upload_image(image_id, image_name, image_file):
+    """
+    Upload an archived image file into glance
+    The file is read (and decompressed) in a background thread while uploading
+    Params: glance image id, image name, name of (uncompressed) image file
+    """
+    glance = get_glance_client()
+    image_fh = open_backup_image(image_file)
+    reader = open_transfer_reader("image " + image_name, image_fh)
+
+    try:
+        glance.images.upload(image_id, reader)
+    finally:
+        reader.close()
+        image_fh.close()
+
+    print "Transfer of image " + image_name + ": " + reader.summary()
+
+
+def download_nova_glance_image(params):
+    image_id = params[0]
+    tenant_id = params[1][0]
+    display_name = params[1][1]
+    output_dir = os.path.join(get_backup_base_path(tenant_id), "nova")
+    return download_glance_image(image_id, os.path.join(output_dir, display_name + ".img"))
+
+def download_cinder_glance_image(params):
+    image_id = params[0]
+    tenant_id = params[1][0]
+    display_name = params[1][1]
+    output_dir = os.path.join(get_backup_base_path(tenant_id), "cinder")
+    return download_glance_image(image_id, os.path.join(output_dir, display_name + ".img"))
+
+
+def get_glance_image_url(image_id):
+    """
+    Return the url of the data of a glance image
+    Params: image id
+    Returns: tupel of url and auth token
+    """
+    keystone = get_keystone_auth()
+    glance_endpoint = keystone.service_catalog.url_for(service_type='image',
+                                                       endpoint_type='publicURL').rstrip("/")
+
+    for version in ("/v1", "/v2"):
+        if glance_endpoint.endswith(version):
+            glance_endpoint = glance_endpoint[:-len(version)]
+
+    return (glance_endpoint + "/v2/images/" + image_id + "/file", keystone.auth_token)
+
+
+def open_glance_image_data(image_id, offset=0, end=None):
+    """
+    Open a http stream to the data of a glance image
+    If offset or end is given only that range of bytes is requested
+    Params: image id, offset (optional), last byte (optional)
+    Returns: httplib response object (status 206 if the range was served)
+    """
+    (url, token) = get_glance_image_url(image_id)
+    url = urlparse.urlsplit(url)
+    headers = {'X-Auth-Token': token}
+
+    if url.scheme == "https":
+        conn = httplib.HTTPSConnection(url.netloc, timeout=DOWNLOAD_SOCKET_TIMEOUT)
+    else:
+        conn = httplib.HTTPConnection(url.netloc, timeout=DOWNLOAD_SOCKET_TIMEOUT)
+
+    if end is not None:
+        headers['Range'] = "bytes=" + str(offset) + "-" + str(end)
+    elif offset:
+        headers['Range'] = "bytes=" + str(offset) + "-"
+
+    conn.request("GET", url.path, headers=headers)
+    resp = conn.getresponse()
+
+    if resp.status == 404:
+        conn.close()
+        raise GlanceNotFound("Image " + image_id + " not found")
+    elif resp.status not in (200, 206):
+        conn.close()
+        raise IOError("Got HTTP status " + str(resp.status) + " " + resp.reason)
+
+    return resp
+
+
+def load_download_progress(image_id, part_file, progress_file):
+    """
+    Return the number of bytes of an image that were already downloaded
+    The part file is truncated to the last recorded progress
+    Params: image id, name of part file, name of progress file
+    Returns: tupel of offset in image and position in part file
+    """
+    progress = None
+
+    if os.path.exists(progress_file) and os.path.exists(part_file):
+        progress = load_openstack_obj(progress_file)
+
+    if not progress or progress.get('image_id') != image_id or 'offset' not in progress:
+        return (0, 0)
+
+    # records of older versions have no file offset, they were
+    # written for uncompressed part files only
+    file_offset = progress.get('file_offset', progress['offset'])
+
+    fh = open(part_file, "r+b")
+    fh.truncate(file_offset)
+    fh.close()
+
+    return (progress['offset'], file_offset)
+
+
+def save_download_progress(image_id, progress_file, offset, file_offset):
+    """
+    Atomically record the number of downloaded bytes of an image
+    Params: image id, name of progress file, offset in image, position in part file
+    """
+    dump_openstack_obj({'image_id': image_id, 'offset': offset, 'file_offset': file_offset}, progress_file + ".tmp")
+    os.rename(progress_file + ".tmp", progress_file)
+
+
+def hash_file(file_name, hasher=None, length=None, codec=None, offset=0):
+    """
+    Feed the (uncompressed) content of a file into a hash object
+    Params: file name, hash object (default md5), number of bytes to read (default all), compression codec (optional),
+            offset to start at (only for uncompressed files)
+    Returns: hash object
+    """
+    if not hasher:
+        hasher = hashlib.md5()
+
+    fh = open_image_reader(file_name, codec)
+
+    if offset:
+        fh.seek(offset)
+
+    while length is None or length > 0:
+        if length is None:
+            chunk = fh.read(DOWNLOAD_CHUNK_SIZE)
+        else:
+            chunk = fh.read(min(DOWNLOAD_CHUNK_SIZE, length))
+            length -= len(chunk)
+
+        if not chunk:
+            break
+
+        hasher.update(chunk)
+
+    fh.close()
+
+    return hasher
+
+
+def save_image_digest(output_file, digest):
+    """
+    Store the md5 digest of a downloaded image in output_file.md5
+    The file can be checked with md5sum -c for uncompressed images
+    Params: name of image file, hex digest
+    """
+    fh = open(output_file + ".md5", "w")
+    fh.write(digest + "  " + os.path.basename(output_file) + "\n")
+    fh.close()
+
+
+def load_image_digest(output_file):
+    """
+    Read the md5 digest of a downloaded image
+    Params: name of image file
+    Returns: hex digest or None
+    """
+    digest = None
+
+    if os.path.exists(output_file + ".md5"):
+        fh = open(output_file + ".md5")
+        digest = fh.read().split(" ")[0].strip()
+        fh.close()
+
+    return digest
+
+
+def download_glance_image_data(image_id, part_file, progress_file, offset, file_offset=0, size=None, hasher=None, codec=None):
+    """
+    Download the data of a glance image starting at offset into part_file
+    Progress is recorded every DOWNLOAD_PROGRESS_INTERVAL bytes
+    Reading, hashing and writing run as stages of a TransferPipeline
+    Params: image id, name of part file, name of progress file, offset in image, position in part file, expected size (optional), hash object of the first offset bytes (optional), compression codec (optional)
+    Returns: tupel of number of bytes of the image in part file and hash object
+    Raises: IOError if the download was interrupted
+    """
+    resp = open_glance_image_data(image_id, offset)
+
+    if not hasher or (offset and resp.status != 206):
+        hasher = hashlib.md5()
+
+    if offset and resp.status != 206:
+        print "Server does not support ranges. Restarting download of image " + image_id
+        offset = 0
+        file_offset = 0
+
+    if resp.getheader('content-length'):
+        size = offset + int(resp.getheader('content-length'))
+
+    if offset:
+        print "Resuming download of image " + image_id + " at byte " + str(offset)
 
+    writer = open_image_writer(part_file, file_offset, codec)
+    state = {'offset': offset, 'saved_offset': offset}
+    complete = False
 
-def restore_nova_vm(params):
-    """
-    Restore a single vm
-    Params: tuple of new tenant_id, path to vm json file, backup dir
-    """
-    new_tenant_id = params[0]
-    vm_file = params[1]
-    backup_path = params[2]
-    vm_data = load_openstack_obj(vm_file)
-    bkp_img_name = "vm_" + vm_data['name']
-    vm_img_file = os.path.join(backup_path, vm_data['id'] + "_" + vm_data['name'] + '.img')
+    def write_data(data):
+        writer.write(data)
+        state['offset'] += len(data)
 
-    nova = get_nova_client(new_tenant_id)
-    glance = get_glance_client()
+        if state['offset'] - state['saved_offset'] >= DOWNLOAD_PROGRESS_INTERVAL:
+            # sync first, it changes the number of buffered bytes
+            synced_offset = writer.sync()
+            save_download_progress(image_id, progress_file, state['offset'] - writer.buffered, synced_offset)
+            state['saved_offset'] = state['offset']
 
-    print "Uploading image " + bkp_img_name
-    glance_img = glance.images.create(container_format="bare",
-                                      disk_format="qcow2",
-                                      name=bkp_img_name,
-                                      visibility="public")
-    glance.images.upload(glance_img.id, open(vm_img_file, 'rb'))
+    pipeline = TransferPipeline("image " + image_id,
+                                lambda buf: read_into_buffer(resp, buf),
+                                [('hash', hasher.update), ('write', write_data)])
 
-    vm = nova.servers.create(vm_data['name'],
-                             glance_img.id,
-                             vm_data['flavor']['id'])
+    try:
+        pipeline.run()
+        complete = size is None or state['offset'] == size
+    finally:
+        resp.close()
+        offset = state['offset']
+        file_offset = writer.close(complete)
+        save_download_progress(image_id, progress_file, offset - writer.buffered, file_offset)
+        print "Transfer of image " + image_id + ": " + pipeline.summary()
 
-    wait_for_action_to_finish({vm.id: (new_tenant_id,)},
-                              GLANCE_DOWNLOAD_TIMEOUT,
-                              nova_check_vm_got_created)
+    if size is not None and offset != size:
+        raise IOError("Connection closed after " + str(offset) + " of " + str(size) + " bytes")
 
-    print "Restored vm " + vm_data['name']
-    glance.images.delete(glance_img.id)
+    return (offset, hasher)
 
 
-def restore_nova(old_tenant_id, new_tenant):
+def download_glance_image_stream(image_id, part_file, progress_file, size=None, codec=None):
     """
-    Restore all nova stuff
-    Params: old tenant_id, new tenant object
+    Download a glance image over one http stream into part_file
+    The md5 digest is calculated while downloading, only the already
+    downloaded part of a resumed download gets read again
+    Params: image id, name of part file, name of progress file, expected size (optional), compression codec (optional)
+    Returns: hex digest of the image or None on failure
     """
-    backup_path = os.path.join(get_backup_base_path(old_tenant_id), "nova")
-    map(restore_nova_vm,
-        [(new_tenant.id, vm_file, backup_path) for vm_file in glob(os.path.join(backup_path, '*.json'))])
+    (offset, file_offset) = load_download_progress(image_id, part_file, progress_file)
+    print "Downloading image " + image_id
 
+    for retry in range(DOWNLOAD_RETRIES):
+        try:
+            hasher = None
 
-def cleanup_nova_backup(tenant):
-    """
-    On exit reset all active vms that are still in task image uploading
-    Params: tenant object
-    """
-    nova = get_nova_client(tenant.id)
-    pool = Pool()
-    vm_ids = (vm.id for vm in nova.servers.list() if getattr(vm, 'OS-EXT-STS:task_state') == task_states.IMAGE_UPLOADING and \
-                                                     vm.status.lower() == 'active')
+            if offset:
+                hasher = hash_file(part_file, length=offset, codec=codec)
 
-    pool.map(lambda vm: vm.reset_state('active'), vm_ids)
+            (offset, hasher) = download_glance_image_data(image_id, part_file, progress_file, offset, file_offset, size, hasher, codec)
+            return hasher.hexdigest()
+        except GlanceNotFound, e:
+            print "Error downloading image " + image_id + ": " + str(e)
+            return None
+        except (IOError, httplib.HTTPException), e:
+            print "Error downloading image " + image_id + ": " + str(e) + ". Retrying."
+            (offset, file_offset) = load_download_progress(image_id, part_file, progress_file)
+            sleep(DOWNLOAD_RETRY_WAIT)
 
+    return None
 
-def nova_check_migration(params):
+
+def glance_supports_ranges(image_id):
     """
-    Check if migration of vm has finished
-    Params: tupel of instance id, tenant id
-    Returns: True for success, False for failure or None for not finished
+    Check if glance serves byte ranges of the image data
+    A server ignoring the range answers with the whole image, that answer
+    is closed without reading it
+    Params: image id
+    Returns: boolean
     """
-    vm_id = params[0]
-    tenant_id = params[1][0]
-    display_name = params[1][1]
-    nova = get_nova_client(tenant_id)
-
     try:
-        vm = nova.servers.get(vm_id)
-        print "Migration of " + display_name + " has status " + vm.status
+        resp = open_glance_image_data(image_id, 0, 0)
 
-        if vm.status.lower() == 'active':
-            return (vm_id, True)
-    except NovaConflict, e:
-        print "\nFailed to get status of image " + display_name + "\n" + str(e) + "\n"
-        return (vm_id, False)
+        if resp.status == 206:
+            resp.read(1)
 
-    return (vm_id, None)
+        resp.close()
+        return resp.status == 206
+    except (IOError, httplib.HTTPException, GlanceNotFound):
+        return False
 
 
-#
-# GLANCE
-#
-def get_glance_client():
+def load_segment_progress(image_id, part_file, progress_file, size):
     """
-    Return an instance of a glance client
+    Return the byte ranges of an image that are left to be downloaded
+    A missing part file is created with the size of the image without
+    allocating its blocks
+    Params: image id, name of part file, name of progress file, size of image
+    Returns: dictionary of the progress record with a list of [start, position, end] as segments
     """
-    keystone = get_keystone_client()
-    glance_endpoint = keystone.service_catalog.url_for(service_type='image',
-                                                       endpoint_type='publicURL')
-    return glance_client.Client('2',glance_endpoint, token=keystone.auth_token)
+    progress = None
 
+    if os.path.exists(progress_file) and os.path.exists(part_file):
+        progress = load_openstack_obj(progress_file)
 
-def glance_check_upload(params, output_dir):
+    if progress and progress.get('image_id') == image_id and progress.get('size') == size and progress.get('segments'):
+        return progress
+
+    segment_size = size / DOWNLOAD_SEGMENTS + 1
+    progress = {'image_id': image_id,
+                'size': size,
+                'segments': [[start, start, min(start + segment_size, size) - 1] for start in range(0, size, segment_size)]}
+
+    fh = open(part_file, "wb")
+    fh.truncate(size)
+    fh.close()
+    dump_openstack_obj(progress, progress_file)
+
+    return progress
+
+
+def download_glance_image_segment(image_id, part_file, progress_file, progress, segment, lock, hasher=None):
     """
-    Check if an upload to glance has finished
-    Params: tupel of image id, tenant id, name for output
-    Returns: True for success, False for failure or None for not finished
+    Download one byte range of a glance image into its position in part_file
+    The position of the segment in the progress record is updated every
+    DOWNLOAD_PROGRESS_INTERVAL bytes
+    Params: image id, name of part file, name of progress file, progress record, segment as [start, position, end], lock for the progress record,
+            hash object fed with the written data in order (optional)
+    Returns: boolean
     """
-    glance = get_glance_client()
-    image_id = params[0]
-    tenant_id = params[1][0]
-    display_name = params[1][1]
+    def save_progress(pos):
+        lock.acquire()
 
-    try:
-        backup_image = glance.images.get(image_id)
-        print "Upload of " + display_name + " is " + backup_image.status
+        try:
+            segment[1] = pos
+            dump_openstack_obj(progress, progress_file + ".tmp")
+            os.rename(progress_file + ".tmp", progress_file)
+        finally:
+            lock.release()
 
-        if backup_image.status.lower() == 'active':
-            return (image_id, True)
-    except (GlanceNotFound, GlanceInternalServerError), e:
-        print "\nFailed to get status of image " + display_name + "\n" + str(e) + "\n"
-        return (image_id, False)
+    for retry in range(DOWNLOAD_RETRIES):
+        pos = segment[1]
 
-    return (image_id, None)
+        if pos > segment[2]:
+            return True
 
+        try:
+            resp = open_glance_image_data(image_id, pos, segment[2])
 
-# No functools.partial with multiprocess on 2.6 :(
-# (see http://bugs.python.org/issue5228)
-#def create_glance_check_upload(tenant, output_dir):
-#    def myclosure(params):
-#        return glance_check_upload(params, tenant, output_dir)
-#    return myclosure
+            if resp.status != 206:
+                resp.close()
+                raise IOError("Range " + str(pos) + "-" + str(segment[2]) + " was not served")
 
-def nova_glance_check_upload(params):
-    return glance_check_upload(params, "nova")
+            fh = open(part_file, "r+b")
+            fh.seek(pos)
+            state = {'read': pos, 'written': pos}
 
-def cinder_glance_check_upload(params):
-    return glance_check_upload(params, "cinder")
+            def read_data(buf):
+                length = read_into_buffer(resp, buf, segment[2] - state['read'] + 1)
+                state['read'] += length
+                return length
 
-def glance_delete(image_id):
-    glance = get_glance_client()
-    return glance.images.delete(image_id)
+            def write_data(data):
+                write_image_data(fh, data)
+                state['written'] += len(data)
 
-def download_nova_glance_image(params):
-    image_id = params[0]
-    tenant_id = params[1][0]
-    display_name = params[1][1]
-    output_dir = os.path.join(get_backup_base_path(tenant_id), "nova")
-    download_glance_image(image_id, os.path.join(output_dir, display_name + ".img"))
+                if hasher:
+                    hasher.update(data)
 
-def download_cinder_glance_image(params):
-    image_id = params[0]
-    tenant_id = params[1][0]
-    display_name = params[1][1]
-    output_dir = os.path.join(get_backup_base_path(tenant_id), "cinder")
-    download_glance_image(image_id, os.path.join(output_dir, display_name + ".img"))
+                if state['written'] - segment[1] >= DOWNLOAD_PROGRESS_INTERVAL:
+                    fh.flush()
+                    os.fsync(fh.fileno())
+                    save_progress(state['written'])
+
+            try:
+                TransferPipeline("image " + image_id + " range " + str(pos), read_data, [('write', write_data)]).run()
+            finally:
+                pos = state['written']
+                fh.flush()
+                os.fsync(fh.fileno())
+                fh.close()
+                resp.close()
+                save_progress(pos)
+
+            if pos <= segment[2]:
+                raise IOError("Connection closed at byte " + str(pos) + " of range ending at " + str(segment[2]))
+
+            return True
+        except GlanceNotFound, e:
+            print "Error downloading image " + image_id + ": " + str(e)
+            return False
+        except (IOError, httplib.HTTPException), e:
+            print "Error downloading image " + image_id + ": " + str(e) + ". Retrying."
+            sleep(DOWNLOAD_RETRY_WAIT)
+
+    return False
+
+
+def download_glance_image_segmented(image_id, part_file, progress_file, size):
+    """
+    Download a glance image as DOWNLOAD_SEGMENTS byte ranges over parallel
+    http streams into a preallocated part_file
+    Md5 cannot be calculated over out of order data. The first segment of a
+    new download is hashed while it arrives, the other segments (and all of
+    a resumed download) are read from the part file once all segments arrived
+    Params: image id, name of part file, name of progress file, size of image
+    Returns: hex digest of the image or None on failure
+    """
+    progress = load_segment_progress(image_id, part_file, progress_file, size)
+    lock = threading.Lock()
+    first = progress['segments'][0]
+    hasher = None
+
+    if first[0] == 0 and first[1] == 0:
+        hasher = hashlib.md5()
+
+    print "Downloading image " + image_id + " in " + str(len(progress['segments'])) + " segments"
+    results = run_parallel(lambda segment: download_glance_image_segment(image_id,
+                                                                         part_file,
+                                                                         progress_file,
+                                                                         progress,
+                                                                         segment,
+                                                                         lock,
+                                                                         segment is first and hasher or None),
+                           progress['segments'],
+                           'glance_data')
+
+    if False in results:
+        return None
+
+    if hasher:
+        return hash_file(part_file, hasher, offset=first[2] + 1).hexdigest()
+
+    return hash_file(part_file).hexdigest()
 
 
 def download_glance_image(image_id, output_file):
     """
     Download a glance image specified by image_id and save it into output_file
+    The data is written to output_file.part and renamed when complete.
+    An interrupted download is resumed with a range request (also on the next run)
+    as recorded in output_file.progress
+    Images of at least two DOWNLOAD_SEGMENT_MIN_SIZE are fetched as DOWNLOAD_SEGMENTS
+    parallel byte ranges if glance supports it
+    The md5 digest of the data is compared to the checksum of the image,
+    on mismatch the download is repeated up to DOWNLOAD_CHECKSUM_RETRIES times.
+    The digest gets stored in output_file.md5
+    If BACKUP_COMPRESSION is set the image is compressed while downloading
+    and saved as output_file plus the suffix of the codec
+    If BACKUP_CHUNK_STORE is set the image is stored deduplicated in the
+    chunk store and only its recipe is saved as output_file.recipe
     Params: image_id, output_file name
+    Returns: boolean
     """
     glance = get_glance_client()
 
-    print "Downloading image " + image_id
-    fh = open(output_file, "wb")
+    if BACKUP_CHUNK_STORE:
+        codec = "chunks"
+        image_file = output_file + CHUNK_RECIPE_SUFFIX
+    else:
+        codec = get_compression_codec()
+        image_file = output_file + COMPRESSION_SUFFIXES.get(codec, "")
+
+    part_file = image_file + ".part"
+    progress_file = image_file + ".progress"
 
     try:
-        for chunk in glance.images.data(image_id):
-            fh.write(chunk)
-    except PicklingError, e:
-        print "Error saving image " + image_id + ": " + str(e)
-        return False
+        img = glance.images.get(image_id)
     except GlanceNotFound, e:
         print "Error downloading image " + image_id + ": " + str(e)
         return False
-    finally:
-        fh.close()
+
+    size = img.size
+    checksum = getattr(img, 'checksum', None)
+
+    for retry in range(DOWNLOAD_CHECKSUM_RETRIES + 1):
+        if not codec and DOWNLOAD_SEGMENTS > 1 and size and size >= 2 * DOWNLOAD_SEGMENT_MIN_SIZE and glance_supports_ranges(image_id):
+            digest = download_glance_image_segmented(image_id, part_file, progress_file, size)
+        else:
+            digest = download_glance_image_stream(image_id, part_file, progress_file, size, codec)
+
+        if not digest:
+            break
+        elif checksum and digest != checksum:
+            print "ERROR checksum mismatch of image " + image_id + ": got " + digest + " expected " + checksum
+            os.unlink(part_file)
+            os.unlink(progress_file)
+        else:
+            os.rename(part_file, image_file)
+            os.unlink(progress_file)
+            save_image_digest(output_file, digest)
+
+            # remove the image of former backups stored with another compression
+            for old_file in get_backup_image_files(output_file):
+                if old_file != image_file and os.path.exists(old_file):
+                    os.unlink(old_file)
+
+            return True
+
+    print "Giving up downloading image " + image_id
+    return False
+
+
+def glance_image_unchanged(img, meta_file, image_file):
+    """
+    Check if a glance image has not changed since it was archived
+    Checksum and update time must equal the archived meta data and the
+    archived image file must have been verified with the same checksum
+    Params: image object, name of archived json file, name of archived (uncompressed) image file
+    Returns: boolean
+    """
+    if not img.checksum or not os.path.exists(meta_file) or not find_backup_image(image_file):
+        return False
+
+    old_img = load_openstack_obj(meta_file)
+
+    return old_img is not None and \
+           old_img.get('checksum') == img.checksum and \
+           old_img.get('updated_at') == img.updated_at and \
+           load_image_digest(image_file) == img.checksum
+
+
+def link_backup_image(old_image_file, image_file):
+    """
+    Hard link an archived image file and its digest from a previous backup
+    Params: name of archived (uncompressed) image file, name of new (uncompressed) image file
+    Returns: boolean
+    """
+    old_file = find_backup_image(old_image_file)
+    new_file = image_file + old_file[len(old_image_file):]
+
+    try:
+        for link_file in get_backup_image_files(image_file) + [image_file + ".md5"]:
+            if os.path.exists(link_file):
+                os.unlink(link_file)
+
+        os.link(old_file, new_file)
+        os.link(old_image_file + ".md5", image_file + ".md5")
+    except OSError, e:
+        print "Cannot link " + old_file + " to " + new_file + ": " + str(e)
+        return False
 
     return True
 
@@ -566,7 +3229,10 @@ def download_glance_image(image_id, output_file):
 def backup_glance_image(params):
     """
     Dump meta data of glance image in a json file and store the image in another file
+    If INCREMENTAL_BACKUP is set an unchanged image is not downloaded again
+    but kept or hard linked from the backup in BACKUP_PREVIOUS_PATH
     Params: tupel of tenant_id, glance image id
+    Returns: boolean
     """
     tenant_id = params[0]
     img_id = params[1]
@@ -577,10 +3243,39 @@ def backup_glance_image(params):
     img = glance.images.get(img_id)
     print "Backing up metadata of glance image " + img.name
 
-    dump_openstack_obj(img, os.path.join(backup_path, img.id + "_" + img.name + ".json"))
-    download_glance_image(img.id, os.path.join(backup_path, img.id + "_" + img.name + ".img"))
+    file_name = img.id + "_" + img.name
+    meta_file = os.path.join(backup_path, file_name + ".json")
+    image_file = os.path.join(backup_path, file_name + ".img")
 
-    return True
+    if BACKUP_PREVIOUS_PATH:
+        old_backup_path = os.path.join(BACKUP_PREVIOUS_PATH, tenant_id, "glance")
+    else:
+        old_backup_path = None
+
+    downloaded = True
+    journaled = get_journal_step(tenant_id, 'image', img.id)
+
+    if journaled and journaled.get('digest') == img.checksum and find_backup_image(image_file):
+        print "Glance image " + img.name + " was already downloaded."
+    elif INCREMENTAL_BACKUP and glance_image_unchanged(img, meta_file, image_file):
+        print "Glance image " + img.name + " is unchanged. Skipping download."
+    elif INCREMENTAL_BACKUP and old_backup_path and os.path.normpath(old_backup_path) != os.path.normpath(backup_path) and \
+         glance_image_unchanged(img,
+                                os.path.join(old_backup_path, file_name + ".json"),
+                                os.path.join(old_backup_path, file_name + ".img")) and \
+         link_backup_image(os.path.join(old_backup_path, file_name + ".img"), image_file):
+        print "Glance image " + img.name + " is unchanged. Linked it from previous backup."
+    else:
+        downloaded = download_glance_image(img.id, image_file)
+
+    dump_openstack_obj(img, meta_file)
+    add_manifest_entry(tenant_id, 'image', img.id, name=img.name, meta=meta_file, data=img)
+
+    if downloaded:
+        add_manifest_payload(tenant_id, 'image', img.id, image_file)
+        add_journal_step(tenant_id, 'image', img.id, digest=load_image_digest(image_file))
+
+    return downloaded
 
 
 def backup_glance(tenant):
@@ -590,33 +3285,174 @@ def backup_glance(tenant):
     """
     ensure_dir_exists(os.path.join(get_backup_base_path(tenant.id), "glance"))
     glance = get_glance_client()
-    pool = Pool()
+
+    run_parallel(backup_glance_image,
+                 [(tenant.id, img.id) for img in glance.images.list() if img.owner == tenant.id],
+                 'glance')
+
+
+# images of the cloud by name, built once and refreshed with the images
+# updated since the last refresh (deleted images stay in it until a full refresh)
+# glance servers that ignore the updated_at filter are listed fully at most
+# every GLANCE_INDEX_FULL_TTL seconds
+_glance_index = {'names': {},
+                 'updated_at': None,
+                 'refreshed': 0,
+                 'full_refreshed': 0,
+                 'incremental': True,
+                 'refreshing': False,
+                 'added': {}}
+_glance_index_lock = threading.Lock()
+
+
+def refresh_glance_index(full=False):
+    """
+    Update the image name index with all images changed since the last refresh
+    The images are listed without holding the index lock, a refresh
+    that is not full is skipped while another one is running
+    Params: list all images (optional)
+    """
+    glance = get_glance_client()
+    start = time()
+
+    _glance_index_lock.acquire()
 
     try:
-        pool.map(backup_glance_image, [(tenant.id, img.id) for img in glance.images.list() if img.owner == tenant.id])
-    except KeyboardInterrupt:
-        pool.terminate()
+        full = full or not _glance_index['updated_at']
+
+        if not full and (_glance_index['refreshing'] or \
+                         (not _glance_index['incremental'] and start - _glance_index['full_refreshed'] < GLANCE_INDEX_FULL_TTL)):
+            _glance_index['refreshed'] = start
+            return
+
+        full = full or not _glance_index['incremental']
+        cutoff = _glance_index['updated_at']
+        _glance_index['refreshing'] = True
+    finally:
+        _glance_index_lock.release()
+
+    try:
+        if full:
+            images = list(glance.images.list(page_size=GLANCE_PAGE_SIZE))
+        else:
+            images = list(glance.images.list(filters={'updated_at': 'gte:' + cutoff}, page_size=GLANCE_PAGE_SIZE))
+    except:
+        _glance_index['refreshing'] = False
+        raise
+
+    _glance_index_lock.acquire()
+
+    try:
+        # the server ignored the filter and listed all images
+        if not full and [img for img in images if img.updated_at and img.updated_at < cutoff]:
+            print "Glance ignores the updated_at filter, refreshing the image index every " + str(GLANCE_INDEX_FULL_TTL) + " seconds"
+            _glance_index['incremental'] = False
+            full = True
+
+        # images created before the listing started are in it
+        for (img_id, (img_name, owner, added)) in _glance_index['added'].items():
+            if added < start:
+                del _glance_index['added'][img_id]
+
+        if full:
+            names = {}
 
+            # keep claims and images created while listing
+            for (img_name, owners) in _glance_index['names'].items():
+                if None in owners:
+                    names[img_name] = {None: None}
 
-def glance_image_exists(img_name):
+            for (img_id, (img_name, owner, added)) in _glance_index['added'].items():
+                names.setdefault(img_name, {})[img_id] = owner
+
+            _glance_index['names'] = names
+            _glance_index['full_refreshed'] = start
+
+        for img in images:
+            owners = _glance_index['names'].setdefault(img.name, {})
+
+            if img.status == "deleted":
+                owners.pop(img.id, None)
+            else:
+                owners[img.id] = getattr(img, 'owner', None)
+
+            if img.updated_at and img.updated_at > _glance_index['updated_at']:
+                _glance_index['updated_at'] = img.updated_at
+
+        _glance_index['refreshed'] = start
+        _glance_index['refreshing'] = False
+    finally:
+        _glance_index_lock.release()
+
+
+def glance_image_exists(img_name, owner=None):
     """
     Check if a glance image with the same name already exists
+    The index is refreshed if it is older than GLANCE_INDEX_TTL seconds
+    Parameters: image name, owner tenant id (optional)
+    Returns boolean
+    """
+    if time() - _glance_index['refreshed'] > GLANCE_INDEX_TTL:
+        refresh_glance_index()
+
+    _glance_index_lock.acquire()
+
+    try:
+        owners = _glance_index['names'].get(img_name, {})
+
+        return bool(owners) and (owner is None or owner in owners.values())
+    finally:
+        _glance_index_lock.release()
+
+
+def claim_glance_image_name(img_name):
+    """
+    Reserve an image name for creating an image if no image has it
+    so that parallel restores do not create the same image twice
     Parameters: image name
     Returns boolean
     """
-    glance = get_glance_client()
-    return filter(lambda x: x.name == img_name, glance.images.list())
+    if glance_image_exists(img_name):
+        return False
+
+    _glance_index_lock.acquire()
+
+    try:
+        if _glance_index['names'].get(img_name):
+            return False
+
+        _glance_index['names'][img_name] = {None: None}
+        return True
+    finally:
+        _glance_index_lock.release()
+
+
+def add_glance_index_entry(img_name, img_id, owner=None):
+    """
+    Add a created image to the index (replacing the claim of its name)
+    Parameters: image name, image id, owner tenant id (optional)
+    """
+    _glance_index_lock.acquire()
+
+    try:
+        owners = _glance_index['names'].setdefault(img_name, {})
+        owners.pop(None, None)
+
+        if img_id:
+            owners[img_id] = owner
+            _glance_index['added'][img_id] = (img_name, owner, time())
+    finally:
+        _glance_index_lock.release()
 
 
 def restore_glance_image(params):
     """
-    Restore a glance image
-    Params: tupel of tenant_id, absolute name to image json file, absolute name to backup path
+    Restore a glance image and upload its data if the backup contains it
+    Params: tupel of tenant_id, image data dictionary, name of image file (optional)
     """
     tenant_id = params[0]
-    img_file = params[1]
-    backup_path = params[2]
-    img_data = load_openstack_obj(img_file)
+    img_data = dict(params[1])
+    img_file = len(params) > 2 and params[2] or None
     glance = get_glance_client()
 
     del img_data['owner']
@@ -629,32 +3465,53 @@ def restore_glance_image(params):
     del img_data['schema']
     del img_data['status']
 
-    if not glance_image_exists(img_data['name']):
-        glance.images.create(**img_data)
+    if not claim_glance_image_name(img_data['name']):
+        return
+
+    img = None
+
+    try:
+        img = glance.images.create(**img_data)
         print "Created image " + img_data['name']
+    finally:
+        add_glance_index_entry(img_data['name'], img and img.id, img and getattr(img, 'owner', None))
+
+    if img_file and find_backup_image(img_file):
+        glance_upload_image(img.id, img_data['name'], img_file)
+        print "Uploaded image " + img_data['name']
 
 
 def restore_glance(tenant_id):
     """
     Restore all glance stuff
+    The names of all images are listed once, at most
+    SERVICE_CONCURRENCY['glance_upload'] images are uploaded at the same time
     Params: tenant_id
     """
-    backup_path = os.path.join(get_backup_base_path(tenant_id), "glance")
+    refresh_glance_index(True)
 
-    pool = Pool()
-    pool.map(restore_glance_image,
-             [(tenant_id, img_file, backup_path) for img_file in glob(os.path.join(backup_path, '*.json'))])
+    run_parallel(restore_glance_image,
+                 [(tenant_id, img['data'], img['payload']) for img in load_backup_objects(tenant_id, 'image')],
+                 'glance_upload')
 
 
-def cleanup_glance_backup():
+def cleanup_glance_backup(tenant_id):
     """
-    At exit remove all glance images which names start with our backup prefix
+    Remove the backup images created by this run (see open_journal) that are still in glance
+    Params: tenant id
+    """
+    delete_backup_images(tenant_id, [step['image_id'] for step in get_journal_steps(tenant_id, 'snapshot')])
+
+
+def gc_glance_backup():
+    """
+    Remove all glance images which names start with our backup prefix
+    This scans the whole image catalog and also removes the images of concurrent runs
     """
     glance = get_glance_client()
-    pool = Pool()
-    image_ids = (img.id for img in glance.images.list() if img.name.startswith(GLANCE_BACKUP_PREFIX) and img.status != "deleted")
+    image_ids = [img.id for img in glance.images.list() if img.name.startswith(GLANCE_BACKUP_PREFIX) and img.status != "deleted"]
 
-    pool.map(glance_delete, image_ids)
+    run_parallel(glance_delete, image_ids, 'glance')
 
 
 
@@ -664,13 +3521,20 @@ def cleanup_glance_backup():
 def get_cinder_client(tenant_name):
     """
     Instantiate and return a cinder client object
+    The client is cached per tenant
     Params: tenant name
     """
-    return cinder_client.Client('1',
-                                os.environ['OS_USERNAME'],
-                                os.environ['OS_PASSWORD'],
-                                tenant_name,
-                                os.environ['OS_AUTH_URL'])
+    cinder = get_cached_client('cinder', tenant_name)
+
+    if not cinder:
+        cinder = set_cached_client('cinder', tenant_name,
+                                   cinder_client.Client('1',
+                                                        os.environ['OS_USERNAME'],
+                                                        os.environ['OS_PASSWORD'],
+                                                        tenant_name,
+                                                        os.environ['OS_AUTH_URL']))
+
+    return cinder
 
 def attach_volume(tenant, volume_id, vm_id, device):
     """
@@ -702,7 +3566,9 @@ def detach_volume(volume):
 def backup_cinder_volume(params):
     """
     Save volume meta data as json file and trigger a backup of the volume
+    The backup image of an interrupted run (see open_journal) is reused if glance still has it
     Params: tuple of tenant_id, tenant_name, volume_id
+    Returns: tuple of backup image id, backup image name, volume size in bytes
     """
     tenant_id = params[0]
     tenant_name = params[1]
@@ -713,7 +3579,23 @@ def backup_cinder_volume(params):
     volume = cinder.volumes.get(volume_id)
 
     print "Backing up metadata of cinder volume " + volume.display_name
-    dump_openstack_obj(volume, os.path.join(get_backup_base_path(tenant_id), "cinder", "vol_" + volume_id + "_" + volume.display_name + ".json"))
+    vol_file = os.path.join(get_backup_base_path(tenant_id), "cinder", "vol_" + volume_id + "_" + volume.display_name + ".json")
+
+    dump_openstack_obj(volume, vol_file)
+    add_manifest_entry(tenant_id,
+                       'volume',
+                       volume_id,
+                       name=volume.display_name,
+                       meta=vol_file,
+                       data=volume,
+                       depends=["tenant:" + tenant_id],
+                       attached_vms=[a['server_id'] for a in getattr(volume, 'attachments', []) if a.get('server_id')])
+
+    snapshot = get_journal_step(tenant_id, 'snapshot', volume_id)
+
+    if snapshot and glance_image_usable(snapshot['image_id']):
+        print "Reusing backup image " + snapshot['image_id'] + " of volume " + volume.display_name
+        return (snapshot['image_id'], snapshot['image_name'], volume.size * 1024 * 1024 * 1024)
 
     if detach_volume(volume):
         print "Backing up volume " + volume.display_name
@@ -726,12 +3608,13 @@ def backup_cinder_volume(params):
                                                   "raw")
             backup_id = resp[1]['os-volume_upload_image']['image_id']
             backup_name = resp[1]['os-volume_upload_image']['image_name']
+            add_journal_step(tenant_id, 'snapshot', volume_id, image_id=backup_id, image_name=backup_name, obj_type='volume')
         except CinderBadRequest, e:
             print "ERROR volume " + volume.display_name + " could not be backuped!\n" + str(e) + "\n"
         except CinderClientException, e:
             print "ERROR volume " + volume.display_name + " could not be backuped!\n" + str(e) + "\n"
 
-    return (backup_id, backup_name)
+    return (backup_id, backup_name, volume.size * 1024 * 1024 * 1024)
 
 
 def backup_cinder(tenant):
@@ -740,26 +3623,42 @@ def backup_cinder(tenant):
     Params: tenant object
     """
     backups = {}
+    backup_volumes = {}
     backup_params = []
-    ensure_dir_exists(os.path.join(get_backup_base_path(tenant.id), "cinder"))
+    output_dir = os.path.join(get_backup_base_path(tenant.id), "cinder")
+    ensure_dir_exists(output_dir)
     cinder = get_cinder_client(tenant.name)
     glance = get_glance_client()
-    pool = Pool()
 
     for volume in cinder.volumes.list():
-        backup_params.append((tenant.id, tenant.name, volume.id))
+        if get_journal_step(tenant.id, 'download', volume.id):
+            print "Volume " + volume.display_name + " was already backed up"
+        else:
+            backup_params.append((tenant.id, tenant.name, volume.id))
 
-    results = pool.map(backup_cinder_volume, backup_params)
+    results = run_parallel(backup_cinder_volume, backup_params, 'cinder')
 
-    for result in results:
+    for (params, result) in zip(backup_params, results):
         if result[0]:
-            backups[result[0]] = (tenant.id, result[1])
+            backups[result[0]] = (tenant.id, result[1], result[2])
+            backup_volumes[result[0]] = params[2]
+
+    outcomes = wait_for_action_to_finish(backups, GLANCE_UPLOAD_TIMEOUT, cinder_glance_check_upload, cinder_glance_batch_check_upload)
+
+    # Download finished images from glance and delete all of them afterwards
+    downloads = get_items_with_outcome(backups, outcomes).items()
+
+    def download_volume_image(download):
+        (image_id, item) = download
+
+        if download_cinder_glance_image(download):
+            image_file = os.path.join(output_dir, item[1] + ".img")
+            add_manifest_payload(tenant.id, 'volume', backup_volumes[image_id], image_file)
+            add_journal_step(tenant.id, 'download', backup_volumes[image_id], image_id=image_id, digest=load_image_digest(image_file))
 
-    wait_for_action_to_finish(backups, GLANCE_UPLOAD_TIMEOUT, cinder_glance_check_upload)
+    run_parallel(download_volume_image, downloads, 'glance')
 
-    # Download images from glance and delete them afterwards
-    pool.map(download_cinder_glance_image, backups.items())
-    pool.map(glance_delete, backups.keys())
+    delete_backup_images(tenant.id, backups.keys())
 
 
 def cinder_check_volume_got_created(params):
@@ -788,26 +3687,29 @@ def cinder_check_volume_got_created(params):
 def restore_cinder_volume(params):
     """
     Restore a cinder volume
-    Params: tuple of tenant id, tenant name, path to json file, backup directory
+    Params: tuple of tenant id, tenant name, volume data dictionary, name of (uncompressed) image file
+    Returns: id of the new volume or None
     """
     tenant_id = params[0]
     tenant_name = params[1]
-    vol_file = params[2]
-    backup_path = params[3]
+    vol_data = params[2]
+    vol_img_file = params[3]
 
     glance = get_glance_client()
     cinder = get_cinder_client(tenant_name)
 
-    vol_data = load_openstack_obj(vol_file)
     bkp_img_name = GLANCE_BACKUP_PREFIX + "_" + vol_data['id'] + "_" + tenant_name + "_" + vol_data['display_name']
-    vol_img_file = os.path.join(backup_path, bkp_img_name + ".img")
+
+    if not vol_img_file or not find_backup_image(vol_img_file):
+        print "ERROR creating volume " + vol_data['display_name'] + " no image file in backup"
+        return None
 
     print "Uploading image " + bkp_img_name
     glance_img = glance.images.create(container_format="bare",
                                       disk_format="qcow2",
                                       name=bkp_img_name,
                                       visibility="public")
-    glance.images.upload(glance_img.id, open(vol_img_file, 'rb'))
+    glance_upload_image(glance_img.id, bkp_img_name, vol_img_file)
 
     # Make cinder volume from glance image and delete it afterwards
     vol = cinder.volumes.create(size=vol_data['size'],
@@ -818,12 +3720,23 @@ def restore_cinder_volume(params):
                           availability_zone=vol_data['availability_zone'],
                           metadata=vol_data['metadata'])
 
-    wait_for_action_to_finish({vol.id: (tenant_name,)},
-                              GLANCE_DOWNLOAD_TIMEOUT,
-                              cinder_check_volume_got_created)
+    outcomes = wait_for_action_to_finish({vol.id: (tenant_name,)},
+                                         GLANCE_DOWNLOAD_TIMEOUT,
+                                         cinder_check_volume_got_created)
+
+    if outcomes.get(vol.id) == ACTION_DONE:
+        print "Created volume " + vol_data['display_name']
+    else:
+        print "ERROR creating volume " + vol_data['display_name'] + " " + outcomes.get(vol.id, ACTION_FAILED)
+
+    # a volume that is still downloading needs its image
+    if outcomes.get(vol.id) != ACTION_TIMEOUT:
+        glance.images.delete(glance_img.id)
+
+    if outcomes.get(vol.id) == ACTION_DONE:
+        return vol.id
 
-    print "Created volume " + vol_data['display_name']
-    glance.images.delete(glance_img.id)
+    return None
 
 
 def restore_cinder(old_tenant_id, new_tenant):
@@ -831,10 +3744,102 @@ def restore_cinder(old_tenant_id, new_tenant):
     Restore all cinder stuff
     Params: id of old tenant (used for backup on disk), new tenant object
     """
-    backup_path = os.path.join(get_backup_base_path(old_tenant_id), "cinder")
+    run_parallel(restore_cinder_volume,
+                 [(old_tenant_id, new_tenant.name, vol['data'], vol['payload']) for vol in load_backup_objects(old_tenant_id, 'volume')],
+                 'cinder')
+
+
+#
+# TENANT RESTORE
+#
+
+def build_restore_plan(old_tenant_id):
+    """
+    Build the tasks to restore a tenant backup for run_task_graph
+    The tenant comes first, users with their roles, volumes and vms need it
+    and volumes get attached after their vm and the volume were restored.
+    Vms boot from their own snapshot, they do not wait for the images they were booted from
+    Params: tenant id of backup
+    Returns: dictionary of tasks or None if the backup has no tenant
+    """
+    tenants = load_backup_objects(old_tenant_id, 'tenant')
+
+    if not tenants:
+        print "ERROR backup of tenant " + old_tenant_id + " does not exist!"
+        return None
+
+    tenant_task = "tenant:" + old_tenant_id
+    tasks = {tenant_task: ('keystone', lambda results, data=tenants[0]['data']: restore_keystone_tenant(data), [])}
+    roles = load_backup_objects(old_tenant_id, 'role')
+
+    for user in load_backup_objects(old_tenant_id, 'user'):
+        user_roles = get_user_roles(roles, user)
+        tasks["user:" + user['id']] = ('keystone',
+                                       lambda results, data=user['data'], user_roles=user_roles: restore_keystone_user((results[tenant_task].id, data, user_roles)),
+                                       [tenant_task])
+
+    refresh_glance_index(True)
+
+    for img in load_backup_objects(old_tenant_id, 'image'):
+        tasks["image:" + img['id']] = ('glance_upload',
+                                       lambda results, data=img['data'], payload=img['payload']: restore_glance_image((old_tenant_id, data, payload)),
+                                       [])
+
+    for vm in load_backup_objects(old_tenant_id, 'vm'):
+        tasks["vm:" + vm['id']] = ('nova',
+                                   lambda results, data=vm['data'], payload=vm['payload']: restore_nova_vm((results[tenant_task].id, data, payload)),
+                                   [tenant_task])
+
+    for vol in load_backup_objects(old_tenant_id, 'volume'):
+        vol_task = "volume:" + vol['id']
+        tasks[vol_task] = ('cinder',
+                           lambda results, data=vol['data'], payload=vol['payload']: restore_cinder_volume((old_tenant_id, results[tenant_task].name, data, payload)),
+                           [tenant_task])
+
+        for attachment in vol['data'].get('attachments') or []:
+            vm_task = "vm:" + attachment.get('server_id', '')
+
+            if vm_task not in tasks:
+                continue
+
+            def attach(results, vm_task=vm_task, vol_task=vol_task, device=attachment.get('device')):
+                return restore_volume_attachment(results[tenant_task], results[vm_task], results[vol_task], device)
+
+            tasks["attachment:" + vol['id'] + ":" + attachment['server_id']] = ('nova', attach, [vm_task, vol_task])
+
+    return tasks
+
+
+def restore_volume_attachment(tenant, vm_id, volume_id, device):
+    """
+    Attach a restored volume to a restored vm
+    Params: new tenant object, id of new vm, id of new volume, device name
+    """
+    if not vm_id or not volume_id:
+        print "Not attaching volume " + str(volume_id) + " to vm " + str(vm_id) + " because one of them was not restored"
+        return
+
+    attach_volume(tenant, volume_id, vm_id, device)
+    print "Attached volume " + volume_id + " to vm " + vm_id + " as " + str(device)
+
+
+def restore_tenant(old_tenant_id):
+    """
+    Restore everything of a tenant backup
+    Independent objects get restored in parallel (see build_restore_plan)
+    Params: tenant id of backup
+    Returns: new tenant object or None
+    """
+    tasks = build_restore_plan(old_tenant_id)
+
+    if not tasks:
+        return None
+
+    start = time()
+    results = run_task_graph(tasks)
+    print "Restored " + str(len(results)) + " of " + str(len(tasks)) + " objects in " + str(int(time() - start)) + " seconds"
 
-    map(restore_cinder_volume,
-        [(old_tenant_id, new_tenant.name, vol_file, backup_path) for vol_file in glob(os.path.join(backup_path, '*.json'))])
+    return results.get("tenant:" + old_tenant_id)
 
 
 #
@@ -843,10 +3848,17 @@ def restore_cinder(old_tenant_id, new_tenant):
 def get_neutron_client(tenant_name):
     """
     Instantiate and return a neutron client
+    The client is cached per tenant
     Params: tenant name
     """
-    return neutron_client.Client('2.0',
-                                 username=os.environ["OS_USERNAME"],
-                                 password=os.environ["OS_PASSWORD"],
-                                 tenant_name=tenant_name,
-                                 auth_url=os.environ["OS_AUTH_URL"])
+    neutron = get_cached_client('neutron', tenant_name)
+
+    if not neutron:
+        neutron = set_cached_client('neutron', tenant_name,
+                                    neutron_client.Client('2.0',
+                                                          username=os.environ["OS_USERNAME"],
+                                                          password=os.environ["OS_PASSWORD"],
+                                                          tenant_name=tenant_name,
+                                                          auth_url=os.environ["OS_AUTH_URL"]))
+
+    return neutron
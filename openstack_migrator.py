@@ -25,14 +25,19 @@
 
 import os
 import sys
+import json
 import time
 import shutil
 import logging
+import threading
+from heapq import heappush, heappop
 from datetime import datetime
 import novaclient.exceptions
 import novaclient.v1_1.client as nvclient
-from multiprocessing import Pool
 from openstack_lib import get_nova_client, get_keystone_client, wait_for_action_to_finish, nova_check_migration
+from openstack_lib import run_parallel
+from openstack_lib import nova_batch_check_migration
+from openstack_lib import ACTION_DONE
 
 
 ###[ Configuration ]###
@@ -44,24 +49,74 @@ final_wait_timeout = 300
 nova_dir="/var/lib/nova"
 log_level = logging.DEBUG
 
-if len(sys.argv) == 2 and (sys.argv[1] == "--help" or sys.argv[1] == "-h"):
-  print sys.argv[0] + " [hypervisor]"
+# seconds a fetched vm is reused by the migration workers
+vm_cache_ttl = 30
+
+# overcommit of target hypervisors used by the migration planner
+cpu_allocation_ratio = 16.0
+ram_allocation_ratio = 1.5
+disk_allocation_ratio = 1.0
+
+# estimated duration of a migration in simulation mode
+# live migrations copy the ram, offline migrations the disk
+migration_setup_time = 10
+migration_rate_mb = 100
+
+# concurrent migrations in total, per source and per target host
+max_migrations = 8
+max_migrations_per_source = 4
+max_migrations_per_target = 2
+
+args = sys.argv[1:]
+simulate_file = None
+aggregate_name = None
+hostnames = []
+smallest_first = "--smallest-first" in args
+
+if "--help" in args or "-h" in args:
+  print sys.argv[0] + " [--simulate cluster.json] [--smallest-first] [--hosts h1,h2 | --aggregate name | hypervisor]"
+  print "--simulate plans the migrations with hypervisors, flavors, servers and aggregates read from a json file"
+  print "--smallest-first migrates the vms with the least ram first"
+  print "--hosts and --aggregate drain several hypervisors at once"
   sys.exit(1)
-elif len(sys.argv) < 2:
-  hostname = os.uname()[1]
-else:
-  hostname = sys.argv[1]
+
+if smallest_first:
+  args.remove("--smallest-first")
+
+if "--simulate" in args and args.index("--simulate") + 1 < len(args):
+  simulate_file = args[args.index("--simulate") + 1]
+  del args[args.index("--simulate"):args.index("--simulate") + 2]
+
+if "--hosts" in args and args.index("--hosts") + 1 < len(args):
+  hostnames = args[args.index("--hosts") + 1].split(",")
+  del args[args.index("--hosts"):args.index("--hosts") + 2]
+
+if "--aggregate" in args and args.index("--aggregate") + 1 < len(args):
+  aggregate_name = args[args.index("--aggregate") + 1]
+  del args[args.index("--aggregate"):args.index("--aggregate") + 2]
+
+hostnames += args
+
+if not hostnames and not aggregate_name:
+  hostnames = [os.uname()[1]]
 
 
 ###[ Subroutines ]###
 
 offline_migrations = []
 resume_vms = []
+vm_cache = {}
+vm_cache_lock = threading.Lock()
+flavors = {}
+migration_targets = {}
+timeline = {}
 log = logging.getLogger('openstack_migrator')
-logging.basicConfig(
-    filename = os.path.join(nova_dir, "openstack_migrator.log"),
-    filemode = "a",
-    level = log_level)
+
+if not simulate_file:
+  logging.basicConfig(
+      filename = os.path.join(nova_dir, "openstack_migrator.log"),
+      filemode = "a",
+      level = log_level)
 
 # dont buffer stdout
 sys.stdout = os.fdopen(sys.stdout.fileno(), 'w', 0)
@@ -70,29 +125,297 @@ def log_prefix():
     return "[%s] %s: " %(datetime.now().strftime("%d.%m.%Y %H:%M:%S"), os.uname()[1])
 
 
-# get hypervisor object by its hostname
-def get_hypervisor_for_host(hostname):
+# get the compute host of a hypervisor as used by the servers host filter
+def get_host_of_hypervisor(hypervisor):
+  return hypervisor.get('service', {}).get('host', hypervisor['hypervisor_hostname'])
+
+
+# get the compute hosts to drain from the hypervisor names or the aggregate
+# with the hypervisors and aggregates as dictionaries of their stats
+def get_drained_hosts(hypervisors, aggregates):
+  if aggregate_name:
+    aggregate = [aggregate for aggregate in aggregates if aggregate['name'] == aggregate_name]
+
+    if not aggregate:
+      print "Aggregate " + aggregate_name + " cannot be found"
+      sys.exit(1)
+
+    return list(aggregate[0]['hosts'])
+
+  hosts = []
+
+  for name in hostnames:
+    hypervisor = [hypervisor for hypervisor in hypervisors if name in (hypervisor['hypervisor_hostname'], get_host_of_hypervisor(hypervisor))]
+
+    if not hypervisor:
+      print "Hypervisor " + name + " cannot be found"
+      sys.exit(1)
+
+    hosts.append(get_host_of_hypervisor(hypervisor[0]))
+
+  return hosts
+
+
+# remember fetched vms for the migration workers
+def cache_vms(vms):
+  vm_cache_lock.acquire()
+
   try:
-    hypervisor = nova.hypervisors.search(hostname, servers=True)[0]
-  except Exception:
-    hypervisor = None
+    for vm in vms:
+      vm_cache[vm.id] = (time.time(), vm)
+  finally:
+    vm_cache_lock.release()
+
+  return vms
+
+
+# get all vm objects of the compute hosts of all tenants with one list call per host
+def get_vms_of_hosts(hosts):
+  vms = []
+
+  for host in hosts:
+    vms.extend(nova.servers.list(search_opts={'host': host, 'all_tenants': 1}))
+
+  return cache_vms(vms)
+
+
+# get a vm object from the cache or fetch it if it's older than vm_cache_ttl
+def get_vm(vm_id):
+  vm_cache_lock.acquire()
+
+  try:
+    (fetched, vm) = vm_cache.get(vm_id, (0, None))
+  finally:
+    vm_cache_lock.release()
+
+  if vm and time.time() - fetched < vm_cache_ttl:
+    return vm
+
+  return refresh_vm(vm_id)
+
+
+# fetch a vm object after its state was changed
+# the workers use the nova client of their thread
+def refresh_vm(vm_id):
+  return cache_vms([get_nova_client(tenant.id).servers.get(vm_id)])[0]
+
+
+# free ram (mb), vcpus and disk (gb) of a hypervisor as dictionary of its stats
+def get_capacity(hypervisor):
+  return {'ram': hypervisor['memory_mb'] * ram_allocation_ratio - hypervisor['memory_mb_used'],
+          'vcpus': hypervisor['vcpus'] * cpu_allocation_ratio - hypervisor['vcpus_used'],
+          'disk': hypervisor['local_gb'] * disk_allocation_ratio - hypervisor['local_gb_used']}
+
+
+# ram (mb), vcpus and disk (gb) a vm as dictionary needs on its target
+# returns None if the flavor of the vm is unknown (e.g. deleted)
+def get_demand(server):
+  flavor = flavors.get(server['flavor']['id'])
+
+  if not flavor:
+    return None
+
+  return {'ram': flavor['ram'],
+          'vcpus': flavor['vcpus'],
+          'disk': flavor['disk'] + flavor.get('OS-FLV-EXT-DATA:ephemeral', 0)}
+
+
+# assign every vm a target hypervisor with enough free ram, vcpus and disk
+# biggest vms first, each onto the hypervisor with the most ram left
+# hypervisors of drained hosts and down or disabled ones are no targets
+# returns dictionary of vm id and target host and list of vms that dont fit anywhere
+def plan_migrations(servers, hypervisors, drained_hosts):
+  targets = {}
+  placed = {}
+
+  for hypervisor in hypervisors:
+    host = get_host_of_hypervisor(hypervisor)
+
+    if host not in drained_hosts and hypervisor.get('state', 'up') == 'up' and hypervisor.get('status', 'enabled') == 'enabled':
+      targets[host] = get_capacity(hypervisor)
+
+  # vms of unknown flavors are left to the scheduler
+  unplaced = [server for server in servers if not get_demand(server)]
+  servers = [server for server in servers if get_demand(server)]
+
+  for server in sorted(servers, key=lambda x: (-get_demand(x)['ram'], -get_demand(x)['vcpus'], x['id'])):
+    demand = get_demand(server)
+    fitting = [host for host in sorted(targets) if not [r for r in demand if targets[host][r] < demand[r]]]
+
+    if not fitting:
+      unplaced.append(server)
+      continue
+
+    target = max(fitting, key=lambda host: targets[host]['ram'])
 
-  return hypervisor
+    for r in demand:
+      targets[target][r] -= demand[r]
 
+    placed[server['id']] = target
 
-# get all vm objects for a hypervisor
-def get_vms_of_hypervisor(hypervisor):
-  return map(lambda x: nova.servers.get(x.get('uuid')), hypervisor.servers)
+  return (placed, unplaced)
+
+
+# plan the targets of the vms with the current hypervisor stats
+def plan_targets(vms):
+  if not flavors:
+    flavors.update([(flavor.id, flavor._info) for flavor in nova.flavors.list(is_public=None)])
+
+  (placed, unplaced) = plan_migrations([vm._info for vm in vms],
+                                       [hypervisor._info for hypervisor in nova.hypervisors.list()],
+                                       drained_hosts)
+  migration_targets.clear()
+  migration_targets.update(placed)
+
+  for server in unplaced:
+    log.info("%s no target planned for vm %s (%s) leaving it to the scheduler" % (log_prefix(), server['name'], get_unplaced_reason(server)))
+    print "No target planned for vm %s (%s)" % (server['name'], get_unplaced_reason(server))
+
+
+# why no target could be planned for a vm
+def get_unplaced_reason(server):
+  if not get_demand(server):
+    return "unknown flavor " + str(server['flavor']['id'])
+
+  return "no hypervisor has enough capacity"
+
+
+# mb to copy to migrate a vm, 0 if its flavor is unknown
+# live migrations copy the ram, offline migrations the disk
+def get_migration_size(server):
+  if not get_demand(server):
+    return 0
+  elif live_migration and server['status'] != "SHUTOFF":
+    return get_demand(server)['ram']
+  else:
+    return get_demand(server)['disk'] * 1024
+
+
+# estimated seconds to migrate a vm
+def get_migration_duration(server):
+  return migration_setup_time + get_migration_size(server) / float(migration_rate_mb)
+
+
+# order in which the vms get migrated
+def get_migration_queue(servers):
+  if smallest_first:
+    return sorted(servers, key=lambda x: ((get_demand(x) or {}).get('ram', 0), x['id']))
+
+  return list(servers)
+
+
+# the groups of a vm that limit its concurrent migrations
+# returns dictionary of group name and maximal number of concurrent migrations
+def get_migration_limits(server):
+  limits = {'all': max_migrations,
+            'source ' + server['OS-EXT-SRV-ATTR:host']: max_migrations_per_source}
+
+  if migration_targets.get(server['id']):
+    limits['target ' + migration_targets[server['id']]] = max_migrations_per_target
+
+  return limits
+
+
+# take the vms of the queue whose groups have free migration slots
+# the slots of the picked vms are counted in running
+def pick_migrations(queue, running):
+  picked = []
+
+  for server in list(queue):
+    limits = get_migration_limits(server)
+
+    if [group for (group, limit) in limits.items() if running.get(group, 0) >= limit]:
+      continue
+
+    for group in limits:
+      running[group] = running.get(group, 0) + 1
+
+    queue.remove(server)
+    picked.append(server)
+
+  return picked
+
+
+# give the migration slots of a vm to the next ones
+def release_migration(server, running):
+  for group in get_migration_limits(server):
+    running[group] -= 1
+
+
+# remember when the migration of a vm started or finished for the timeline of its source host
+# success is None for a started migration
+def add_to_timeline(server, elapsed, success=None):
+  entry = timeline.setdefault(server['OS-EXT-SRV-ATTR:host'], {'started': 0, 'done': 0, 'failed': 0, 'first': elapsed, 'last': elapsed})
+
+  if success is None:
+    entry['started'] += 1
+  elif success:
+    entry['done'] += 1
+  else:
+    entry['failed'] += 1
+
+  entry['last'] = elapsed
+
+
+# print the migrations of every drained host and when its first one started and last one finished
+def print_timeline(hosts):
+  for host in hosts:
+    if host in timeline:
+      entry = timeline[host]
+      print "%s: %d migrations, %d done, %d failed, first started after %.0fs, last finished after %.0fs" % \
+            (host, entry['started'], entry['done'], entry['failed'], entry['first'], entry['last'])
+      log.info("%s Drained %s: %d migrations, %d done, %d failed, %.0fs - %.0fs" % \
+               (log_prefix(), host, entry['started'], entry['done'], entry['failed'], entry['first'], entry['last']))
+    else:
+      print "%s: no vms" % (host,)
+
+
+# simulate the drain of the hosts with the hypervisors, flavors, servers and aggregates of a json file
+# migrations are started like in migrate_all_vms and take get_migration_duration seconds
+# prints the assignment, start and end of every migration, the drain time and the timeline per host
+def simulate_drain(cluster_file):
+  fh = open(cluster_file)
+  cluster = json.load(fh)
+  fh.close()
+
+  flavors.update([(flavor['id'], flavor) for flavor in cluster['flavors']])
+  drained = get_drained_hosts(cluster['hypervisors'], cluster.get('aggregates', []))
+  servers = [server for server in cluster['servers'] if server.get('OS-EXT-SRV-ATTR:host') in drained]
+  (placed, unplaced) = plan_migrations(servers, cluster['hypervisors'], drained)
+  migration_targets.update(placed)
+  queue = get_migration_queue([server for server in servers if server['id'] in placed])
+  running = {}
+  finishing = []
+  clock = 0
+
+  for server in unplaced:
+    print "vm %s has no target (%s)" % (server['name'], get_unplaced_reason(server))
+
+  while queue or finishing:
+    for server in pick_migrations(queue, running):
+      duration = get_migration_duration(server)
+      print "%6.0fs vm %s -> %s (%.0fs)" % (clock, server['name'], placed[server['id']], duration)
+      add_to_timeline(server, clock)
+      heappush(finishing, (clock + duration, server['id'], server))
+
+    (clock, server_id, server) = heappop(finishing)
+    release_migration(server, running)
+    add_to_timeline(server, clock, True)
+
+  print "%d of %d vms placed, estimated drain time %.0fs" % (len(placed), len(servers), clock)
+  print_timeline(drained)
 
 
 # migrate a vm online or offline depending on its status
-def migrate((tenant_id,vm_id)):
-  nova = get_nova_client(tenant_id)
-  vm = nova.servers.get(vm_id)
+# the cached vm object is only read, the actions use the nova client of the thread
+# returns True if the vm is migrating
+def migrate(vm_id):
+  vm = get_vm(vm_id)
+  servers = get_nova_client(tenant.id).servers
 
   if vm.status == "MIGRATING" or vm.status == "VERIFY_RESIZE":
       log.debug("%s vm %s is in state %s skipping migration" % (log_prefix(), vm.name, vm.status))
-      return 0
+      return True
 
   log.debug("%s Vm info %s" %(log_prefix(), vm._info))
 
@@ -104,99 +427,147 @@ def migrate((tenant_id,vm_id)):
       shutil.rmtree(resize_dir)
 
   try:
-    vm.lock()
+    servers.lock(vm.id)
 
     if vm.status == "SHUTOFF":
       log.info("%s offline migraion of vm %s" % (log_prefix(), vm.name))
-      vm.migrate()
+      servers.migrate(vm.id)
     else:
-      vm.reset_state(state="active")
-      vm = nova.servers.get(vm.id)
+      servers.reset_state(vm.id, "active")
 
       if live_migration:
-        log.info("%s live migraion of vm %s" % (log_prefix(), vm.name))
-        vm.live_migrate(block_migration=block_migration)
+        log.info("%s live migraion of vm %s to %s" % (log_prefix(), vm.name, migration_targets.get(vm.id)))
+        servers.live_migrate(vm.id, migration_targets.get(vm.id), block_migration, False)
       else:
         log.info("%s stopping vm %s" % (log_prefix(), vm.name,))
-        vm.stop()
+        servers.stop(vm.id)
         time.sleep(5)
         log.info("%s offline migration of vm %s" % (log_prefix(), vm.name))
-        vm = nova.servers.get(vm.id)
-        vm.migrate()
+        vm = refresh_vm(vm.id)
+        servers.migrate(vm.id)
     print "Migration of vm %s started.\n" % (vm.name,)
+    return True
   except Exception, e:
     log.error("%s Migration of vm %s failed!\n%s" % (log_prefix(), vm.name, str(e)))
     print "Migration of vm %s failed!\n%s\n" % (vm.name, str(e))
     log.debug("%s Vm info %s" % (log_prefix(), vm._info))
+    return False
   finally:
-    vm.unlock()
-
-
-def migrate_all_vms_of_hypervisor(hypervisor):
-  vms = get_vms_of_hypervisor(hypervisor)
-  vm_ids = map(lambda(vm): (tenant.id, vm.id), vms)
-  pool = Pool()
-  pool.map(migrate, vm_ids)
-  #map(lambda vm: migrate(vm), vms)
-  waiting_for_migrations = {}
+    servers.unlock(vm.id)
+
+
+# migrate the vms through a queue limited by max_migrations, max_migrations_per_source
+# and max_migrations_per_target, the next ones start when a migration has finished
+def migrate_all_vms(vms):
+  plan_targets(vms)
+  queue = get_migration_queue([vm._info for vm in vms])
+  running = {}
+  started = {}
+
+  def start_migrations():
+    items = {}
+
+    while queue:
+      picked = pick_migrations(queue, running)
+
+      if not picked:
+        break
+
+      for (server, migrating) in zip(picked, run_parallel(migrate, [server['id'] for server in picked], 'nova')):
+        add_to_timeline(server, time.time() - drain_start)
+
+        if migrating:
+          started[server['id']] = server
+          items[server['id']] = (tenant.id,
+                                 server['name'],
+                                 get_migration_size(server) * 1024 * 1024,
+                                 server['OS-EXT-SRV-ATTR:host'],
+                                 migration_targets.get(server['id']))
+        else:
+          # failed migrations give their slots to the next vms
+          release_migration(server, running)
+          add_to_timeline(server, time.time() - drain_start, False)
+
+    return items
+
+  # a timed out migration may still be running, its slots are given
+  # to the next vms anyway to not block the drain
+  def migration_finished(vm_id, outcome):
+    release_migration(started[vm_id], running)
+    add_to_timeline(started[vm_id], time.time() - drain_start, outcome == ACTION_DONE)
+    return start_migrations()
 
   for vm in vms:
-    waiting_for_migrations[vm.id] = (tenant.id, vm.name)
-
     if vm.status == "SHUTOFF":
       offline_migrations.append(vm)
     elif vm.status != "SHUTOFF" and not live_migration:
       offline_migrations.append(vm)
       resume_vms.append(vm)
 
-  wait_for_action_to_finish(waiting_for_migrations, migration_timeout/3, nova_check_migration)
+  wait_for_action_to_finish(start_migrations(),
+                            migration_timeout/3,
+                            nova_check_migration,
+                            nova_batch_check_migration,
+                            migration_finished)
 
 
 
 ###[ MAIN PART ]###
 
-# get nova client and hypervisor objects
+if simulate_file:
+  simulate_drain(simulate_file)
+  sys.exit(0)
+
+# get nova client and the hosts to drain
+# all hosts are drained together through one migration queue
 keystone = get_keystone_client()
 tenant = keystone.tenants.find(name=os.environ['OS_TENANT_NAME'])
 nova = get_nova_client(tenant.id)
-hypervisor = get_hypervisor_for_host(hostname)
 
-if not hypervisor:
-  print "Hypervisor " + hostname + " cannot be found"
-  sys.exit(1)
+if aggregate_name:
+  drained_hosts = get_drained_hosts([], [aggregate._info for aggregate in nova.aggregates.list()])
+else:
+  drained_hosts = get_drained_hosts([hypervisor._info for hypervisor in nova.hypervisors.list()], [])
+
+# the hosts are looked up once, their vms are listed in bulk per round
+drain_start = time.time()
+vms = get_vms_of_hosts(drained_hosts)
 
 # check if there are any vms, trigger live migration and wait for their completion
-if hasattr(hypervisor, "servers"):
-    migrate_all_vms_of_hypervisor(hypervisor)
+if vms:
+    migrate_all_vms(vms)
 else:
-  log.info("%s Hypervisor %s serves no vms" % (log_prefix(), hostname))
-  print "Hypervisor " + hostname + " serves no vms"
+  log.info("%s Hypervisors %s serve no vms" % (log_prefix(), ", ".join(drained_hosts)))
+  print "Hypervisors " + ", ".join(drained_hosts) + " serve no vms"
 
 
 # Are there any vm left that were not migrateable? Try another time
-hypervisor = get_hypervisor_for_host(hostname)
+vms = get_vms_of_hosts(drained_hosts)
 
-if hypervisor and hasattr(hypervisor, "servers"):
-    migrate_all_vms_of_hypervisor(hypervisor)
+if vms:
+    migrate_all_vms(vms)
 
     # still vms left? shut em down and migrate offline
-    hypervisor = get_hypervisor_for_host(hostname)
+    vms = get_vms_of_hosts(drained_hosts)
 
-    if hypervisor and hasattr(hypervisor, "servers"):
-        for vm in get_vms_of_hypervisor(hypervisor):
+    if vms:
+        for vm in vms:
             log.debug("%s Resetting state to active" % log_prefix())
             vm.reset_state(state="active")
-            vm = nova.servers.get(vm.id)
+            vm = refresh_vm(vm.id)
             vm.stop()
 
-        migrate_all_vms_of_hypervisor(hypervisor)
+        migrate_all_vms(get_vms_of_hosts(drained_hosts))
 
+log.info("%s Drained hypervisors %s in %.0fs" % (log_prefix(), ", ".join(drained_hosts), time.time() - drain_start))
+print "Drained hypervisors %s in %.0fs" % (", ".join(drained_hosts), time.time() - drain_start)
+print_timeline(drained_hosts)
 
 # offline migrated machines sometimes stay in state VERIFY_RESIZE, reset them
 for vm in offline_migrations:
   log.debug("%s Resetting state of offline migrated vm %s" % (log_prefix(), vm.name))
   vm.reset_state(state="active")
-  vm = nova.servers.get(vm.id)
+  vm = refresh_vm(vm.id)
   vm.stop()
 
 # resume vms must be started
@@ -28,7 +28,7 @@
 
 import os
 import sys
-from openstack_lib import restore_keystone, restore_glance, restore_cinder, restore_nova
+from openstack_lib import restore_tenant, verify_backup
 
 
 #
@@ -37,15 +37,20 @@ from openstack_lib import restore_keystone, restore_glance, restore_cinder, rest
 
 # Check if we got enough params
 if len(sys.argv) < 2:
-    print sys.argv[0] + " <tenant_id>"
+    print sys.argv[0] + " [--verify] <tenant_id>"
     sys.exit(1)
 
-old_tenant_id = sys.argv[1]
+old_tenant_id = sys.argv[-1]
 
 # dont buffer stdout
 sys.stdout = os.fdopen(sys.stdout.fileno(), 'w', 0)
 
-new_tenant = restore_keystone(old_tenant_id)
-restore_glance(old_tenant_id)
-restore_cinder(old_tenant_id, new_tenant)
-restore_nova(old_tenant_id, new_tenant)
+# only check the image files of the backup
+if "--verify" in sys.argv[1:-1]:
+    if verify_backup(old_tenant_id):
+        sys.exit(0)
+    else:
+        sys.exit(1)
+
+if not restore_tenant(old_tenant_id):
+    sys.exit(1)